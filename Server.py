@@ -8,16 +8,24 @@ Usage:
     python server.py ingest   — run the ingest API only
     python server.py read     — run the read API only
     python server.py both     — run both APIs concurrently (normal usage)
+    python server.py serve    — run both APIs as pre-forked worker processes
+                                (production, see prefork.py)
 
 When running both, a threading.Event is created here and passed into both
 APIs. IngestAPI sets it after every successful snapshot write; ReadAPI's SSE
-generator waits on it and pushes to connected frontend clients the moment it
+producer waits on it and pushes to connected frontend clients the moment it
 fires — no polling, no delay.
 
 Running as separate processes (python server.py ingest / python server.py read)
-loses the shared Event, so the SSE generator falls back to polling SystemState
-in the database. This is fine for deployments where the two APIs need to be
-managed separately, but for normal usage 'both' is recommended.
+loses the shared Event. Instead, the ingest process sends a datagram to every
+read process after each commit, and each read process has one ChangeListener
+that wakes its SSE producer (see api/change_notify.py). If a datagram is lost,
+the listener still notices the change by probing the SQLite data version. This
+suits deployments where the two APIs restart on different schedules.
+
+'serve' uses more than one core: a supervisor forks ingest and read worker
+processes that share each API's listening socket. One designated writer
+process performs every database write (see prefork.py).
 """
 
 import sys
@@ -36,10 +44,15 @@ def _import_apis():
 
 
 def main() -> int:
-    if len(sys.argv) < 2 or sys.argv[1] not in ('ingest', 'read', 'both'):
-        print("Usage: python server.py [ingest | read | both]")
+    if len(sys.argv) < 2 or sys.argv[1] not in ('ingest', 'read', 'both', 'serve'):
+        print("Usage: python server.py [ingest | read | both | serve]")
         return 1
 
+    if sys.argv[1] == 'serve':
+        from config import Config
+        from prefork import Supervisor
+        return Supervisor(Config(__file__)).run()
+
     IngestAPI, ReadAPI = _import_apis()
     mode = sys.argv[1]
 
@@ -57,9 +70,15 @@ def main() -> int:
 
         ingest = IngestAPI()
         ingest.set_update_event(update_event)
+        # IngestAPI.run() upgrades the schema too, but on its own thread;
+        # do it first so the read API never starts on an older schema
+        from migrations import upgrade
+        upgrade(ingest.engine)
 
         read = ReadAPI()
         read.set_update_event(update_event)
+        # Let ReadAPI's response cache hear about commits directly
+        read.attach_ingest(ingest)
 
         # Run ingest in a background thread, read in the main thread.
         # Flask needs the main thread for signal handling in debug mode.
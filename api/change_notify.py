@@ -0,0 +1,186 @@
+"""
+api/change_notify.py
+
+Cross-process "new data was committed" signal for deployments that run the
+ingest and read APIs as separate processes (python server.py ingest /
+python server.py read).
+
+    IngestAPI process                         ReadAPI process(es)
+    ┌──────────────────┐   datagram per   ┌──────────────────────────┐
+    │  ChangeNotifier  │ ───────────────► │ ChangeListener thread    │
+    │  notify()        │   commit         │  sets one threading.Event│
+    └──────────────────┘                  └────────────┬─────────────┘
+                                                       ▼
+                                            SSE producer wakes once and
+                                            fans out to every client
+
+Every read process binds a Unix datagram socket in a shared directory; after
+each commit the ingest process sends one byte to every socket it finds there.
+Sending never blocks: a full socket buffer means the listener already has a
+wake-up pending, and sockets whose process has gone away are removed.
+
+Datagrams can still be lost (for example while a read process restarts), and
+Unix sockets do not exist everywhere, so the listener also probes the
+database's data version — PRAGMA data_version on SQLite, which changes
+whenever another connection commits. Without a socket that probe is the
+only signal and runs every second; with one it is a slower safety net.
+
+Usage:
+    # ingest process
+    notifier = ChangeNotifier(notify_dir)
+    notifier.notify()
+
+    # read process
+    listener = ChangeListener(notify_dir, probe=read_data_version)
+    listener.start()
+    listener.event.wait()
+"""
+
+import atexit
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable
+
+_logger = logging.getLogger(__name__)
+
+# Seconds between data-version probes when the socket is the main signal, and
+# when it is unavailable and the probe is all there is
+PROBE_INTERVAL_WITH_SOCKET    = 5.0
+PROBE_INTERVAL_WITHOUT_SOCKET = 1.0
+
+_SOCKET_SUFFIX = '.sock'
+
+
+def default_notify_dir(config) -> Path:
+    """Return the directory ingest and read processes share for change
+    notifications: database.notify_dir from config.json if set, otherwise a
+    per-database directory under the system temp dir (kept short, because
+    Unix socket paths are limited to about 100 characters)."""
+    configured = getattr(config.database, 'notify_dir', None)
+    if configured:
+        return Path(configured)
+    url    = config.database.connection_string
+    digest = hashlib.sha1(os.path.abspath(url.split('///', 1)[-1]).encode()).hexdigest()[:12]
+    return Path(tempfile.gettempdir()) / f'metrics-notify-{digest}'
+
+
+def sockets_supported() -> bool:
+    return hasattr(socket, 'AF_UNIX')
+
+
+class ChangeNotifier:
+    """Ingest side: wakes every ChangeListener registered in notify_dir.
+
+    Args:
+        notify_dir: Directory shared with the read processes
+    """
+
+    def __init__(self, notify_dir: Path):
+        self._notify_dir = Path(notify_dir)
+        self._socket     = None
+        if sockets_supported():
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+
+    def notify(self):
+        """Send a wake-up to every listening read process. Never blocks and
+        never raises; failures only cost that process its instant push."""
+        if self._socket is None or not self._notify_dir.is_dir():
+            return
+        for path in self._notify_dir.glob('*' + _SOCKET_SUFFIX):
+            try:
+                self._socket.sendto(b'!', str(path))
+            except BlockingIOError:
+                pass   # buffer full: the listener already has wake-ups pending
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a read process that exited without cleaning up
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            except OSError as e:
+                _logger.debug("Change notification to %s failed: %s", path, str(e))
+
+
+class ChangeListener:
+    """Read side: one background thread per process that sets self.event
+    whenever the ingest process reports a commit or the data version moves.
+
+    Args:
+        notify_dir: Directory shared with the ingest process
+        probe:      Callable returning a value that changes whenever new data
+                    is committed (e.g. PRAGMA data_version)
+    """
+
+    def __init__(self, notify_dir: Path, probe: Callable[[], object]):
+        self.event       = threading.Event()
+        self._notify_dir = Path(notify_dir)
+        self._probe      = probe
+        self._socket     = None
+        self._path: Path | None = None
+        self._thread     = threading.Thread(target=self._listen, name='ChangeListener', daemon=True)
+
+    def start(self):
+        """Bind the notification socket (if possible) and start listening."""
+        if sockets_supported():
+            try:
+                self._notify_dir.mkdir(parents=True, exist_ok=True)
+                self._path   = self._notify_dir / f'read-{os.getpid()}-{id(self):x}{_SOCKET_SUFFIX}'
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._socket.bind(str(self._path))
+                self._socket.settimeout(PROBE_INTERVAL_WITH_SOCKET)
+                atexit.register(self.stop)
+            except OSError as e:
+                _logger.warning("Change notification socket unavailable (%s); probing the data version instead", str(e))
+                self._socket = None
+        self._thread.start()
+        _logger.info("ChangeListener started (%s)",
+                     f"socket {self._path}" if self._socket else "data version probe only")
+
+    def stop(self):
+        """Close and remove the notification socket."""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        if self._path is not None:
+            try:
+                self._path.unlink()
+            except OSError:
+                pass
+
+    def _listen(self):
+        last_seen = self._safe_probe()
+        while True:
+            sock = self._socket
+            if sock is not None:
+                try:
+                    sock.recv(64)
+                    # Absorb the commit into the probe baseline so the safety
+                    # net does not fire a second wake-up for it
+                    last_seen = self._safe_probe()
+                    self.event.set()
+                    continue
+                except socket.timeout:
+                    pass
+                except OSError:
+                    # Socket closed by stop(); carry on with probing alone
+                    self._socket = None
+            else:
+                threading.Event().wait(PROBE_INTERVAL_WITHOUT_SOCKET)
+
+            current = self._safe_probe()
+            if current != last_seen:
+                last_seen = current
+                self.event.set()
+
+    def _safe_probe(self):
+        try:
+            return self._probe()
+        except Exception as e:
+            _logger.warning("Data version probe failed: %s", str(e))
+            return None
@@ -0,0 +1,234 @@
+"""
+api/group_commit.py
+
+Write-behind queue with group commit for the ingest API.
+
+Request threads validate a payload, hand it to GroupCommitWriter.submit() and
+return straight away. A single writer thread drains the queue and commits
+everything waiting in one transaction, so the per-transaction cost (BEGIN,
+journal sync, COMMIT) is paid once per group instead of once per snapshot,
+and request threads never hold the SQLite write lock.
+
+A group is closed as soon as either limit is reached:
+    max_batch   — number of submitted items in the group
+    max_delay   — seconds since the first item of the group was taken
+
+                request threads
+                    │  submit() — returns a PendingWrite immediately
+                    ▼
+          ┌───────────────────┐
+          │ GroupCommitWriter │  ← bounded in-memory queue
+          └─────────┬─────────┘
+                    │  writer thread: one transaction per group
+                    ▼
+                   DB
+
+Callers that need durability wait on the returned PendingWrite, which is
+resolved once the group containing it has committed (or failed).
+
+Usage:
+    writer = GroupCommitWriter(commit_batch=store_fn, max_batch=200, max_delay=0.05)
+    writer.start()
+    pending = writer.submit([record])
+    pending.wait(timeout=10)   # optional — only for durable writes
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH  = 200     # items per group commit
+DEFAULT_MAX_DELAY  = 0.05    # seconds — how long a group stays open
+DEFAULT_MAX_QUEUE  = 10_000  # items waiting before submit() refuses more
+
+# Seconds to keep draining the queue on shutdown before giving up
+_SHUTDOWN_TIMEOUT = 10
+
+_STOP = object()  # sentinel that wakes the writer thread on shutdown
+
+
+class QueueFullError(Exception):
+    """Raised by submit() when the write queue is at capacity."""
+
+
+class PendingWrite:
+    """Handle for one submitted item, resolved by the writer thread."""
+
+    def __init__(self, items: list):
+        self.items  = items
+        self.error: Exception | None = None
+        self._done  = threading.Event()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until the item has been committed or has failed.
+
+        Returns:
+            True if the item was resolved within timeout, False otherwise.
+            Check .error afterwards to see whether the commit succeeded.
+        """
+        return self._done.wait(timeout)
+
+    def _resolve(self, error: Exception | None = None):
+        self.error = error
+        self._done.set()
+
+
+class GroupCommitWriter:
+    """
+    Buffers submitted items in memory and commits them in groups from a
+    dedicated writer thread.
+
+    Args:
+        commit_batch: Callable that stores a flat list of items in a single
+                      transaction, raising on failure.
+        max_batch:    Maximum number of submitted items per group.
+        max_delay:    Maximum seconds a group stays open after its first item.
+        max_queue:    Maximum number of submitted items waiting to be written.
+    """
+
+    def __init__(self, commit_batch: Callable[[list], None],
+                 max_batch: int   = DEFAULT_MAX_BATCH,
+                 max_delay: float = DEFAULT_MAX_DELAY,
+                 max_queue: int   = DEFAULT_MAX_QUEUE):
+        self._commit_batch = commit_batch
+        self._max_batch    = max_batch
+        self._max_delay    = max_delay
+        self._queue        = queue.Queue(maxsize=max_queue)
+        self._thread       = threading.Thread(
+            target=self._writer_loop,
+            name="GroupCommitWriter",
+            daemon=True
+        )
+        self._state_lock = threading.Lock()
+        self._started    = False
+        self._running    = False
+
+    def start(self):
+        """Start the writer thread. Safe to call more than once; pending
+        writes are flushed at interpreter exit."""
+        with self._state_lock:
+            if self._started:
+                return
+            self._started = True
+            self._running = True
+            self._thread.start()
+        atexit.register(self.stop)
+        _logger.info("GroupCommitWriter started (max_batch=%d, max_delay=%.0fms)",
+                     self._max_batch, self._max_delay * 1000)
+
+    def stop(self):
+        """Stop accepting writes, flush everything already queued and wait
+        for the writer thread to finish."""
+        with self._state_lock:
+            if not self._running:
+                return
+            self._running = False
+        self._queue.put(_STOP)
+        self._thread.join(timeout=_SHUTDOWN_TIMEOUT)
+        _logger.info("GroupCommitWriter stopped")
+
+    def submit(self, items: list) -> PendingWrite:
+        """Queue items to be written in the next group.
+
+        Non-blocking. Starts the writer thread on first use. The items of one
+        call are always committed in the same transaction.
+
+        Args:
+            items: Items to pass to commit_batch, e.g. AggregatorRecords
+
+        Returns:
+            A PendingWrite that resolves when the items have been committed.
+
+        Raises:
+            QueueFullError: If the queue is at capacity or the writer has
+                            been stopped — the caller should ask the client
+                            to retry later.
+        """
+        if not self._started:
+            self.start()
+        if not self._running:
+            raise QueueFullError("Write queue has been stopped")
+        pending = PendingWrite(items)
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            raise QueueFullError(f"Write queue full ({self._queue.maxsize} items)")
+        return pending
+
+    def qsize(self) -> int:
+        """Return the approximate number of submitted items not yet written."""
+        return self._queue.qsize()
+
+    def _writer_loop(self):
+        """Writer thread — collect a group, commit it, resolve its waiters.
+
+        Blocks for the first item of a group, then keeps taking items until
+        max_batch is reached or max_delay has passed since the first one.
+        """
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+
+            group    = [first]
+            deadline = time.monotonic() + self._max_delay
+            while len(group) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    # Drain what is left so nothing accepted is lost on shutdown
+                    stopping = True
+                    break
+                group.append(item)
+
+            self._commit_group(group)
+
+        # Flush anything still queued behind the stop sentinel
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        for start in range(0, len(leftover), self._max_batch):
+            self._commit_group(leftover[start:start + self._max_batch])
+
+    def _commit_group(self, group: list[PendingWrite]):
+        """Commit a group in one transaction and resolve every waiter.
+
+        If the group transaction fails, each submitted item is retried in its
+        own transaction so one bad payload cannot take the rest of the group
+        down with it.
+        """
+        try:
+            self._commit_batch([item for pending in group for item in pending.items])
+            for pending in group:
+                pending._resolve()
+            _logger.debug("Group commit of %d write(s) succeeded", len(group))
+            return
+        except Exception as e:
+            if len(group) == 1:
+                _logger.exception("Write-behind commit failed: %s", str(e))
+                group[0]._resolve(e)
+                return
+            _logger.warning("Group commit of %d write(s) failed (%s) — retrying individually",
+                            len(group), str(e))
+
+        for pending in group:
+            try:
+                self._commit_batch(pending.items)
+                pending._resolve()
+            except Exception as e:
+                _logger.exception("Write-behind commit failed: %s", str(e))
+                pending._resolve(e)
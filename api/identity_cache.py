@@ -0,0 +1,245 @@
+"""
+api/identity_cache.py
+
+Bounded in-process cache of the surrogate IDs the ingest path needs before it
+can insert a snapshot:
+
+    guid                        → aggregator_id
+    (aggregator_id, device name) → device_id
+    (device_id, metric name)     → device_metric_type_id
+    (device_id, packed type ids) → layout_id   (packed value layout only)
+
+These rows are created once and never change, so once an ID has been
+committed it can be served from memory forever (until evicted). Lookups are
+O(1) dict hits; a miss falls back to the database, and all missing metric
+types for a device are fetched with one SELECT and created with one INSERT.
+
+IDs created inside a transaction are staged in a PendingIdentities object and
+only published to the shared cache after the caller commits, so a rolled-back
+transaction can never leave a dangling ID behind.
+
+Usage:
+    cache   = IdentityCache(max_entries=100_000)
+    pending = PendingIdentities()
+    agg_id  = cache.resolve_aggregator(session, pending, guid, name)
+    dev_id  = cache.resolve_device(session, pending, agg_id, "gen9ou")
+    types   = cache.resolve_metric_types(session, pending, dev_id, names)
+    session.commit()
+    cache.publish(pending)
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from models import Aggregator, Device, DeviceMetricType, MetricLayout
+
+_logger = logging.getLogger(__name__)
+
+# Default bound on the number of cached IDs across all key kinds.
+# One entry is a small tuple key plus an int, so 100k entries is a few MB.
+DEFAULT_MAX_ENTRIES = 100_000
+
+# SQLite limits the number of bound parameters per statement; stay well under
+# it when building IN (...) lists for large PokemonInfo snapshots.
+_IN_CHUNK_SIZE = 500
+
+
+class PendingIdentities:
+    """IDs created in the current (uncommitted) transaction.
+
+    Consulted before the shared cache so later snapshots in the same batch
+    reuse rows created earlier in it. Published via IdentityCache.publish()
+    once the transaction commits; simply discarded on rollback.
+    """
+
+    def __init__(self):
+        self.entries: dict[tuple, int] = {}
+
+
+class IdentityCache:
+    """Thread-safe LRU map of identity keys to database IDs.
+
+    Correctness with several ingest workers relies on two things: only
+    committed IDs are ever published, and callers serialise their write
+    transactions (IngestAPI holds a write lock around each one, which costs
+    nothing because SQLite only allows one writer at a time anyway). A race
+    between separate processes surfaces as an IntegrityError once the unique
+    indexes exist, and the agent simply retries the upload.
+
+    Args:
+        max_entries: Maximum number of IDs held before the least recently
+                     used are evicted.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[tuple, int] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits   = 0
+        self.misses = 0
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Resolution (cache first, then database, then create)
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def resolve_aggregator(self, session: Session, pending: PendingIdentities,
+                           guid: str, name: str) -> int:
+        """Return the aggregator_id for guid, creating the row on first sight."""
+        key = ('aggregator', guid)
+        cached = self._lookup(pending, key)
+        if cached is not None:
+            return cached
+
+        aggregator_id = session.execute(
+            select(Aggregator.aggregator_id).where(Aggregator.guid == guid)
+        ).scalar()
+        if aggregator_id is None:
+            aggregator_id = session.execute(
+                insert(Aggregator).values(guid=guid, name=name)
+                .returning(Aggregator.aggregator_id)
+            ).scalar_one()
+            pending.entries[key] = aggregator_id
+        else:
+            self._store(key, aggregator_id)
+        return aggregator_id
+
+    def resolve_device(self, session: Session, pending: PendingIdentities,
+                       aggregator_id: int, name: str) -> int:
+        """Return the device_id for (aggregator_id, name), creating the row on
+        first sight with the next ordinal for that aggregator."""
+        key = ('device', aggregator_id, name)
+        cached = self._lookup(pending, key)
+        if cached is not None:
+            return cached
+
+        device_id = session.execute(
+            select(Device.device_id).where(
+                Device.aggregator_id == aggregator_id,
+                Device.name == name
+            )
+        ).scalar()
+        if device_id is None:
+            ordinal = session.execute(
+                select(func.count()).select_from(Device)
+                .where(Device.aggregator_id == aggregator_id)
+            ).scalar_one()
+            device_id = session.execute(
+                insert(Device).values(aggregator_id=aggregator_id, name=name, ordinal=ordinal)
+                .returning(Device.device_id)
+            ).scalar_one()
+            pending.entries[key] = device_id
+        else:
+            self._store(key, device_id)
+        return device_id
+
+    def resolve_metric_types(self, session: Session, pending: PendingIdentities,
+                             device_id: int, names) -> dict[str, int]:
+        """Return {name: device_metric_type_id} for every name on device_id.
+
+        Names not in memory are fetched with one SELECT per chunk of names,
+        and any still missing are created with a single multi-row INSERT.
+        """
+        result  = {}
+        missing = []
+        for name in dict.fromkeys(names):
+            cached = self._lookup(pending, ('metric_type', device_id, name))
+            if cached is None:
+                missing.append(name)
+            else:
+                result[name] = cached
+
+        if not missing:
+            return result
+
+        for start in range(0, len(missing), _IN_CHUNK_SIZE):
+            chunk = missing[start:start + _IN_CHUNK_SIZE]
+            rows  = session.execute(
+                select(DeviceMetricType.name, DeviceMetricType.device_metric_type_id).where(
+                    DeviceMetricType.device_id == device_id,
+                    DeviceMetricType.name.in_(chunk)
+                )
+            ).all()
+            for name, type_id in rows:
+                result[name] = type_id
+                self._store(('metric_type', device_id, name), type_id)
+
+        to_create = [name for name in missing if name not in result]
+        if to_create:
+            created = session.execute(
+                insert(DeviceMetricType).returning(
+                    DeviceMetricType.name, DeviceMetricType.device_metric_type_id
+                ),
+                [{'device_id': device_id, 'name': name} for name in to_create]
+            ).all()
+            for name, type_id in created:
+                result[name] = type_id
+                pending.entries[('metric_type', device_id, name)] = type_id
+            _logger.debug("Created %d metric type(s) for device %d", len(to_create), device_id)
+
+        return result
+
+    def resolve_layout(self, session: Session, pending: PendingIdentities,
+                       device_id: int, type_ids: bytes) -> int:
+        """Return the layout_id for a device's packed metric type ids (see
+        packed_values.py), creating the metric_layouts row on first sight."""
+        key = ('layout', device_id, type_ids)
+        cached = self._lookup(pending, key)
+        if cached is not None:
+            return cached
+
+        layout_id = session.execute(
+            select(MetricLayout.layout_id).where(
+                MetricLayout.device_id == device_id,
+                MetricLayout.type_ids == type_ids
+            )
+        ).scalar()
+        if layout_id is None:
+            layout_id = session.execute(
+                insert(MetricLayout).values(device_id=device_id, type_ids=type_ids)
+                .returning(MetricLayout.layout_id)
+            ).scalar_one()
+            pending.entries[key] = layout_id
+        else:
+            self._store(key, layout_id)
+        return layout_id
+
+    def publish(self, pending: PendingIdentities):
+        """Make IDs created by a committed transaction visible to all workers.
+
+        Must only be called after the transaction that created them commits.
+        """
+        for key, value in pending.entries.items():
+            self._store(key, value)
+        pending.entries.clear()
+
+    def clear(self):
+        """Drop every cached ID, e.g. after rows were deleted out of band."""
+        with self._lock:
+            self._entries.clear()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # LRU internals
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _lookup(self, pending: PendingIdentities, key: tuple) -> int | None:
+        value = pending.entries.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _store(self, key: tuple, value: int):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
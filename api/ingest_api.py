@@ -4,33 +4,80 @@ api/ingest_api.py
 Write-only API server. Receives snapshots from agents and persists them to
 the database. Has no read endpoints — that is read_api.py's responsibility.
 
+Snapshots are written either synchronously inside the request (default) or,
+when ingest_api.write_behind.enabled is set in config.json, queued in memory
+and committed in groups by a dedicated writer thread (see group_commit.py).
+In write-behind mode a request returns 202 as soon as the payload is
+validated and queued; pass ?durable=true to wait for the commit and get 201.
+
+Request bodies may be compressed (Content-Encoding: gzip, or zstd when the
+zstandard package is installed; see compression.py). A body in any other
+encoding gets a 415 whose Accept-Encoding header lists what is supported.
+
+Snapshots may also be sent in a compact binary format instead of JSON, with
+Content-Type: application/x-metrics-snapshot (see metrics_codec.py).
+
 After every successful snapshot write, signals the read API that new data is
 available via one of two mechanisms depending on how the server is started:
 
   - When started via 'python server.py both': fires a shared threading.Event
     that the read API's SSE generator is waiting on — push is instant.
 
-  - When started standalone via 'python server.py ingest': falls back to
-    updating SystemState in the database, which the read API polls instead.
+  - When started standalone via 'python server.py ingest': sends a datagram
+    to every read API process through a ChangeNotifier (see
+    change_notify.py); those that miss it notice the commit through SQLite's
+    data version instead.
 
 Endpoints:
-    POST /aggregator_snapshots  — receive and store a DTO_Aggregator snapshot
+    POST /aggregator_snapshots       — receive and store a DTO_Aggregator snapshot
+    POST /aggregator_snapshots/bulk  — receive a JSON array of DTO_Aggregator
+                                       snapshots and store them in one transaction
+    GET  /maintenance_stats          — retention and vacuum counters (see
+                                       retention.py)
+
+The process that writes the database also runs the retention maintenance
+thread when ingest_api.retention.enabled is set.
 """
 
 import sys
+import json
+import socket
 import logging
 import threading
+from typing import Callable
 from pathlib import Path
 from datetime import datetime, timezone
-from sqlalchemy import create_engine
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from flask import Flask, request
+from werkzeug.serving import make_server
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from config import Config
-from collectors.metrics_datamodel import DTO_Aggregator
-from models import Aggregator, Device, DeviceMetricType, MetricSnapshot, MetricValue, SystemState
+from database import create_db_engine
+from partitions import partition_store
+from migrations import upgrade
+from compression import ENCODINGS, ContentEncodingError, UnsupportedEncodingError, BodyTooLargeError, decompress
+from collectors.metrics_codec import (
+    AggregatorRecord, SnapshotFormatError, BINARY_CONTENT_TYPE, decode_aggregator, decode_aggregators_binary
+)
+from models import MetricSnapshot, MetricValue, PackedMetricValues, SystemState
+from api import materialized
+from api.materialized import WrittenSnapshot
+from api.packed_values import LAYOUT_CHUNKED, LAYOUT_PACKED, LAYOUT_ROWS, LAYOUTS, pack_type_ids, pack_values
+from api.series_chunks import DEFAULT_CHUNK_SECS, Sample, append_samples, shared_epochs
+from api.identity_cache import IdentityCache, PendingIdentities, DEFAULT_MAX_ENTRIES
+from api.group_commit import (
+    GroupCommitWriter, QueueFullError, DEFAULT_MAX_BATCH, DEFAULT_MAX_DELAY, DEFAULT_MAX_QUEUE
+)
+from api.change_notify import ChangeNotifier, default_notify_dir
+from api.writer_channel import WriterClient
+from api.retention import RetentionTask
+
+# How long a ?durable=true request waits for its group to commit before
+# giving up. The snapshot stays queued and is still written afterwards.
+DURABLE_WAIT_TIMEOUT = 30  # seconds
 
 
 class IngestAPI:
@@ -38,8 +85,34 @@ class IngestAPI:
         self.config        = Config(__file__)
         self.logger        = logging.getLogger(__name__)
         self.webserver     = Flask(__name__)
-        self.engine        = create_engine(self.config.database.connection_string)
+        self.engine        = create_db_engine(self.config, immediate_writes=True)
+        self._partitions   = partition_store(self.config)
         self._update_event: threading.Event | None = None
+        self._update_listeners: list[Callable[[set[tuple[str, str]] | None], None]] = []
+        # Wakes ReadAPI processes running standalone (python server.py read)
+        self._change_notifier = ChangeNotifier(default_notify_dir(self.config))
+        self._identity_cache = IdentityCache(
+            getattr(self.config.ingest_api, 'identity_cache_size', DEFAULT_MAX_ENTRIES)
+        )
+        # 'rows' writes one metric_values row per metric, 'packed' one
+        # packed_metric_values row per snapshot (see packed_values.py) and
+        # 'chunked' appends to per-metric time-series chunks (see
+        # series_chunks.py); aggregator_value_layouts overrides it by
+        # aggregator name
+        self._value_layout = getattr(self.config.ingest_api, 'value_layout', LAYOUT_ROWS)
+        overrides          = getattr(self.config.ingest_api, 'aggregator_value_layouts', None)
+        self._aggregator_layouts: dict[str, str] = dict(vars(overrides)) if overrides is not None else {}
+        for layout in (self._value_layout, *self._aggregator_layouts.values()):
+            if layout not in LAYOUTS:
+                raise ValueError(f"ingest_api value layouts must be one of {list(LAYOUTS)}, got {layout!r}")
+        self._chunk_secs = int(getattr(self.config.ingest_api, 'chunk_secs', DEFAULT_CHUNK_SECS))
+        # SQLite allows a single writer at a time, so serialising write
+        # transactions in-process costs nothing and keeps find-or-create of
+        # identity rows race-free across request threads.
+        self._write_lock = threading.Lock()
+        self._writer: GroupCommitWriter | None = self._create_writer()
+        self._remote_writer: WriterClient | None = None
+        self._retention: RetentionTask | None = self._create_retention()
         self._setup_routes()
         self.logger.debug("IngestAPI initialized")
 
@@ -58,8 +131,88 @@ class IngestAPI:
         self._update_event = event
         self.logger.debug("IngestAPI: shared update event registered")
 
+    def add_update_listener(self, listener: Callable[[set[tuple[str, str]] | None], None]):
+        """Register a callback run after every successful commit.
+
+        The callback receives the set of (aggregator guid, device name) pairs
+        that got new snapshots, so in-process consumers such as ReadAPI's
+        response cache can react to exactly what changed, or None after
+        retention has deleted data, which may affect anything. It runs on the
+        committing thread; exceptions are logged and otherwise ignored.
+
+        Args:
+            listener: Callable taking the set of changed (guid, device) pairs
+        """
+        self._update_listeners.append(listener)
+
+    def use_remote_writer(self, client: WriterClient):
+        """Send every write to the designated writer process instead of
+        writing here. Called in server.py serve's ingest workers.
+
+        Args:
+            client: Connected to the writer's WriterServer
+        """
+        self._remote_writer = client
+        self.logger.debug("IngestAPI: writes forwarded to the designated writer")
+
+    def _create_writer(self) -> GroupCommitWriter | None:
+        """Build the group-commit writer if write-behind mode is enabled in
+        config.json, otherwise return None so requests write synchronously.
+
+        The writer thread starts on the first submitted write so that simply
+        importing this module does not spawn threads.
+        """
+        settings = getattr(self.config.ingest_api, 'write_behind', None)
+        if settings is None or not getattr(settings, 'enabled', False):
+            return None
+        return GroupCommitWriter(
+            commit_batch=self._store_and_signal,
+            max_batch=getattr(settings, 'max_batch', DEFAULT_MAX_BATCH),
+            max_delay=getattr(settings, 'max_delay_ms', DEFAULT_MAX_DELAY * 1000) / 1000,
+            max_queue=getattr(settings, 'max_queue', DEFAULT_MAX_QUEUE),
+        )
+
+    def _create_retention(self) -> RetentionTask | None:
+        """Build the retention task if ingest_api.retention is enabled in
+        config.json. It only starts with start_maintenance(), so worker
+        processes that forward their writes never run it."""
+        settings = getattr(self.config.ingest_api, 'retention', None)
+        if settings is None or not getattr(settings, 'enabled', False):
+            return None
+        return RetentionTask(self.engine, self._write_lock, settings,
+                             on_deleted=self._publish_deletions, partitions=self._partitions)
+
+    def start_maintenance(self):
+        """Start the retention thread, if enabled. Called by run() and by the
+        designated writer in server.py serve."""
+        if self._retention is not None:
+            self._retention.start()
+
+    def maintenance_stats(self) -> dict:
+        """Retention counters of this process, see RetentionTask.stats()."""
+        if self._retention is None:
+            return {'enabled': False}
+        return self._retention.stats()
+
     def _setup_routes(self):
-        self.webserver.route("/aggregator_snapshots", methods=['POST'])(self.upload_snapshot)
+        self.webserver.route("/aggregator_snapshots",      methods=['POST'])(self.upload_snapshot)
+        self.webserver.route("/aggregator_snapshots/bulk", methods=['POST'])(self.upload_snapshots_bulk)
+        self.webserver.route("/maintenance_stats",         methods=['GET'])(self.get_maintenance_stats)
+
+    def get_maintenance_stats(self):
+        """Return rows deleted, time spent and lock wait of retention
+        maintenance, from the designated writer when there is one.
+        GET /maintenance_stats
+        """
+        try:
+            if self._remote_writer is not None:
+                stats = self._remote_writer.maintenance_stats()
+            else:
+                stats = self.maintenance_stats()
+        except Exception as e:
+            self.logger.exception("Error reading maintenance stats: %s", str(e))
+            return {'status': 'error', 'message': str(e)}, 500
+        return {'status': 'success', 'retention': stats}, 200
 
     def upload_snapshot(self):
         """Receive a DTO_Aggregator JSON snapshot from an agent and write it to
@@ -68,126 +221,451 @@ class IngestAPI:
 
         After a successful commit, signals the read API via threading.Event
         (if available) or by updating SystemState in the database.
+
+        The body, JSON or binary (see metrics_codec), is validated and decoded
+        straight into records; a snapshot that does not match the schema gets
+        a 400.
         """
-        session = None
         try:
-            self.logger.info("Deserializing incoming snapshot")
-            data           = request.get_json()
-            dto_aggregator = DTO_Aggregator.from_dict(data)
-            self.logger.info("Snapshot deserialized: %s", dto_aggregator)
-
-            session = Session(self.engine)
+            record = self._request_records(bulk=False)[0]
+            self.logger.info("Snapshot decoded: %s (%s), %d device(s)",
+                             record.name, record.guid, len(record.devices))
 
-            # Find or create aggregator
-            aggregator = session.query(Aggregator).filter_by(
-                guid=str(dto_aggregator.guid)
-            ).first()
-            if not aggregator:
-                aggregator = Aggregator(
-                    guid=str(dto_aggregator.guid),
-                    name=dto_aggregator.name
-                )
-                session.add(aggregator)
-                session.flush()
-
-            for dto_device in dto_aggregator.devices:
-                device = session.query(Device).filter_by(
-                    aggregator_id=aggregator.aggregator_id,
-                    name=dto_device.name
-                ).first()
-
-                if not device:
-                    max_ordinal = session.query(Device).filter_by(
-                        aggregator_id=aggregator.aggregator_id
-                    ).count()
-                    device = Device(
-                        aggregator_id=aggregator.aggregator_id,
-                        name=dto_device.name,
-                        ordinal=max_ordinal
-                    )
-                    session.add(device)
-                    session.flush()
-
-                now_utc = datetime.now(timezone.utc)
-                for dto_snapshot in dto_device.data_snapshots:
-                    snapshot = MetricSnapshot(
-                        device_id=device.device_id,
-                        client_utc_timestamp_epoch=int(dto_snapshot.timestamp_utc.timestamp()),
-                        client_timezone_mins=dto_snapshot.timezone_mins,
-                        server_utc_timestamp_epoch=int(now_utc.timestamp()),
-                        server_timezone_mins=int(
-                            now_utc.astimezone().utcoffset().total_seconds() / 60
-                        )
-                    )
-                    session.add(snapshot)
-                    session.flush()
-
-                    for dto_metric in dto_snapshot.metrics:
-                        metric_type = session.query(DeviceMetricType).filter_by(
-                            device_id=device.device_id,
-                            name=dto_metric.name
-                        ).first()
-                        if not metric_type:
-                            metric_type = DeviceMetricType(
-                                device_id=device.device_id,
-                                name=dto_metric.name
-                            )
-                            session.add(metric_type)
-                            session.flush()
-
-                        session.add(MetricValue(
-                            metric_snapshot_id=snapshot.metric_snapshot_id,
-                            device_metric_type_id=metric_type.device_metric_type_id,
-                            value=float(dto_metric.value)
-                        ))
-
-            # Always update SystemState so standalone read_api can poll it
-            self._update_system_state(session)
-
-            session.commit()
-            self.logger.info("Snapshot stored successfully")
-
-            # Signal the read API. If a shared Event is available (both APIs
-            # running in the same process) this fires instantly. Otherwise the
-            # read API falls back to polling SystemState which was updated above.
-            self._signal_update()
-
-            return {'status': 'success', 'message': 'Snapshot stored successfully'}, 201
+            return self._write([record], 'Snapshot stored successfully')
 
+        except (SnapshotFormatError, ContentEncodingError) as e:
+            self.logger.warning("Rejecting malformed snapshot: %s", str(e))
+            return self._bad_request(e)
         except Exception as e:
-            if session:
-                try:
-                    session.rollback()
-                    session.close()
-                except Exception:
-                    pass
             self.logger.exception("Error storing snapshot: %s", str(e))
             return {'status': 'error', 'message': str(e)}, 500
-        finally:
-            if session:
+
+    def upload_snapshots_bulk(self):
+        """Receive a JSON array of DTO_Aggregator snapshots, or a run of binary
+        messages, and write them all in a single transaction. Used by UploaderQueue to amortise the
+        per-request and per-commit overhead across several snapshots.
+
+        The batch is all-or-nothing: if any snapshot fails to store, the whole
+        transaction is rolled back and the agent retries the batch.
+        """
+        try:
+            records = self._request_records(bulk=True)
+            self.logger.info("Bulk request decoded: %d snapshot(s)", len(records))
+
+            body, status = self._write(records, f'{len(records)} snapshot(s) stored successfully')
+            if status == 201:
+                body['stored'] = len(records)
+            elif status == 202:
+                body['queued'] = len(records)
+            return body, status
+
+        except (SnapshotFormatError, ContentEncodingError) as e:
+            self.logger.warning("Rejecting malformed bulk request: %s", str(e))
+            return self._bad_request(e)
+        except Exception as e:
+            self.logger.exception("Error storing bulk snapshots: %s", str(e))
+            return {'status': 'error', 'message': str(e)}, 500
+
+    @staticmethod
+    def _request_records(bulk: bool) -> list[AggregatorRecord]:
+        """Decode the request body into records, whichever wire format it uses.
+
+        A body sent as BINARY_CONTENT_TYPE is in metrics_codec's binary
+        format; anything else is parsed as JSON: one DTO_Aggregator object,
+        or an array of them for a bulk request. Any Content-Encoding is
+        undone first.
+
+        Args:
+            bulk: Accept any number of snapshots rather than exactly one
+
+        Raises:
+            ContentEncodingError: If the body cannot be decompressed.
+            SnapshotFormatError:  If it is not a valid snapshot (or array).
+        """
+        body = decompress(request.get_data(cache=False), request.headers.get('Content-Encoding'))
+
+        if request.mimetype == BINARY_CONTENT_TYPE:
+            records = decode_aggregators_binary(body)
+            if not bulk and len(records) != 1:
+                raise SnapshotFormatError(f'Expected one snapshot, got {len(records)}')
+            return records
+
+        try:
+            data = json.loads(body)
+        except ValueError as e:   # JSONDecodeError, or undecodable UTF-8
+            raise SnapshotFormatError(f'Request body is not valid JSON: {e}') from None
+        if not bulk:
+            return [decode_aggregator(data)]
+        if not isinstance(data, list):
+            raise SnapshotFormatError('Expected a JSON array of snapshots')
+
+        records = []
+        for index, item in enumerate(data):
+            try:
+                records.append(decode_aggregator(item))
+            except SnapshotFormatError as e:
+                raise SnapshotFormatError(f'snapshot {index}: {e}') from None
+        return records
+
+    @staticmethod
+    def _bad_request(e: ValueError) -> tuple[dict, int] | tuple[dict, int, dict]:
+        """Build the error response for a request body that could not be used."""
+        body = {'status': 'error', 'message': str(e)}
+        if isinstance(e, UnsupportedEncodingError):
+            # Tells the agent which encodings to fall back to (RFC 7694)
+            return body, 415, {'Accept-Encoding': ', '.join(ENCODINGS)}
+        if isinstance(e, BodyTooLargeError):
+            return body, 413
+        return body, 400
+
+    def _write(self, records: list[AggregatorRecord], message: str) -> tuple[dict, int]:
+        """Store validated snapshots, here or through the designated writer
+        process (server.py serve), and build the response.
+
+        Args:
+            records: Decoded snapshots to store
+            message: Success message for the response body
+
+        Raises:
+            Exception: Anything raised while committing a synchronous or
+                       durable write.
+        """
+        durable = request.args.get('durable', '').lower() in ('1', 'true', 'yes')
+        if self._remote_writer is not None:
+            status, error = self._remote_writer.write(records, durable)
+        else:
+            status, error = self.write_snapshots(records, durable)
+
+        if status == 201:
+            self.logger.info("%d snapshot(s) stored successfully", len(records))
+            return {'status': 'success', 'message': message}, 201
+        if status == 202:
+            self.logger.info("%d snapshot(s) queued for group commit", len(records))
+            return {'status': 'accepted', 'message': f'{len(records)} snapshot(s) queued'}, 202
+        return {'status': 'error', 'message': error}, status
+
+    def write_snapshots(self, records: list[AggregatorRecord], durable: bool) -> tuple[int, str | None]:
+        """Store snapshots using the configured write mode.
+
+        Synchronous mode commits straight away (201). Write-behind mode
+        queues the snapshots for the writer thread (202), unless durable is
+        set, in which case it waits for their group to commit (201, or 504 if
+        that takes too long). A full queue gives 503 so the agent backs off
+        and retries.
+
+        Args:
+            records: Decoded snapshots to store
+            durable: Wait for a write-behind commit before returning
+
+        Returns:
+            (HTTP status, error message or None)
+
+        Raises:
+            Exception: Anything raised while committing a synchronous or
+                       durable write.
+        """
+        if self._writer is None:
+            self._store_and_signal(records)
+            return 201, None
+
+        try:
+            pending = self._writer.submit(records)
+        except QueueFullError as e:
+            self.logger.warning("Rejecting %d snapshot(s): %s", len(records), str(e))
+            return 503, str(e)
+
+        if not durable:
+            return 202, None
+        if not pending.wait(DURABLE_WAIT_TIMEOUT):
+            return 504, 'Timed out waiting for commit; snapshot is still queued'
+        if pending.error is not None:
+            raise pending.error
+        return 201, None
+
+    def _store_and_signal(self, records: list[AggregatorRecord]):
+        """Write a batch of snapshots in one transaction, update SystemState in
+        the same transaction, then signal the read API once the commit has
+        succeeded.
+
+        Identity rows created by the transaction are published to the
+        identity cache only after the commit, so a rollback leaves the cache
+        untouched.
+
+        Args:
+            records: Decoded snapshots to store
+
+        Raises:
+            Exception: Anything raised while writing. The transaction is rolled
+                       back before the exception propagates.
+        """
+        pending = PendingIdentities()
+        with self._write_lock, self._write_session(records) as session:
+            try:
+                self._store_snapshots(session, pending, records)
+
+                # Always update SystemState so standalone read_api can poll it
+                self._update_system_state(session)
+
+                session.commit()
+                self._identity_cache.publish(pending)
+            except Exception:
+                session.rollback()
+                raise
+
+        # Signal the read API. If a shared Event is available (both APIs
+        # running in the same process) this fires instantly. Otherwise the
+        # read API falls back to polling SystemState which was updated above.
+        self._signal_update({
+            (record.guid, device.name)
+            for record in records
+            for device in record.devices
+        })
+
+    def _write_session(self, records: list[AggregatorRecord]):
+        """Session for a write transaction. With partitioned storage, the
+        partitions the records' snapshots belong to are created if needed
+        and attached before the transaction starts."""
+        if self._partitions is None:
+            return Session(self.engine)
+        keys = {
+            self._partitions.key_for(snapshot.epoch)
+            for record in records
+            for device in record.devices
+            for snapshot in device.snapshots
+        }
+        return self._partitions.session(self.engine, keys, create=True)
+
+    def _store_snapshots(self, session: Session, pending: PendingIdentities,
+                         records: list[AggregatorRecord]):
+        """Add a batch of snapshots to the session without committing.
+
+        Aggregator, device and metric type IDs come from the identity cache,
+        which only touches the database for names it has not seen before.
+        Snapshot rows are then written with one multi-row INSERT ... RETURNING
+        and all metric values with one executemany INSERT, rather than one
+        flush per snapshot and one INSERT per value. In the packed value
+        layout that INSERT writes one packed_metric_values row per snapshot
+        instead of one metric_values row per metric; in the chunked layout
+        the values are appended to metric_chunks instead. With partitioned
+        storage each snapshot and its values go to the partition of its
+        timestamp (see _store_partitioned). Finally the derived tables in
+        materialized.py (rollups, totals, latest values) are updated for the batch.
+
+        Args:
+            session: The active SQLAlchemy session
+            pending: Collects identity rows created by this transaction
+            records: Decoded snapshots to store
+        """
+        cache           = self._identity_cache
+        now_utc         = datetime.now(timezone.utc)
+        server_epoch    = int(now_utc.timestamp())
+        server_tz_mins  = int(now_utc.astimezone().utcoffset().total_seconds() / 60)
+        snapshot_rows   = []
+        snapshot_values = []   # one list of (device_metric_type_id, value) per snapshot row
+        snapshot_names  = []   # the matching metric names
+        snapshot_layout = []   # the value layout each snapshot is stored in
+
+        for record in records:
+            aggregator_id = cache.resolve_aggregator(session, pending, record.guid, record.name)
+            layout        = self._aggregator_layouts.get(record.name, self._value_layout)
+
+            for device in record.devices:
+                device_id = cache.resolve_device(session, pending, aggregator_id, device.name)
+
+                for snapshot in device.snapshots:
+                    metric_types = cache.resolve_metric_types(session, pending, device_id, snapshot.names)
+                    snapshot_rows.append({
+                        'device_id':                  device_id,
+                        'client_utc_timestamp_epoch': snapshot.epoch,
+                        'client_timezone_mins':       snapshot.timezone_mins,
+                        'server_utc_timestamp_epoch': server_epoch,
+                        'server_timezone_mins':       server_tz_mins,
+                    })
+                    # Values were already converted to float by the codec
+                    snapshot_values.append([
+                        (metric_types[name], value) for name, value in zip(snapshot.names, snapshot.values)
+                    ])
+                    snapshot_names.append(snapshot.names)
+                    snapshot_layout.append(layout)
+
+        if not snapshot_rows:
+            return
+
+        if self._partitions is not None:
+            snapshot_ids = self._store_partitioned(session, pending, snapshot_rows, snapshot_values, snapshot_layout)
+        else:
+            # SQLite assigns INTEGER PRIMARY KEY values in increasing order as
+            # the rows of a multi-row INSERT are written, so sorting the
+            # RETURNING ids lines them back up with snapshot_rows. Asking
+            # SQLAlchemy for sort_by_parameter_order instead degrades to one
+            # INSERT per row.
+            snapshot_ids = sorted(session.execute(
+                insert(MetricSnapshot).returning(MetricSnapshot.metric_snapshot_id),
+                snapshot_rows
+            ).scalars().all())
+            self._store_values(session, pending, list(zip(snapshot_ids, snapshot_rows, snapshot_values, snapshot_layout)))
+
+        # Keep rollups and other derived tables in step, in this transaction
+        materialized.update_all(session, [
+            WrittenSnapshot(snapshot_id, row['device_id'], row['client_utc_timestamp_epoch'], values, names)
+            for snapshot_id, row, values, names in zip(snapshot_ids, snapshot_rows, snapshot_values, snapshot_names)
+        ])
+
+    def _store_partitioned(self, session: Session, pending: PendingIdentities, snapshot_rows: list[dict],
+                           snapshot_values: list[list[tuple[int, float]]], snapshot_layout: list[str]) -> list[int]:
+        """Write snapshots and their values to the partitions of their
+        timestamps, one partition at a time.
+
+        Ids are allocated here rather than by each file's INTEGER PRIMARY KEY
+        so they stay unique and in commit order across partitions.
+
+        Returns:
+            The id given to each snapshot row, in order.
+        """
+        first_id     = self._partitions.allocate_ids(session, len(snapshot_rows))
+        snapshot_ids = list(range(first_id, first_id + len(snapshot_rows)))
+        by_key       = {}
+        for index, row in enumerate(snapshot_rows):
+            by_key.setdefault(self._partitions.key_for(row['client_utc_timestamp_epoch']), []).append(index)
+
+        for key, indexes in by_key.items():
+            self._partitions.use(session, key)
+            session.execute(insert(MetricSnapshot), [
+                {'metric_snapshot_id': snapshot_ids[index], **snapshot_rows[index]} for index in indexes
+            ])
+            self._store_values(session, pending, [
+                (snapshot_ids[index], snapshot_rows[index], snapshot_values[index], snapshot_layout[index])
+                for index in indexes
+            ])
+            self._partitions.record(session, key, snapshot_ids[indexes[-1]])
+        self._partitions.use(session, None)
+        return snapshot_ids
+
+    def _store_values(self, session: Session, pending: PendingIdentities,
+                      snapshots: list[tuple[int, dict, list[tuple[int, float]], str]]):
+        """Write the metric values of stored snapshots in their value layouts.
+
+        Args:
+            session:   The active SQLAlchemy session
+            pending:   Collects identity rows created by this transaction
+            snapshots: (snapshot id, snapshot row, values, value layout) per snapshot
+        """
+        # Snapshots without metrics have nothing to store in any layout
+        by_layout = {layout: [] for layout in LAYOUTS}
+        for snapshot_id, row, values, layout in snapshots:
+            if values:
+                by_layout[layout].append((snapshot_id, row, values))
+
+        value_rows = [
+            {
+                'metric_snapshot_id':    snapshot_id,
+                'device_metric_type_id': metric_type_id,
+                'value':                 value,
+            }
+            for snapshot_id, _, values in by_layout[LAYOUT_ROWS]
+            for metric_type_id, value in values
+        ]
+        if value_rows:
+            session.execute(insert(MetricValue), value_rows)
+        if by_layout[LAYOUT_PACKED]:
+            self._store_packed_values(session, pending, by_layout[LAYOUT_PACKED])
+        if by_layout[LAYOUT_CHUNKED]:
+            self._store_chunked_values(session, by_layout[LAYOUT_CHUNKED])
+
+    def _store_chunked_values(self, session: Session, snapshots: list[tuple[int, dict, list[tuple[int, float]]]]):
+        """Append each snapshot's values to the chunk store.
+
+        The snapshots are already inserted, so shared_epochs() sees them:
+        values of a snapshot that is not the first of its device at its
+        timestamp are tagged with its id, so reads keep them apart.
+
+        Args:
+            session:   The active SQLAlchemy session
+            snapshots: (snapshot id, snapshot row, non-empty values) per snapshot
+        """
+        epochs  = [row['client_utc_timestamp_epoch'] for _, row, _ in snapshots]
+        shared  = shared_epochs(session, {row['device_id'] for _, row, _ in snapshots}, min(epochs), max(epochs))
+        samples = []
+        for snapshot_id, row, values in snapshots:
+            key   = (row['device_id'], row['client_utc_timestamp_epoch'])
+            owner = None if shared.get(key, snapshot_id) == snapshot_id else snapshot_id
+            samples.extend(Sample(metric_type_id, *key, value, owner) for metric_type_id, value in values)
+        append_samples(session, samples, self._chunk_secs)
+
+    def _store_packed_values(self, session: Session, pending: PendingIdentities,
+                             snapshots: list[tuple[int, dict, list[tuple[int, float]]]]):
+        """Write each snapshot's values as one packed_metric_values row.
+
+        The metric type ids go into a metric_layouts row shared by every
+        snapshot of the device with the same metrics, resolved through the
+        identity cache; only the values are stored per snapshot.
+
+        Args:
+            session:   The active SQLAlchemy session
+            pending:   Collects identity rows created by this transaction
+            snapshots: (snapshot id, snapshot row, non-empty values) per snapshot
+        """
+        packed_rows = []
+        for snapshot_id, row, values in snapshots:
+            type_ids, metric_values = zip(*values)
+            packed_rows.append({
+                'metric_snapshot_id': snapshot_id,
+                'layout_id':          self._identity_cache.resolve_layout(
+                    session, pending, row['device_id'], pack_type_ids(type_ids)
+                ),
+                'metric_values':      pack_values(metric_values),
+            })
+        session.execute(insert(PackedMetricValues), packed_rows)
+
+    def _publish_deletions(self):
+        """Bump the data version after retention deleted rows and tell the
+        read API, so ETags change and cached responses are dropped."""
+        with self._write_lock:
+            session = Session(self.engine)
+            try:
+                self._update_system_state(session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
                 session.close()
+        self._signal_update(None)
 
-    def _signal_update(self):
+    def _signal_update(self, changes: set[tuple[str, str]] | None):
         """Notify the read API that new data has been committed.
 
         If a shared threading.Event was provided via set_update_event(), sets
         it so the read API's SSE generator wakes up immediately. The event is
         cleared by the read API after it wakes, ready for the next snapshot.
+        Listeners registered with add_update_listener() are then called with
+        the changed (aggregator guid, device name) pairs.
+
+        Read APIs running as separate processes are woken through the
+        ChangeNotifier; it never blocks, and a lost wake-up is caught by their
+        data version probe.
 
-        If no event is available (standalone process), the read API will detect
-        the update via SystemState polling instead — no action needed here.
+        Args:
+            changes: (aggregator guid, device name) pairs that got new
+                     snapshots, or None if anything may have changed
         """
         if self._update_event is not None:
             self._update_event.set()
             self.logger.debug("IngestAPI: update event fired")
+        self._change_notifier.notify()
+        for listener in self._update_listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                self.logger.exception("IngestAPI: update listener failed: %s", str(e))
 
     def _update_system_state(self, session: Session):
         """Update or create the single SystemState row with the current UTC
-        timestamp. Included in the same transaction as the snapshot write so
-        it rolls back automatically if the write fails.
+        timestamp and bump its data version. Included in the same transaction
+        as the snapshot write so it rolls back automatically if the write fails.
 
-        Used as a fallback signal for standalone read_api deployments that
-        cannot share a threading.Event with this process.
+        The version feeds the read API's ETags and lets a standalone read_api
+        work out what changed since it last looked.
 
         Args:
             session: The active SQLAlchemy session for the current request
@@ -196,12 +674,33 @@ class IngestAPI:
         state     = session.query(SystemState).filter_by(id=1).first()
         if state:
             state.last_updated = now_epoch
+            state.version      = SystemState.version + 1
         else:
-            session.add(SystemState(id=1, last_updated=now_epoch))
+            session.add(SystemState(id=1, last_updated=now_epoch, version=1))
+
+    def run(self, sock: socket.socket | None = None) -> int:
+        """Serve the ingest API until interrupted.
 
-    def run(self) -> int:
+        Args:
+            sock: Already listening socket to accept connections from, as
+                  inherited by server.py serve's workers; by default one is
+                  opened on ingest_api.port
+        """
         try:
+            # The ingest API is the only writer, so it brings the schema up to
+            # date before accepting snapshots
+            upgrade(self.engine)
+            if self._partitions is not None:
+                self._partitions.upgrade_files()
+            if self._remote_writer is None:
+                self.start_maintenance()
             self.logger.info("Starting IngestAPI on port %s", self.config.ingest_api.port)
+            if sock is not None:
+                make_server(
+                    '0.0.0.0', self.config.ingest_api.port, self.webserver,
+                    threaded=True, fd=sock.fileno()
+                ).serve_forever()
+                return 0
             self.webserver.run(host='0.0.0.0',debug=self.config.ingest_api.debug, port=self.config.ingest_api.port)
             return 0
         except Exception as e:
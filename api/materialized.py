@@ -0,0 +1,251 @@
+"""
+api/materialized.py
+
+Tables derived from the raw snapshots and kept up to date by the ingest
+transaction, so the read API can answer common questions without scanning
+raw metric_values.
+
+IngestAPI collects a WrittenSnapshot for every snapshot it inserts and passes
+the batch to update_all() before committing. Each maintainer folds the batch
+in memory first and then issues one multi-row statement, so the extra cost
+per ingest is a handful of statements regardless of batch size.
+
+Maintained tables:
+    metric_rollups          count/min/max/sum/last per metric per 1m, 1h and 1d bucket
+    metric_totals           all-time count and sum per metric
+    device_latest_values    newest snapshot of each device, values packed as JSON
+"""
+
+import json
+import logging
+from typing import NamedTuple
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import DeviceLatestValues, MetricRollup, MetricTotal
+
+_logger = logging.getLogger(__name__)
+
+# Rollup resolutions, keyed by the value accepted by /metrics?resolution=
+ROLLUP_RESOLUTIONS = {
+    '1m': 60,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+
+class WrittenSnapshot(NamedTuple):
+    """One snapshot as written by the ingest transaction."""
+    snapshot_id: int
+    device_id:   int
+    epoch:       int                        # client_utc_timestamp_epoch
+    values:      list[tuple[int, float]]    # (device_metric_type_id, value)
+    names:       list[str]                  # metric name of each entry in values
+
+
+def update_all(session: Session, written: list[WrittenSnapshot]):
+    """Bring every materialised table up to date with a batch of snapshots.
+
+    Must be called inside the transaction that wrote them, so the derived
+    rows commit or roll back together with the raw data.
+    """
+    if not written:
+        return
+    update_rollups(session, written)
+    update_totals(session, written)
+    update_latest_values(session, written)
+
+
+# ---------------------------------------------------------------------------
+# Rollups
+# ---------------------------------------------------------------------------
+
+def update_rollups(session: Session, written: list[WrittenSnapshot]):
+    """Fold a batch of snapshots into metric_rollups for every resolution.
+
+    Samples landing in the same bucket are combined in memory, then all
+    buckets are upserted with one executemany INSERT ... ON CONFLICT that
+    merges them with whatever is already stored.
+    """
+    buckets = {}   # (type_id, resolution, bucket_start) → [device_id, count, min, max, sum, last, last_epoch]
+    for snapshot in sorted(written, key=lambda w: w.epoch):
+        for resolution in ROLLUP_RESOLUTIONS.values():
+            bucket_start = snapshot.epoch - snapshot.epoch % resolution
+            for type_id, value in snapshot.values:
+                acc = buckets.get((type_id, resolution, bucket_start))
+                if acc is None:
+                    buckets[(type_id, resolution, bucket_start)] = [
+                        snapshot.device_id, 1, value, value, value, value, snapshot.epoch
+                    ]
+                else:
+                    acc[1] += 1
+                    acc[2]  = min(acc[2], value)
+                    acc[3]  = max(acc[3], value)
+                    acc[4] += value
+                    acc[5]  = value           # batch is sorted by epoch
+                    acc[6]  = snapshot.epoch
+
+    if not buckets:
+        return
+
+    stmt     = sqlite_insert(MetricRollup)
+    excluded = stmt.excluded
+    table    = MetricRollup.__table__.c
+    newer    = excluded.last_epoch >= table.last_epoch
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device_metric_type_id', 'resolution_secs', 'bucket_start_epoch'],
+        set_={
+            'sample_count': table.sample_count + excluded.sample_count,
+            'min_value':    func.min(table.min_value, excluded.min_value),
+            'max_value':    func.max(table.max_value, excluded.max_value),
+            'sum_value':    table.sum_value + excluded.sum_value,
+            'last_value':   case((newer, excluded.last_value), else_=table.last_value),
+            'last_epoch':   case((newer, excluded.last_epoch), else_=table.last_epoch),
+        }
+    )
+    session.execute(stmt, [
+        {
+            'device_metric_type_id': type_id,
+            'resolution_secs':       resolution,
+            'bucket_start_epoch':    bucket_start,
+            'device_id':             acc[0],
+            'sample_count':          acc[1],
+            'min_value':             acc[2],
+            'max_value':             acc[3],
+            'sum_value':             acc[4],
+            'last_value':            acc[5],
+            'last_epoch':            acc[6],
+        }
+        for (type_id, resolution, bucket_start), acc in buckets.items()
+    ])
+    _logger.debug("Upserted %d rollup bucket(s)", len(buckets))
+
+
+def rollup_window_condition(start_epoch: int, end_epoch: int):
+    """Return a filter on MetricRollup selecting the fewest buckets that
+    cover [start_epoch, end_epoch].
+
+    Whole days inside the window come from the 1d rollups and the partial
+    days at either end from the 1h rollups, so a 7-day window merges at most
+    7 + 2*23 buckets per metric. start_epoch is rounded down to the hour.
+    """
+    hour, day = ROLLUP_RESOLUTIONS['1h'], ROLLUP_RESOLUTIONS['1d']
+    start     = start_epoch - start_epoch % hour
+    first_day = -(-start // day) * day             # first midnight at or after start
+    last_day  = end_epoch - end_epoch % day        # midnight starting the final, partial day
+
+    hours = and_(MetricRollup.resolution_secs == hour, MetricRollup.bucket_start_epoch >= start,
+                 MetricRollup.bucket_start_epoch <= end_epoch)
+    if first_day >= last_day:
+        return hours
+
+    return or_(
+        and_(MetricRollup.resolution_secs == hour,
+             MetricRollup.bucket_start_epoch >= start, MetricRollup.bucket_start_epoch < first_day),
+        and_(MetricRollup.resolution_secs == day,
+             MetricRollup.bucket_start_epoch >= first_day, MetricRollup.bucket_start_epoch < last_day),
+        and_(MetricRollup.resolution_secs == hour,
+             MetricRollup.bucket_start_epoch >= last_day, MetricRollup.bucket_start_epoch <= end_epoch),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Totals
+# ---------------------------------------------------------------------------
+
+def update_totals(session: Session, written: list[WrittenSnapshot]):
+    """Add a batch of snapshots to the all-time totals in metric_totals."""
+    totals = {}   # type_id → [device_id, count, sum]
+    for snapshot in written:
+        for type_id, value in snapshot.values:
+            acc = totals.get(type_id)
+            if acc is None:
+                totals[type_id] = [snapshot.device_id, 1, value]
+            else:
+                acc[1] += 1
+                acc[2] += value
+
+    if not totals:
+        return
+
+    stmt     = sqlite_insert(MetricTotal)
+    excluded = stmt.excluded
+    table    = MetricTotal.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device_metric_type_id'],
+        set_={
+            'sample_count': table.sample_count + excluded.sample_count,
+            'total_value':  table.total_value  + excluded.total_value,
+        }
+    )
+    session.execute(stmt, [
+        {
+            'device_metric_type_id': type_id,
+            'device_id':             acc[0],
+            'sample_count':          acc[1],
+            'total_value':           acc[2],
+        }
+        for type_id, acc in totals.items()
+    ])
+    _logger.debug("Upserted %d metric total(s)", len(totals))
+
+
+# ---------------------------------------------------------------------------
+# Latest values
+# ---------------------------------------------------------------------------
+
+def pack_latest_values(pairs) -> str:
+    """Serialise (device_metric_type_id, name, value) triples for
+    device_latest_values.metric_values, in metric type order."""
+    return json.dumps([[name, value] for _, name, value in sorted(pairs, key=lambda p: p[0])],
+                      separators=(',', ':'))
+
+
+def unpack_latest_values(packed: str) -> list[tuple[str, float]]:
+    """Inverse of pack_latest_values: [(metric name, value), ...]."""
+    return [(name, value) for name, value in json.loads(packed)]
+
+
+def update_latest_values(session: Session, written: list[WrittenSnapshot]):
+    """Replace each device's row in device_latest_values if the batch holds
+    a newer snapshot for it.
+
+    Newer means a later client timestamp, or the same timestamp and a higher
+    snapshot id — the same snapshot a "newest first" scan of
+    metric_snapshots would return.
+    """
+    newest = {}   # device_id → WrittenSnapshot
+    for snapshot in written:
+        current = newest.get(snapshot.device_id)
+        if current is None or (snapshot.epoch, snapshot.snapshot_id) > (current.epoch, current.snapshot_id):
+            newest[snapshot.device_id] = snapshot
+
+    stmt     = sqlite_insert(DeviceLatestValues)
+    excluded = stmt.excluded
+    table    = DeviceLatestValues.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device_id'],
+        set_={
+            'metric_snapshot_id':         excluded.metric_snapshot_id,
+            'client_utc_timestamp_epoch': excluded.client_utc_timestamp_epoch,
+            'metric_values':              excluded.metric_values,
+        },
+        where=or_(
+            excluded.client_utc_timestamp_epoch > table.client_utc_timestamp_epoch,
+            and_(excluded.client_utc_timestamp_epoch == table.client_utc_timestamp_epoch,
+                 excluded.metric_snapshot_id > table.metric_snapshot_id),
+        )
+    )
+    session.execute(stmt, [
+        {
+            'device_id':                  device_id,
+            'metric_snapshot_id':         snapshot.snapshot_id,
+            'client_utc_timestamp_epoch': snapshot.epoch,
+            'metric_values':              pack_latest_values(
+                (type_id, name, value) for (type_id, value), name in zip(snapshot.values, snapshot.names)
+            ),
+        }
+        for device_id, snapshot in newest.items()
+    ])
+    _logger.debug("Refreshed latest values for %d device(s)", len(newest))
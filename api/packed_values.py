@@ -0,0 +1,168 @@
+"""
+api/packed_values.py
+
+Packed storage layout for metric values: one row per snapshot instead of
+one metric_values row per metric.
+
+With the default "rows" layout a 300-metric PokemonInfo snapshot becomes
+300 metric_values rows, each with its own primary key entry. With
+ingest_api.value_layout set to "packed" it becomes a single
+packed_metric_values row instead:
+
+    metric_layouts          layout_id → the device's metric type ids, in the
+                            order the agent sent them, as a uint32 array.
+                            Written once per distinct set of metrics, so
+                            successive snapshots of a device share one.
+    packed_metric_values    metric_snapshot_id → layout_id plus the values as
+                            a dense float64 array in layout order
+
+All integers and floats are little-endian. A snapshot's values are in
+exactly one of the two tables, so switching layouts never needs a migration
+of old data: ReadAPI reads both and merges them (see read_api.py), and every
+endpoint returns the same JSON whichever layout a snapshot was stored in.
+
+Decoding does not copy: values_view() returns a NumPy array over the
+stored bytes when numpy is installed, and a memoryview of doubles otherwise.
+
+Usage:
+    from api.packed_values import pack_values, pack_type_ids, values_view
+
+    blob   = pack_values([3.0, 1.0])           # store in packed_metric_values
+    values = values_view(blob)                 # zero-copy; .tolist() for JSON
+"""
+
+import sys
+from array import array
+from sqlalchemy import select
+
+from models import DeviceMetricType, MetricLayout
+
+try:
+    import numpy
+    _NUMPY_AVAILABLE = True
+except ImportError:
+    _NUMPY_AVAILABLE = False
+
+# ingest_api.value_layout values; 'chunked' is the time-series chunk store
+# in series_chunks.py
+LAYOUT_ROWS    = 'rows'
+LAYOUT_PACKED  = 'packed'
+LAYOUT_CHUNKED = 'chunked'
+LAYOUTS        = (LAYOUT_ROWS, LAYOUT_PACKED, LAYOUT_CHUNKED)
+
+# Stored arrays are little-endian; array() uses the host byte order
+_SWAP = sys.byteorder != 'little'
+
+# SQLite limits the number of bound parameters per statement
+_IN_CHUNK_SIZE = 500
+
+
+# ---------------------------------------------------------------------------
+# Encoding
+# ---------------------------------------------------------------------------
+
+def pack_type_ids(type_ids) -> bytes:
+    """Pack device_metric_type_ids for metric_layouts.type_ids."""
+    # array('I') is 32-bit on every platform CPython supports
+    packed = array('I', type_ids)
+    if _SWAP:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def pack_values(values) -> bytes:
+    """Pack float values for packed_metric_values.metric_values."""
+    packed = array('d', values)
+    if _SWAP:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+# ---------------------------------------------------------------------------
+# Decoding
+# ---------------------------------------------------------------------------
+
+def values_view(blob: bytes):
+    """View a packed value array without copying it.
+
+    Returns:
+        A read-only numpy float64 array if numpy is installed, else a
+        memoryview of doubles (a copy only on big-endian hosts). Either
+        supports len(), indexing and .tolist().
+    """
+    if _NUMPY_AVAILABLE:
+        return numpy.frombuffer(blob, dtype='<f8')
+    if not _SWAP:
+        return memoryview(blob).cast('d')
+    values = array('d', blob)
+    values.byteswap()
+    return values
+
+
+def type_ids_view(blob: bytes):
+    """View a packed type id array without copying it; see values_view()."""
+    if _NUMPY_AVAILABLE:
+        return numpy.frombuffer(blob, dtype='<u4')
+    if not _SWAP:
+        return memoryview(blob).cast('I')
+    type_ids = array('I', blob)
+    type_ids.byteswap()
+    return type_ids
+
+
+def layout_names(session, layout_ids) -> dict[int, list[str]]:
+    """Resolve layouts to their metric names, in layout order.
+
+    Two queries per chunk of layouts: the layouts themselves, then the
+    metric types of the devices they belong to.
+
+    Returns:
+        {layout_id: [metric name, ...]}
+    """
+    layout_ids = list(dict.fromkeys(layout_ids))
+    layouts    = []
+    for start in range(0, len(layout_ids), _IN_CHUNK_SIZE):
+        layouts += session.execute(
+            select(MetricLayout.layout_id, MetricLayout.device_id, MetricLayout.type_ids)
+            .where(MetricLayout.layout_id.in_(layout_ids[start:start + _IN_CHUNK_SIZE]))
+        ).all()
+
+    device_ids = list({device_id for _, device_id, _ in layouts})
+    type_names = {}
+    for start in range(0, len(device_ids), _IN_CHUNK_SIZE):
+        type_names.update(session.execute(
+            select(DeviceMetricType.device_metric_type_id, DeviceMetricType.name)
+            .where(DeviceMetricType.device_id.in_(device_ids[start:start + _IN_CHUNK_SIZE]))
+        ).all())
+
+    return {
+        layout_id: [type_names[type_id] for type_id in type_ids_view(type_ids).tolist()]
+        for layout_id, _, type_ids in layouts
+    }
+
+
+def expand_rows(session, packed_rows: list):
+    """Turn packed rows into one row per metric, like the "rows" layout gives.
+
+    Layout names are looked up straight away, so the session is free for
+    other queries while the result is being iterated.
+
+    Args:
+        session:     Active SQLAlchemy session
+        packed_rows: Rows whose last two columns are (layout_id, packed
+                     values); any leading columns are repeated on every
+                     row produced
+
+    Returns:
+        An iterator of (*leading columns, metric name, value) tuples, in
+        row order and then layout order.
+    """
+    names = layout_names(session, [row[-2] for row in packed_rows])
+
+    def rows():
+        for row in packed_rows:
+            head = tuple(row[:-2])
+            for name, value in zip(names[row[-2]], values_view(row[-1]).tolist()):
+                yield head + (name, value)
+
+    return rows()
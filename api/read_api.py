@@ -5,14 +5,33 @@ Read-only API server. Serves stored metrics data to the frontend.
 Has no write endpoints — that is ingest_api.py's responsibility.
 
 The SSE endpoint (/stream) pushes updates to connected clients whenever new
-data is available. It uses one of two mechanisms depending on how the server
-is started:
+data is available. A single producer thread detects the change, builds the
+payload once and fans it out to every client through an SSEHub (see
+sse_hub.py), which also lets reconnecting clients resume with Last-Event-ID.
+The producer uses one of two mechanisms depending on how the server is started:
 
   - When started via 'python server.py both': waits on a shared
     threading.Event that IngestAPI sets after each commit — push is instant.
 
-  - When started standalone via 'python server.py read': polls SystemState
-    in the database every second — push has up to 1 second of latency.
+  - When started standalone via 'python server.py read': waits on a
+    ChangeListener (see change_notify.py), woken by a datagram the ingest
+    process sends after each commit, with a PRAGMA data_version probe as
+    the fallback. One listener per process, however many clients.
+
+/aggregators, /metrics, /pc_devices, /pokemon_info and /trainers are served
+from an in-process response cache (see response_cache.py). In 'both' mode IngestAPI
+tells the cache which aggregators and devices each commit touched; standalone,
+the cache notices SystemState.version advancing and works that out from the
+newly committed snapshots.
+
+JSON responses and /stream are compressed with zstd or gzip when the
+client's Accept-Encoding allows it (see compression.py). Cached responses and
+SSE events keep their compressed bytes, so each is compressed once, not once
+per client.
+
+By default run() uses Flask's threaded server, where every SSE client holds a
+thread. Setting read_api.server to "asgi" serves the same routes from uvicorn
+with /stream as a coroutine per client instead (see read_api_asgi.py).
 
 Endpoints:
     GET /hello
@@ -21,49 +40,133 @@ Endpoints:
     GET /devices?aggregator_guid=<guid>
     GET /devices?aggregator_guid=<guid>&name=<n>
     GET /metrics?guid=<guid>&device_name=<n>&utc_date_min=<datetime>&utc_date_max=<datetime>
+    GET /metrics?...&limit=<n>&cursor=<cursor>  — keyset-paginated
+    GET /metrics?...&format=ndjson              — streamed, one line per snapshot
+    GET /metrics?...&resolution=<1m|1h|1d>&stat=<avg|min|max|sum|last|count>
+                                                — downsampled from rollup tables
     GET /pc_info
-    GET /pokemon_info?format=<format>&type=<mons|move>
+    GET /pokemon_info?format=<format>&type=<mons|move>[&window=<24h|7d|...>]
+    GET /cache_stats         — response cache size and hit/miss counters
     GET /stream              — SSE push endpoint for the frontend
+    GET /stream?events=snapshots[&aggregator_guid=<guid>&device_name=<n>]
+                             — SSE deltas: only newly committed snapshots
     GET /formats             — pinned formats + full available list
     POST /formats/pin        — pin a format to start tracking
     DELETE /formats/pin      — unpin a format
 """
 
 import sys
+import re
 import json
+import base64
+import functools
+import heapq
 import logging
+import socket
 import threading
 import time
 from pathlib import Path
-from datetime import datetime
-from sqlalchemy import create_engine
+from datetime import datetime, timezone
+from sqlalchemy import and_, func, inspect, literal_column, or_, select
 from sqlalchemy.orm import Session
 from flask import Flask, request, Response, stream_with_context
+from werkzeug.http import http_date
+from werkzeug.serving import make_server
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from config import Config
-from collectors.metrics_datamodel import (
-    DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+from database import create_db_engine
+from migrations import LATEST_VERSION, current_version
+from partitions import partition_store
+from compression import ENCODINGS, DEFAULT_MIN_BYTES as DEFAULT_COMPRESS_MIN_BYTES, compress, negotiate
+from models import (
+    Aggregator, Device, DeviceLatestValues, DeviceMetricType, MetricChunk, MetricRollup, MetricSnapshot, MetricTotal,
+    MetricValue, PackedMetricValues, SystemState
 )
-from models import Aggregator, Device, DeviceMetricType, MetricSnapshot, MetricValue, SystemState
+from api.response_cache import (
+    CachedBody, ResponseCache, ANY_CHANGE, DEFAULT_MAX_ENTRIES as DEFAULT_CACHE_ENTRIES, DEFAULT_TTL_SECS as DEFAULT_CACHE_TTL_SECS
+)
+from api.sse_hub import SSEHub, DEFAULT_QUEUE_SIZE, DEFAULT_REPLAY_SIZE
+from api.change_notify import ChangeListener, default_notify_dir
+from api.materialized import ROLLUP_RESOLUTIONS, rollup_window_condition, unpack_latest_values
+from api.packed_values import expand_rows
+from api.series_chunks import read_samples, shared_epochs, snapshot_values
 from collectors import PCInfo
 from collectors import PokemonInfo
 
-# How often the SSE generator polls the database when no threading.Event is
-# available (standalone deployment). Lower = more responsive, higher = less
-# DB load.
-SSE_POLL_INTERVAL  = 1   # seconds
 HEARTBEAT_INTERVAL = 15  # seconds between keepalive pings to the client
 
+# read_api.server: 'flask' runs Flask's threaded server (one thread per SSE
+# client); 'asgi' runs uvicorn (see read_api_asgi.py)
+DEFAULT_SERVER = 'flask'
+
+# Column expression returned for each /metrics?stat= value when answering
+# from the rollup tables
+ROLLUP_STATS = {
+    'avg':   MetricRollup.sum_value / MetricRollup.sample_count,
+    'min':   MetricRollup.min_value,
+    'max':   MetricRollup.max_value,
+    'sum':   MetricRollup.sum_value,
+    'last':  MetricRollup.last_value,
+    'count': MetricRollup.sample_count,
+}
+
+# /stream event kinds: the full current state on every update, or only the
+# snapshots committed since the previous event
+SSE_METRICS   = 'metrics'
+SSE_SNAPSHOTS = 'snapshots'
+
+# Response headers for /stream: no proxy buffering, no caching, any origin
+SSE_HEADERS = {
+    'X-Accel-Buffering':           'no',
+    'Access-Control-Allow-Origin': '*',
+    'Cache-Control':               'no-cache',
+}
+
+# Tag set returned by a route's cache_tags callable to skip the response cache
+NOT_CACHED = object()
+
+# Responses larger than this are served but not kept in the response cache,
+# so a few full-history /metrics dumps cannot fill memory
+CACHE_MAX_BODY_BYTES = 8 * 1024 * 1024
+
+# Response types compressed when the client accepts it; others (static files,
+# NDJSON streams) are sent as they are
+COMPRESSIBLE_MIMETYPES = {'application/json'}
+
+# /pokemon_info?window= values: a count followed by h (hours) or d (days)
+WINDOW_PATTERN = re.compile(r'(\d+)([hd])')
+WINDOW_UNITS   = {'h': 3600, 'd': 86400}
+
+# Keyset pagination for /metrics. METRICS_PAGE_SIZE is how many snapshots the
+# NDJSON stream reads per round trip; METRICS_MAX_LIMIT caps ?limit=.
+METRICS_PAGE_SIZE = 500
+METRICS_MAX_LIMIT = 10000
+
 
 class ReadAPI:
     def __init__(self):
         self.config        = Config(__file__)
         self.logger        = logging.getLogger(__name__)
         self.webserver     = Flask(__name__)
-        self.engine        = create_engine(self.config.database.connection_string)
+        self.engine        = create_db_engine(self.config)
+        self._partitions   = partition_store(self.config)
         self._update_event: threading.Event | None = None
+        self._response_cache = self._create_response_cache()
+        self._encodings, self._compress_min_bytes = self._compression_settings()
+        # Until attach_ingest() is called the cache finds out about new data
+        # by watching SystemState.version (standalone mode)
+        self._cache_follows_version = True
+        self._cache_seen: tuple[int, int] | None = None   # (data version, max snapshot id)
+        self._cache_sync_lock = threading.Lock()
+        self._sse_hub         = self._create_sse_hub()
+        self._sse_producer: threading.Thread | None = None
+        self._change_listener: ChangeListener | None = None
+        self._sse_after_snapshot_id = 0   # last snapshot id published as a delta
+        self._sse_lock        = threading.Lock()
+        self._sse_build_lock  = threading.Lock()
+        self._has_metric_totals = False   # set once metric_totals is seen
         self._setup_routes()
         self.logger.debug("ReadAPI initialized")
 
@@ -76,7 +179,7 @@ class ReadAPI:
         immediately with no polling delay.
 
         This is called by server.py when running both APIs in the same process.
-        If never called, the SSE generator falls back to polling SystemState.
+        If never called, a ChangeListener provides the event instead.
 
         Args:
             event: The shared Event instance created in server.py
@@ -84,20 +187,265 @@ class ReadAPI:
         self._update_event = event
         self.logger.debug("ReadAPI: shared update event registered")
 
+    def set_worker(self, index: int, count: int):
+        """Declare this instance worker index of count processes serving the
+        read API (server.py serve), so the SSE event ids each one issues
+        stay distinct. Call before serving any request."""
+        self._sse_hub = self._create_sse_hub(index, count)
+
+    def attach_ingest(self, ingest):
+        """Take response cache invalidations straight from an IngestAPI running
+        in the same process, instead of watching SystemState for changes.
+
+        Called by server.py in 'both' mode.
+
+        Args:
+            ingest: The IngestAPI instance sharing this process
+        """
+        ingest.add_update_listener(self.invalidate_cache)
+        self._cache_follows_version = False
+        self.logger.debug("ReadAPI: response cache attached to in-process IngestAPI")
+
+    def invalidate_cache(self, changes: set[tuple[str, str]] | None = None):
+        """Drop cached responses that may depend on changes, a set of
+        (aggregator guid, device name) pairs, or every response if None."""
+        removed = self._response_cache.invalidate(changes)
+        self.logger.debug("ReadAPI: %d cached response(s) invalidated", removed)
+
+    def _create_sse_hub(self, worker_index: int = 0, worker_count: int = 1) -> SSEHub:
+        settings = getattr(self.config.read_api, 'sse', None)
+        return SSEHub(
+            replay_size=getattr(settings, 'replay_size', DEFAULT_REPLAY_SIZE),
+            queue_size=getattr(settings, 'client_queue_size', DEFAULT_QUEUE_SIZE),
+            worker_index=worker_index,
+            worker_count=worker_count,
+        )
+
+    def _create_response_cache(self) -> ResponseCache:
+        settings = getattr(self.config.read_api, 'response_cache', None)
+        return ResponseCache(
+            max_entries=getattr(settings, 'max_entries', DEFAULT_CACHE_ENTRIES),
+            ttl=getattr(settings, 'ttl_secs', DEFAULT_CACHE_TTL_SECS),
+        )
+
+    def _compression_settings(self) -> tuple[tuple[str, ...], int]:
+        """Return the encodings to offer, most preferred first, and the
+        smallest body worth compressing, from read_api.compression."""
+        settings  = getattr(self.config.read_api, 'compression', None)
+        wanted    = getattr(settings, 'encodings', ENCODINGS)
+        encodings = tuple(e for e in wanted if e in ENCODINGS)
+        return encodings, int(getattr(settings, 'min_bytes', DEFAULT_COMPRESS_MIN_BYTES))
+
+    def negotiate_encoding(self, headers) -> str | None:
+        """Pick the Content-Encoding for a response from the request headers,
+        or None to send it uncompressed."""
+        return negotiate(headers.get('Accept-Encoding'), self._encodings)
+
+    @staticmethod
+    def sse_headers(encoding: str | None) -> dict:
+        """Response headers for a /stream response sent in encoding."""
+        if encoding is None:
+            return {**SSE_HEADERS, 'Vary': 'Accept-Encoding'}
+        return {**SSE_HEADERS, 'Vary': 'Accept-Encoding', 'Content-Encoding': encoding}
+
     def _setup_routes(self):
+        conditional, cached = self._conditional, self._cached
+        self.webserver.after_request(self._compress_response)
         self.webserver.route("/hello")(self.hello)
-        self.webserver.route("/aggregators",  methods=['GET'])(self.get_aggregators)
-        self.webserver.route("/devices",      methods=['GET'])(self.get_devices)
-        self.webserver.route("/metrics",      methods=['GET'])(self.get_metrics)
-        self.webserver.route("/pc_devices",      methods=['GET'])(self.get_pc_devices)
-        self.webserver.route("/pc_device_info",  methods=['GET'])(self.get_pc_device_info)
-        self.webserver.route("/pokemon_info", methods=['GET'])(self.get_pokemon_info)
+        self.webserver.route("/aggregators",  methods=['GET'])(conditional(cached(self.get_aggregators, self._any_change_tags)))
+        self.webserver.route("/cache_stats",  methods=['GET'])(self.get_cache_stats)
+        self.webserver.route("/devices",      methods=['GET'])(conditional(self.get_devices))
+        self.webserver.route("/metrics",      methods=['GET'])(conditional(cached(self.get_metrics, self._metrics_tags)))
+        self.webserver.route("/pc_devices",      methods=['GET'])(conditional(cached(self.get_pc_devices, self._any_change_tags)))
+        self.webserver.route("/pc_device_info",  methods=['GET'])(conditional(self.get_pc_device_info, self._pc_device_etag))
+        self.webserver.route("/pokemon_info", methods=['GET'])(conditional(cached(self.get_pokemon_info, self._pokemon_info_tags), self._pokemon_info_etag))
         self.webserver.route("/stream",       methods=['GET'])(self.stream)
-        self.webserver.route("/trainer_info", methods=['GET'])(self.get_trainer_info)
-        self.webserver.route("/trainers",     methods=['GET'])(self.get_trainers)
+        self.webserver.route("/trainer_info", methods=['GET'])(conditional(self.get_trainer_info, self._trainer_etag))
+        self.webserver.route("/trainers",     methods=['GET'])(conditional(cached(self.get_trainers, self._trainers_tags)))
         self.webserver.route("/formats",      methods=['GET'])(self.get_formats)
         self.webserver.route("/formats/pin",  methods=['POST', 'DELETE'])(self.pin_format)
 
+    def _conditional(self, handler, scoped_etag=None):
+        """Wrap a GET handler with conditional request support.
+
+        Every response carries a weak ETag and a Last-Modified header taken
+        from SystemState, which ingest_api bumps on each commit. A request
+        whose If-None-Match (or, failing that, If-Modified-Since) still
+        matches gets an empty 304 without running the handler at all.
+
+        Args:
+            handler:     The route function to wrap
+            scoped_etag: Optional callable taking the global data version and
+                         returning a narrower ETag for this request (e.g. one
+                         that only changes when a single device does), or None
+                         to fall through to the handler uncached.
+        """
+        @functools.wraps(handler)
+        def wrapper():
+            state = self._get_data_version()
+            if state is None:
+                return handler()
+
+            version, last_updated = state
+            etag = f'v{version}' if scoped_etag is None else scoped_etag(version)
+            if etag is None:
+                return handler()
+            last_modified = datetime.fromtimestamp(last_updated, timezone.utc)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = self.webserver.make_response(handler())
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified          = last_modified
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    def _cached(self, handler, cache_tags):
+        """Wrap a GET handler with the response cache.
+
+        Successful responses are stored under the route plus its sorted query
+        arguments, tagged with what cache_tags() says they depend on, and
+        replayed byte for byte until an ingest touching those tags
+        invalidates them or they expire. Compressed forms are cached with
+        the body, so each is built once.
+
+        Args:
+            handler:    The route function to wrap
+            cache_tags: Callable returning the (aggregator guid, device name)
+                        tags for the current request, ANY_CHANGE, or
+                        NOT_CACHED to bypass the cache
+        """
+        @functools.wraps(handler)
+        def wrapper():
+            cache = self._response_cache
+            tags  = cache_tags()
+            if not cache.enabled or tags is NOT_CACHED:
+                return handler()
+
+            if self._cache_follows_version:
+                self._sync_cache_with_database()
+
+            key        = (request.path, tuple(sorted(request.args.items(multi=True))))
+            generation = cache.generation
+            body       = cache.get(key)
+            if body is not None:
+                return self._encode_response(Response(body.data, status=200, mimetype='application/json'), body)
+
+            response = self.webserver.make_response(handler())
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = CachedBody(response.get_data())
+            if len(body.data) <= CACHE_MAX_BODY_BYTES:
+                cache.put(key, body, tags, generation)
+            return self._encode_response(response, body)
+
+        return wrapper
+
+    def _compress_response(self, response: Response) -> Response:
+        """after_request hook: compress JSON responses not already handled
+        by the response cache, if the client accepts an encoding we offer."""
+        if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or 'Content-Encoding' in response.headers):
+            return response
+        return self._encode_response(response)
+
+    def _encode_response(self, response: Response, body: CachedBody | None = None) -> Response:
+        """Replace a 200 response's body with its compressed form when the
+        request accepts one and the body is large enough to be worth it.
+
+        Args:
+            response: The uncompressed response
+            body:     Its CachedBody, whose compressed forms are reused; if
+                      None the body is compressed afresh
+        """
+        response.vary.add('Accept-Encoding')
+        data = response.get_data() if body is None else body.data
+        if len(data) < self._compress_min_bytes:
+            return response
+        encoding = self.negotiate_encoding(request.headers)
+        if encoding is None:
+            return response
+        response.set_data(compress(data, encoding) if body is None else body.encoded(encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _sync_cache_with_database(self):
+        """Standalone mode: invalidate cached responses for whatever was
+        ingested since the last check.
+
+        SystemState.version tells whether anything changed; if it did, the
+        snapshots committed since then say which aggregators and devices.
+        A version change with no new snapshots clears the whole cache.
+        """
+        state   = self._get_data_version()
+        version = state.version if state else 0
+        with self._cache_sync_lock:
+            if self._cache_seen is not None and self._cache_seen[0] == version:
+                return
+
+            session = Session(self.engine)
+            try:
+                if self._cache_seen is None:
+                    # First request: nothing is cached yet, just take a baseline
+                    self._cache_seen = (version, self._max_snapshot_id(session))
+                    return
+
+                seen_id = self._cache_seen[1]
+                rows = [
+                    row
+                    for _ in self._each_partition(session, self._partition_keys(session, after_id=seen_id))
+                    for row in (
+                        session.query(Aggregator.guid, Device.name, func.max(MetricSnapshot.metric_snapshot_id))
+                        .select_from(MetricSnapshot)
+                        .join(Device,     MetricSnapshot.device_id == Device.device_id)
+                        .join(Aggregator, Device.aggregator_id     == Aggregator.aggregator_id)
+                        .filter(MetricSnapshot.metric_snapshot_id > seen_id)
+                        .group_by(Aggregator.guid, Device.name)
+                        .all()
+                    )
+                ]
+            finally:
+                session.close()
+
+            self.invalidate_cache({(guid, name) for guid, name, _ in rows} if rows else None)
+            self._cache_seen = (version, max([seen_id] + [max_id for _, _, max_id in rows]))
+
+    @staticmethod
+    def _any_change_tags():
+        return ANY_CHANGE
+
+    @staticmethod
+    def _metrics_tags():
+        if request.args.get('format') == 'ndjson':
+            return NOT_CACHED
+        guid = request.args.get('guid')
+        if not guid:
+            # Device names are only unique within an aggregator
+            return ANY_CHANGE
+        return {(guid, request.args.get('device_name') or None)}
+
+    @staticmethod
+    def _trainers_tags():
+        return {('b2c3d4e5-f6a7-8901-bcde-f12345678901', None)}
+
+    @staticmethod
+    def _pokemon_info_tags():
+        # Windowed results move with the clock, and are cheap rollup reads anyway
+        if request.args.get('window'):
+            return NOT_CACHED
+        return {('a1b2c3d4-e5f6-7890-abcd-ef1234567890', request.args.get('format', 'gen9ou'))}
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Routes
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -107,18 +455,53 @@ class ReadAPI:
 
     def stream(self):
         """Server-Sent Events endpoint.
-        GET /stream
+        GET /stream                      — 'metrics' events with the full current state
+        GET /stream?events=snapshots     — 'snapshots' events with only newly committed snapshots
+        GET /stream?aggregator_guid=<guid>&device_name=<n>
+                                         — snapshots events for a subset (implies events=snapshots)
+        GET /stream?last_event_id=<id>   — resume; the Last-Event-ID header works too
         """
+        try:
+            kind, last_event_id, guid, device_name = self.parse_stream_args(request.args, request.headers)
+        except ValueError as e:
+            return {'status': 'error', 'message': str(e)}, 400
+        encoding = self.negotiate_encoding(request.headers)
         return Response(
-            stream_with_context(self._sse_generator()),
+            stream_with_context(self._sse_generator(kind, last_event_id, guid, device_name, encoding)),
             mimetype='text/event-stream',
-            headers={
-                'X-Accel-Buffering':           'no',
-                'Access-Control-Allow-Origin': '*',
-                'Cache-Control':               'no-cache',
-            }
+            headers=self.sse_headers(encoding)
         )
 
+    @staticmethod
+    def parse_stream_args(args, headers) -> tuple[str, int | None, str | None, str | None]:
+        """Read /stream's query arguments and Last-Event-ID header.
+
+        Args:
+            args:    Mapping of query arguments
+            headers: Mapping of request headers
+
+        Returns:
+            (kind, last_event_id, aggregator guid, device name)
+
+        Raises:
+            ValueError: If events= is unknown or filters are combined with
+                        events=metrics. The message is meant for the client.
+        """
+        guid        = args.get('aggregator_guid') or None
+        device_name = args.get('device_name') or None
+        kind        = args.get('events', SSE_SNAPSHOTS if (guid or device_name) else SSE_METRICS)
+        if kind not in (SSE_METRICS, SSE_SNAPSHOTS):
+            raise ValueError(f'events must be {SSE_METRICS} or {SSE_SNAPSHOTS}')
+        if kind == SSE_METRICS and (guid or device_name):
+            raise ValueError('aggregator_guid and device_name filter events=snapshots only')
+
+        last_event_id = headers.get('Last-Event-ID') or args.get('last_event_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+        return kind, last_event_id, guid, device_name
+
     def get_aggregators(self):
         """Return all aggregators, or a single one by GUID.
         GET /aggregators
@@ -135,10 +518,7 @@ class ReadAPI:
             else:
                 aggregators = session.query(Aggregator).all()
 
-            result = [
-                DTO_Aggregator(guid=a.guid, name=a.name, devices=[]).to_dict()
-                for a in aggregators
-            ]
+            result = [{'guid': a.guid, 'name': a.name, 'devices': []} for a in aggregators]
             return {'status': 'success', 'aggregators': result}, 200
 
         except Exception as e:
@@ -147,6 +527,16 @@ class ReadAPI:
         finally:
             session.close()
 
+    def get_cache_stats(self):
+        """Return response cache size and hit/miss counters.
+        GET /cache_stats
+        """
+        return {
+            'status':       'success',
+            'invalidation': 'version-poll' if self._cache_follows_version else 'ingest-listener',
+            'cache':        self._response_cache.stats(),
+        }, 200
+
     def get_devices(self):
         """Return devices for an aggregator, optionally filtered by name.
         GET /devices?aggregator_guid=<guid>
@@ -165,11 +555,12 @@ class ReadAPI:
             if name:
                 query = query.filter(Device.name == name)
 
-            devices = query.all()
+            # Insertion order, as before the (aggregator_id, name) index existed
+            devices = query.order_by(Device.device_id).all()
             if name and not devices:
                 return {'status': 'error', 'message': f'No device "{name}" found for aggregator {aggregator_guid}'}, 404
 
-            result = [DTO_Device(name=d.name, data_snapshots=[]) for d in devices]
+            result = [{'name': d.name, 'data_snapshots': []} for d in devices]
             return {'status': 'success', 'devices': result}, 200
 
         except Exception as e:
@@ -182,15 +573,70 @@ class ReadAPI:
         """Return stored metric values, with optional filters.
         GET /metrics
         GET /metrics?guid=<guid>&device_name=<n>&utc_date_min=<Y-m-d H:M:S>&utc_date_max=<Y-m-d H:M:S>
+
+        Pagination and streaming (both optional, combinable with the filters):
+        GET /metrics?limit=<n>                  first n snapshots, oldest first,
+                                                plus "next_cursor" to continue
+        GET /metrics?limit=<n>&cursor=<c>       the n snapshots after cursor c
+        GET /metrics?format=ndjson              stream one JSON line per snapshot
+                                                in bounded memory; with limit, a
+                                                final {"next_cursor": ...} line
+
+        Cursors are opaque keyset positions on (snapshot time, snapshot id),
+        so a page costs the same however deep into the history it is.
+
+        Downsampled (answered from the rollup tables, one snapshot per bucket):
+        GET /metrics?resolution=<1m|1h|1d>&stat=<avg|min|max|sum|last|count>
+        stat defaults to avg. Bucket timestamps are the bucket start in UTC.
         """
+        fmt = request.args.get('format', 'json')
+        if fmt not in ('json', 'ndjson'):
+            return {'status': 'error', 'message': 'format must be json or ndjson'}, 400
+
+        resolution = request.args.get('resolution')
+        stat       = request.args.get('stat', 'avg')
+        if resolution is not None:
+            if resolution not in ROLLUP_RESOLUTIONS:
+                return {'status': 'error', 'message': f'resolution must be one of {", ".join(ROLLUP_RESOLUTIONS)}'}, 400
+            if stat not in ROLLUP_STATS:
+                return {'status': 'error', 'message': f'stat must be one of {", ".join(ROLLUP_STATS)}'}, 400
+            if fmt != 'json' or request.args.get('limit') or request.args.get('cursor'):
+                return {'status': 'error', 'message': 'resolution cannot be combined with limit, cursor or format=ndjson'}, 400
+
+        try:
+            limit = self._parse_limit(request.args.get('limit'))
+            after = self._decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError as e:
+            return {'status': 'error', 'message': str(e)}, 400
+
         session = Session(self.engine)
         try:
             guid         = request.args.get('guid')
             device_name  = request.args.get('device_name')
             utc_date_min = datetime.strptime(request.args['utc_date_min'], '%Y-%m-%d %H:%M:%S') if request.args.get('utc_date_min') else None
             utc_date_max = datetime.strptime(request.args['utc_date_max'], '%Y-%m-%d %H:%M:%S') if request.args.get('utc_date_max') else None
+            filters      = (guid, device_name, utc_date_min, utc_date_max)
+
+            if fmt == 'ndjson':
+                return Response(
+                    stream_with_context(self._ndjson_metrics(filters, after, limit)),
+                    mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'}
+                )
 
-            return {'status': 'success', 'aggregators': self._query_metrics(session, guid, device_name, utc_date_min, utc_date_max)}, 200
+            if resolution is not None:
+                aggregators = self._query_rollups(session, *filters, ROLLUP_RESOLUTIONS[resolution], stat)
+                return {'status': 'success', 'resolution': resolution, 'stat': stat, 'aggregators': aggregators}, 200
+
+            if limit is None and after is None:
+                return {'status': 'success', 'aggregators': self._query_metrics(session, *filters)}, 200
+
+            rows, next_key = self._query_snapshot_page(session, *filters, after, limit or METRICS_MAX_LIMIT)
+            return {
+                'status':      'success',
+                'aggregators': self._build_aggregators(row[1:] for row in rows),
+                'next_cursor': self._encode_cursor(next_key) if next_key else None,
+            }, 200
 
         except Exception as e:
             self.logger.exception("Error in get_metrics: %s", str(e))
@@ -208,6 +654,7 @@ class ReadAPI:
                 session.query(Device)
                 .join(Aggregator)
                 .filter(Aggregator.name == 'Devices')
+                .order_by(Device.device_id)
                 .all()
             )
             if not devices:
@@ -234,35 +681,13 @@ class ReadAPI:
 
         session = Session(self.engine)
         try:
-            device = (
-                session.query(Device)
-                .join(Aggregator)
-                .filter(
-                    Aggregator.name == 'Devices',
-                    Device.name == device_name
-                )
-                .first()
-            )
+            device = self._query_latest_values(session, Aggregator.name == 'Devices', device_name)
             if not device:
                 return {'status': 'error', 'message': f'No PC device "{device_name}" found'}, 404
-
-            latest_snapshot = (
-                session.query(MetricSnapshot)
-                .filter_by(device_id=device.device_id)
-                .order_by(MetricSnapshot.client_utc_timestamp_epoch.desc())
-                .first()
-            )
-            if not latest_snapshot:
+            if device.metric_values is None:
                 return {'status': 'error', 'message': f'No snapshots found for device "{device_name}"'}, 404
 
-            metric_values = (
-                session.query(MetricValue)
-                .join(DeviceMetricType)
-                .filter(MetricValue.metric_snapshot_id == latest_snapshot.metric_snapshot_id)
-                .all()
-            )
-
-            data = {mv.device_metric_type.name: mv.value for mv in metric_values}
+            data = dict(unpack_latest_values(device.metric_values))
 
             return {
                 'status': 'success',
@@ -279,9 +704,16 @@ class ReadAPI:
     def get_pokemon_info(self):
         """Return Pokémon usage counts summed across all stored snapshots.
         GET /pokemon_info?format=gen9ou&type=mons
+        GET /pokemon_info?format=gen9ou&window=24h   — only the last 24 hours (<N>h or <N>d)
         """
-        fmt  = request.args.get('format', 'gen9ou')
-        kind = request.args.get('type', 'mons')
+        fmt    = request.args.get('format', 'gen9ou')
+        kind   = request.args.get('type', 'mons')
+        window = request.args.get('window')
+        try:
+            window_secs = self._parse_window(window)
+        except ValueError as e:
+            return {'status': 'error', 'message': str(e)}, 400
+
         session = Session(self.engine)
         try:
             # Find the device matching the requested format under the PokemonShowdown aggregator
@@ -297,21 +729,33 @@ class ReadAPI:
             if not device:
                 return {'status': 'error', 'message': f'No data found for format {fmt}'}, 404
 
-            # Sum metric values across ALL snapshots for this device, grouped by metric name
-            from sqlalchemy import func
-
-            results = (
-                session.query(
-                    DeviceMetricType.name,
-                    func.sum(MetricValue.value).label('total')
+            if window_secs is not None:
+                now  = int(datetime.now(timezone.utc).timestamp())
+                data = self._windowed_usage(session, device.device_id, now - window_secs, now)
+                return {'status': 'success', 'format': fmt, 'type': kind, 'window': window, 'data': data}, 200
+
+            if self._metric_totals_ready(session):
+                # All-time totals are maintained at ingest, so this is one keyed
+                # read however many snapshots the format has accumulated
+                results = (
+                    session.query(DeviceMetricType.name, MetricTotal.total_value)
+                    .join(MetricTotal, DeviceMetricType.device_metric_type_id == MetricTotal.device_metric_type_id)
+                    .filter(MetricTotal.device_id == device.device_id)
+                    .order_by(MetricTotal.total_value.desc(), DeviceMetricType.name)
+                    .all()
+                )
+            else:
+                # Database predates migration 3: sum the raw values instead
+                total   = func.sum(MetricValue.value)
+                results = (
+                    session.query(DeviceMetricType.name, total.label('total'))
+                    .join(MetricValue, DeviceMetricType.device_metric_type_id == MetricValue.device_metric_type_id)
+                    .join(MetricSnapshot, MetricValue.metric_snapshot_id == MetricSnapshot.metric_snapshot_id)
+                    .filter(MetricSnapshot.device_id == device.device_id)
+                    .group_by(DeviceMetricType.name)
+                    .order_by(total.desc(), DeviceMetricType.name)
+                    .all()
                 )
-                .join(MetricValue, DeviceMetricType.device_metric_type_id == MetricValue.device_metric_type_id)
-                .join(MetricSnapshot, MetricValue.metric_snapshot_id == MetricSnapshot.metric_snapshot_id)
-                .filter(MetricSnapshot.device_id == device.device_id)
-                .group_by(DeviceMetricType.name)
-                .order_by(func.sum(MetricValue.value).desc())
-                .all()
-            )
 
             if not results:
                 return {'status': 'error', 'message': f'No snapshots found for format {fmt}'}, 404
@@ -326,6 +770,13 @@ class ReadAPI:
         finally:
             session.close()
 
+    def _metric_totals_ready(self, session: Session) -> bool:
+        """Whether metric_totals exists yet. Only a missing table is re-checked,
+        since migrations never drop it once created."""
+        if not self._has_metric_totals:
+            self._has_metric_totals = inspect(session.connection()).has_table('metric_totals')
+        return self._has_metric_totals
+
     def get_trainer_info(self):
         """Return a trainer's current party grouped by generation.
         GET /trainer_info?trainer=DavidM
@@ -337,40 +788,19 @@ class ReadAPI:
         session = Session(self.engine)
         try:
             # Find the device matching the trainer under the mobileapp aggregator
-            device = (
-                session.query(Device)
-                .join(Aggregator)
-                .filter(
-                    Aggregator.guid == 'b2c3d4e5-f6a7-8901-bcde-f12345678901',
-                    Device.name == trainer_name
-                )
-                .first()
+            device = self._query_latest_values(
+                session, Aggregator.guid == 'b2c3d4e5-f6a7-8901-bcde-f12345678901', trainer_name
             )
             if not device:
                 return {'status': 'error', 'message': f'No data found for trainer {trainer_name}'}, 404
-
-            # Get the most recent snapshot — party is current state, not cumulative
-            latest_snapshot = (
-                session.query(MetricSnapshot)
-                .filter_by(device_id=device.device_id)
-                .order_by(MetricSnapshot.client_utc_timestamp_epoch.desc())
-                .first()
-            )
-            if not latest_snapshot:
+            # Party is current state, not cumulative — only the newest snapshot counts
+            if device.metric_values is None:
                 return {'status': 'error', 'message': f'No snapshots found for trainer {trainer_name}'}, 404
 
-            # Pull metric values for the latest snapshot
-            metric_values = (
-                session.query(MetricValue)
-                .join(DeviceMetricType)
-                .filter(MetricValue.metric_snapshot_id == latest_snapshot.metric_snapshot_id)
-                .all()
-            )
-
             # Reconstruct { generation: [pokemon_names] } from "gen|pokemon" metric keys
             party = {}
-            for mv in metric_values:
-                parts = mv.device_metric_type.name.split('|')
+            for metric_name, _ in unpack_latest_values(device.metric_values):
+                parts = metric_name.split('|')
                 gen   = parts[0]
                 name  = parts[1] if len(parts) > 1 else 'unknown'
                 if gen not in party:
@@ -399,6 +829,7 @@ class ReadAPI:
                 session.query(Device)
                 .join(Aggregator)
                 .filter(Aggregator.guid == 'b2c3d4e5-f6a7-8901-bcde-f12345678901')
+                .order_by(Device.device_id)
                 .all()
             )
             if not devices:
@@ -498,115 +929,301 @@ class ReadAPI:
     # SSE internals
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def _sse_generator(self):
+    def _sse_generator(self, kind: str, last_event_id: int | None,
+                       guid: str | None, device_name: str | None, encoding: str | None = None):
         """Generator that drives the SSE stream for one connected client.
 
-        Uses one of two strategies to detect new data:
-
-        Event mode (both APIs in same process):
-            Calls event.wait(timeout=HEARTBEAT_INTERVAL). The event is set by
-            IngestAPI._signal_update() the moment a snapshot is committed, so
-            this wakes up and pushes to the client instantly. If nothing
-            arrives within HEARTBEAT_INTERVAL seconds, a heartbeat is sent
-            instead and the wait restarts.
-
-        Poll mode (standalone deployment, no shared event):
-            Sleeps SSE_POLL_INTERVAL seconds, then reads SystemState from the
-            database. If last_updated has changed since the last push, new
-            data is fetched and pushed. A heartbeat is sent when HEARTBEAT_INTERVAL
-            seconds pass without a push.
-
-        Yields SSE-formatted byte strings.
+        Args:
+            kind:          SSE_METRICS or SSE_SNAPSHOTS
+            last_event_id: The client's Last-Event-ID when reconnecting, so it
+                           can be sent the events it missed
+            guid:          Only send snapshots of this aggregator
+            device_name:   Only send snapshots of this device
+            encoding:      Content-Encoding of the stream, or None
+
+        Yields SSE-formatted byte strings, compressed if encoding is set.
         """
-        self.logger.info("SSE client connected (mode: %s)",
-                         "event" if self._update_event else "poll")
-        last_heartbeat = time.time()
-
+        subscriber = self.sse_subscribe(kind, last_event_id, guid, device_name, encoding=encoding)
         try:
-            if self._update_event is not None:
-                yield from self._sse_event_mode(last_heartbeat)
-            else:
-                yield from self._sse_poll_mode(last_heartbeat)
+            yield from self._sse_hub.stream(subscriber, HEARTBEAT_INTERVAL)
+            if subscriber.lagged:
+                self.logger.info("SSE client fell behind and was disconnected")
         except GeneratorExit:
             self.logger.info("SSE client disconnected")
 
-    def _sse_event_mode(self, last_heartbeat: float):
-        """SSE loop used when a shared threading.Event is available.
+    @property
+    def sse_hub(self) -> SSEHub:
+        return self._sse_hub
 
-        Waits on the event with a timeout equal to HEARTBEAT_INTERVAL. When
-        IngestAPI sets the event, this wakes immediately, fetches fresh
-        metrics, pushes them to the client, then clears the event and waits
-        again. If the timeout expires with no event, a heartbeat is sent.
+    def sse_subscribe(self, kind: str, last_event_id: int | None, guid: str | None,
+                      device_name: str | None, waker=None, encoding: str | None = None):
+        """Subscribe one SSE client to the shared SSEHub.
+
+        The client is sent whatever the producer thread publishes for its
+        kind and filters. It never queries the database itself, so the cost
+        of an update does not grow with the number of clients. A 'metrics'
+        client that connects when no current full-state event exists has one
+        built for it first, so this may block on the database.
 
         Args:
-            last_heartbeat: epoch time of the last heartbeat, used to track
-                            the 15-second keepalive interval on first entry
-        """
-        while True:
-            triggered = self._update_event.wait(timeout=HEARTBEAT_INTERVAL)
+            kind:          SSE_METRICS or SSE_SNAPSHOTS
+            last_event_id: The client's Last-Event-ID, if reconnecting
+            guid:          Only send snapshots of this aggregator
+            device_name:   Only send snapshots of this device
+            waker:         Passed to SSEHub.subscribe() for asyncio clients
+            encoding:      Content-Encoding to send the stream in, or None
 
-            if triggered:
-                # IngestAPI committed new data — clear the flag and push
-                self._update_event.clear()
+        Returns:
+            The hub Subscriber; iterate it with SSEHub.stream() or astream().
+        """
+        self._ensure_sse_producer()
+        subscriber = self._sse_hub.subscribe(kind, last_event_id, guid, device_name, waker, encoding)
+        if subscriber.needs_snapshot and kind == SSE_METRICS:
+            self._publish_metrics(only_if_missing=True)
+        self.logger.info("SSE client connected (mode: %s, events: %s, resume: %s, encoding: %s)",
+                         "listener" if self._change_listener else "event", kind, last_event_id,
+                         encoding or 'identity')
+        return subscriber
+
+    def _ensure_sse_producer(self):
+        """Start the SSE producer thread on first use.
+
+        The delta position is taken here, before the first client subscribes,
+        so snapshots committed after that are never folded into the starting
+        point unseen.
+        """
+        with self._sse_lock:
+            if self._sse_producer is None:
+                if self._update_event is None:
+                    self._start_change_listener()
+                session = Session(self.engine)
                 try:
-                    yield self._sse_event('metrics', self._latest_metrics_payload())
-                    self.logger.debug("SSE metrics event sent (event mode)")
-                except Exception as e:
-                    self.logger.exception("SSE failed to fetch metrics: %s", str(e))
-                    yield self._sse_event('error', {'message': str(e)})
-            else:
-                # Timeout — no new data, send keepalive
-                yield self._sse_event('heartbeat', {})
-                self.logger.debug("SSE heartbeat sent")
+                    self._sse_after_snapshot_id = self._max_snapshot_id(session)
+                finally:
+                    session.close()
+                self._sse_producer = threading.Thread(
+                    target=self._sse_produce, name='SSEProducer', daemon=True
+                )
+                self._sse_producer.start()
+
+    def _start_change_listener(self):
+        """Standalone mode: start this process's ChangeListener and use its
+        event as the update event, so the producer works exactly as it does
+        next to an in-process IngestAPI."""
+        if self.config.database.connection_string.startswith('sqlite'):
+            # One dedicated connection, held for the life of the process:
+            # data_version only moves for commits made by other connections
+            connection = self.engine.raw_connection()
+            probe      = lambda: connection.cursor().execute("PRAGMA data_version").fetchone()[0]
+        else:
+            probe = self._get_data_version
+        self._change_listener = ChangeListener(default_notify_dir(self.config), probe)
+        self._change_listener.start()
+        self._update_event = self._change_listener.event
+
+    def _sse_produce(self):
+        """Producer thread — publish events whenever data changes.
+
+        Waits on the update event: the shared one IngestAPI._signal_update()
+        sets when both APIs run in one process, or the ChangeListener's when
+        standalone. This thread is the event's only consumer, so clearing it
+        can never make a client miss an update.
+        """
+        while True:
+            if not self._update_event.wait(timeout=HEARTBEAT_INTERVAL):
+                continue
+            self._update_event.clear()
+            self._publish_snapshots()
+            self._publish_metrics()
 
-    def _sse_poll_mode(self, last_heartbeat: float):
-        """SSE loop used when no threading.Event is available (standalone).
+    def _publish_metrics(self, only_if_missing: bool = False):
+        """Build the full metrics payload once and publish it to every
+        'metrics' client.
 
-        Polls SystemState.last_updated every SSE_POLL_INTERVAL seconds. Pushes
-        a metrics event when the value changes, and a heartbeat event when
-        HEARTBEAT_INTERVAL seconds pass without a push.
+        With no such client connected the build is skipped and the hub told
+        so; the next one to connect asks for a fresh payload.
 
         Args:
-            last_heartbeat: epoch time of the last heartbeat sent
+            only_if_missing: Only build if the hub has no full-state event,
+                             e.g. for a client connecting before any update
         """
-        last_seen_ts = None
+        with self._sse_build_lock:
+            if only_if_missing and self._sse_hub.has_snapshot(SSE_METRICS):
+                return
+            if not only_if_missing and self._sse_hub.subscriber_count(SSE_METRICS) == 0:
+                self._sse_hub.skip(SSE_METRICS)
+                return
+            try:
+                payload = self._sse_json(self._latest_metrics_payload())
+                self._sse_hub.publish(SSE_METRICS, payload, topic=(SSE_METRICS, None, None), snapshot=True)
+                self.logger.debug("SSE metrics event published to %d client(s)",
+                                  self._sse_hub.subscriber_count(SSE_METRICS))
+            except Exception as e:
+                self.logger.exception("SSE failed to fetch metrics: %s", str(e))
+                self._sse_hub.publish('error', self._sse_json({'message': str(e)}))
+
+    def _publish_snapshots(self):
+        """Publish the snapshots committed since the last call as delta events.
+
+        Reads only snapshots with an id above the last one published (ids are
+        assigned in commit order because SQLite has a single writer), so the
+        cost is proportional to the new data. One 'snapshots' event is
+        published per device, letting the hub route it to clients filtered on
+        that aggregator or device without re-serialising.
+
+        With no 'snapshots' client connected, only the position is advanced.
+        """
+        with self._sse_build_lock:
+            session = Session(self.engine)
+            try:
+                if self._sse_hub.subscriber_count(SSE_SNAPSHOTS) == 0:
+                    latest = self._max_snapshot_id(session)
+                    if latest != self._sse_after_snapshot_id:
+                        self._sse_hub.skip(SSE_SNAPSHOTS)
+                    self._sse_after_snapshot_id = latest
+                    return
+
+                while True:
+                    rows = self._query_new_snapshots(session, self._sse_after_snapshot_id, METRICS_PAGE_SIZE)
+                    if not rows:
+                        break
+                    for (agg_guid, dev_name), payload in self._group_snapshot_rows(rows).items():
+                        self._sse_hub.publish(SSE_SNAPSHOTS, self._sse_json(payload),
+                                              topic=(SSE_SNAPSHOTS, agg_guid, dev_name))
+                    self._sse_after_snapshot_id = rows[-1][0]
+            except Exception as e:
+                self.logger.exception("SSE failed to fetch new snapshots: %s", str(e))
+                self._sse_hub.publish('error', self._sse_json({'message': str(e)}))
+            finally:
+                session.close()
+
+    def _query_new_snapshots(self, session, after_id: int, limit: int) -> list:
+        """Fetch up to `limit` snapshots with an id above after_id, with their
+        metric values, in id order.
+
+        With partitioned storage only the partitions holding ids above
+        after_id are read, each up to `limit` snapshots, and the results are
+        cut back to the first `limit` ids overall.
 
-        while True:
-            time.sleep(SSE_POLL_INTERVAL)
-            current_ts = self._get_last_updated()
+        Returns:
+            (snapshot id, guid, aggregator name, device name, epoch, tz mins,
+            metric name, value) rows, as _query_snapshot_page.
+        """
+        snapshot_ids, parts = [], []
+        for _ in self._each_partition(session, self._partition_keys(session, after_id=after_id)):
+            ids = [
+                snapshot_id for (snapshot_id,) in
+                session.query(MetricSnapshot.metric_snapshot_id)
+                .filter(MetricSnapshot.metric_snapshot_id > after_id)
+                .order_by(MetricSnapshot.metric_snapshot_id)
+                .limit(limit)
+            ]
+            if not ids:
+                continue
+            snapshot_ids += ids
+            parts.append(list(self._merge_value_rows(
+                session,
+                self._metric_rows_query(session, MetricSnapshot.metric_snapshot_id)
+                .filter(MetricValue.metric_snapshot_id.in_(ids))
+                .order_by(MetricSnapshot.metric_snapshot_id, literal_column('metric_values.rowid'))
+                .all(),
+                self._packed_rows_query(session, MetricSnapshot.metric_snapshot_id)
+                .filter(PackedMetricValues.metric_snapshot_id.in_(ids))
+                .order_by(MetricSnapshot.metric_snapshot_id)
+                .all(),
+                self._chunked_rows(
+                    session, self._snapshot_query(session).filter(MetricSnapshot.metric_snapshot_id.in_(ids))
+                ),
+                key=lambda row: row[0]
+            )))
+        if not snapshot_ids:
+            return []
+        if len(parts) == 1:
+            last_id, rows = snapshot_ids[-1], parts[0]
+        else:
+            last_id = heapq.nsmallest(limit, snapshot_ids)[-1]
+            rows    = [row for row in heapq.merge(*parts, key=lambda row: row[0]) if row[0] <= last_id]
+        # Snapshots without values have no rows; still move past them
+        if not rows or rows[-1][0] != last_id:
+            rows.append((last_id,) + (None,) * 7)
+        return rows
 
-            if current_ts != last_seen_ts:
-                last_seen_ts   = current_ts
-                last_heartbeat = time.time()
-                try:
-                    yield self._sse_event('metrics', self._latest_metrics_payload())
-                    self.logger.debug("SSE metrics event sent (poll mode)")
-                except Exception as e:
-                    self.logger.exception("SSE failed to fetch metrics: %s", str(e))
-                    yield self._sse_event('error', {'message': str(e)})
+    @staticmethod
+    def _group_snapshot_rows(rows) -> dict:
+        """Group _query_new_snapshots rows into one delta payload per device.
 
-            elif time.time() - last_heartbeat >= HEARTBEAT_INTERVAL:
-                last_heartbeat = time.time()
-                yield self._sse_event('heartbeat', {})
-                self.logger.debug("SSE heartbeat sent")
+        Returns:
+            {(guid, device name): {'aggregator': {...}, 'device': ...,
+            'snapshots': [{'timestamp_utc', 'timezone_mins', 'metrics'}]}}
+        """
+        payloads   = {}
+        current_id = None
+        for snapshot_id, agg_guid, agg_name, dev_name, epoch, tz_mins, metric_name, value in rows:
+            if agg_guid is None:
+                continue
+            if snapshot_id != current_id:
+                current_id = snapshot_id
+                payload = payloads.get((agg_guid, dev_name))
+                if payload is None:
+                    payload = payloads[(agg_guid, dev_name)] = {
+                        'aggregator': {'guid': agg_guid, 'name': agg_name},
+                        'device':     dev_name,
+                        'snapshots':  [],
+                    }
+                snapshot = {
+                    'timestamp_utc': datetime.fromtimestamp(epoch),
+                    'timezone_mins': tz_mins,
+                    'metrics':       [],
+                }
+                payload['snapshots'].append(snapshot)
+            snapshot['metrics'].append({'name': metric_name, 'value': value})
+        return payloads
+
+    def _get_data_version(self) -> tuple[int, int] | None:
+        """Read (SystemState.version, SystemState.last_updated), or None if
+        no snapshots have been ingested yet."""
+        session = Session(self.engine)
+        try:
+            return session.query(SystemState.version, SystemState.last_updated).filter_by(id=1).first()
+        finally:
+            session.close()
 
-    def _get_last_updated(self) -> int | None:
-        """Read SystemState.last_updated from the database.
+    def _pc_device_etag(self, version: int) -> str | None:
+        """ETag for /pc_device_info that only changes with that device's latest snapshot."""
+        return self._latest_snapshot_etag(Aggregator.name == 'Devices', request.args.get('device'))
 
-        Opens a fresh session each call so SQLAlchemy's cache never returns a
-        stale value from a previous read in this process.
+    def _trainer_etag(self, version: int) -> str | None:
+        """ETag for /trainer_info that only changes with that trainer's latest snapshot."""
+        return self._latest_snapshot_etag(
+            Aggregator.guid == 'b2c3d4e5-f6a7-8901-bcde-f12345678901', request.args.get('trainer')
+        )
 
-        Returns:
-            The epoch timestamp as an int, or None if no snapshots have been
-            ingested yet.
-        """
+    def _latest_snapshot_etag(self, aggregator_filter, device_name: str | None) -> str | None:
+        """ETag built from a device's id and its latest snapshot id, or None
+        if the device or its snapshots do not exist (the handler reports it)."""
+        if not device_name:
+            return None
         session = Session(self.engine)
         try:
-            state = session.query(SystemState).filter_by(id=1).first()
-            return state.last_updated if state else None
+            row = (
+                session.query(Device.device_id, DeviceLatestValues.metric_snapshot_id)
+                .join(Aggregator)
+                .join(DeviceLatestValues, Device.device_id == DeviceLatestValues.device_id)
+                .filter(aggregator_filter, Device.name == device_name)
+                .first()
+            )
+            return f'd{row.device_id}-s{row.metric_snapshot_id}' if row else None
         finally:
             session.close()
 
+    @staticmethod
+    def _pokemon_info_etag(version: int) -> str:
+        """ETag for /pokemon_info. A window= result also changes as time moves
+        on without any ingest, so those include the current hour as well."""
+        if request.args.get('window'):
+            return f'v{version}-h{int(time.time()) // 3600}'
+        return f'v{version}'
+
     def _latest_metrics_payload(self) -> dict:
         """Fetch all current metrics from the database and return them as a
         plain dict for JSON serialisation in an SSE event.
@@ -623,26 +1240,10 @@ class ReadAPI:
         finally:
             session.close()
 
-    @staticmethod
-    def _sse_event(event_name: str, data: dict) -> bytes:
-        """Format a dict as a single SSE event and return it as UTF-8 bytes.
-
-        SSE wire format (each field on its own line, blank line terminates):
-            event: <name>\\n
-            data: <json>\\n
-            \\n
-
-        The trailing blank line is mandatory — without it the browser will not
-        fire the event.
-
-        Args:
-            event_name: Event type string seen by the frontend listener
-            data:       Dict to serialise as the event payload
-
-        Returns:
-            UTF-8 encoded bytes ready to yield from the generator
-        """
-        return f"event: {event_name}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+    def _sse_json(self, data: dict) -> bytes:
+        """Serialise an SSE payload with Flask's JSON provider, which knows
+        how to encode the datetimes in it."""
+        return self.webserver.json.dumps(data, separators=(',', ':')).encode('utf-8')
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Shared query helper
@@ -650,9 +1251,16 @@ class ReadAPI:
 
     def _query_metrics(self, session, guid, device_name, utc_date_min, utc_date_max) -> list:
         """Build and execute a metrics query, returning a list of DTO_Aggregator
-        dicts. Shared between get_metrics() and the SSE push so both always
+        shaped dicts. Shared between get_metrics() and the SSE push so both always
         return data in the same shape.
 
+        Fetches every column it needs in one joined query, ordered the way
+        the rows were ingested, and builds the nested aggregator → device →
+        snapshot shape in a single pass (see _build_aggregators) — no
+        per-row queries or lazy loads. With partitioned storage each
+        partition overlapping the date range is read in turn and the rows
+        merged back into snapshot id order.
+
         Args:
             session:      Active SQLAlchemy session
             guid:         Filter by aggregator GUID, or None for all
@@ -660,61 +1268,592 @@ class ReadAPI:
             utc_date_min: Earliest timestamp to include, or None
             utc_date_max: Latest timestamp to include, or None
         """
+        filters = (guid, device_name, utc_date_min, utc_date_max)
+        if self._partitions is not None:
+            keys  = self._partition_keys(session, *self._epoch_range(utc_date_min, utc_date_max))
+            parts = [list(self._id_value_rows(session, filters)) for _ in self._each_partition(session, keys)]
+            rows  = heapq.merge(*parts, key=lambda row: row[0])
+            return self._build_aggregators(row[1:] for row in rows)
+
+        packed  = self._filtered_packed_rows(session, filters)
+        chunked = self._chunked_rows(session, self._filter_metrics(self._snapshot_query(session), *filters))
+
+        # Insertion order: snapshots in id order, metrics in the order the
+        # agent sent them (metric_values rowid)
+        if not packed and not chunked:
+            query = self._filter_metrics(self._metric_rows_query(session), *filters)
+            return self._build_aggregators(
+                query.order_by(MetricValue.metric_snapshot_id, literal_column('metric_values.rowid'))
+            )
+        return self._build_aggregators(row[1:] for row in self._id_value_rows(session, filters, packed, chunked))
+
+    def _id_value_rows(self, session, filters: tuple, packed: list | None = None, chunked: list | None = None):
+        """The rows behind _query_metrics, each preceded by its snapshot id,
+        in snapshot id order.
+
+        Args:
+            session: Active SQLAlchemy session
+            filters: (guid, device_name, utc_date_min, utc_date_max)
+            packed:  Packed rows already fetched for filters, if any
+            chunked: Chunked rows already fetched for filters, if any
+        """
+        if packed is None:
+            packed = self._filtered_packed_rows(session, filters)
+        if chunked is None:
+            chunked = self._chunked_rows(session, self._filter_metrics(self._snapshot_query(session), *filters))
+        query = (
+            self._filter_metrics(self._metric_rows_query(session, MetricValue.metric_snapshot_id), *filters)
+            .order_by(MetricValue.metric_snapshot_id, literal_column('metric_values.rowid'))
+        )
+        return self._merge_value_rows(session, query, packed, chunked, key=lambda row: row[0])
+
+    def _filtered_packed_rows(self, session, filters: tuple) -> list:
+        return (
+            self._filter_metrics(self._packed_rows_query(session, MetricSnapshot.metric_snapshot_id), *filters)
+            .order_by(MetricSnapshot.metric_snapshot_id)
+            .all()
+        )
+
+    def _query_snapshot_page(self, session, guid, device_name, utc_date_min, utc_date_max,
+                             after: tuple[int, int] | None, limit: int) -> tuple[list, tuple[int, int] | None]:
+        """Fetch one keyset page of snapshots, oldest first.
+
+        Two queries: the first picks the next `limit` snapshot ids after the
+        (epoch, snapshot id) position `after` using the
+        (device_id, client_utc_timestamp_epoch) index; the second fetches
+        their metric values. With partitioned storage the first runs on the
+        partitions in time order until later ones cannot contribute, and the
+        second on each partition the page draws from.
+
+        Args:
+            session:     Active SQLAlchemy session
+            guid, device_name, utc_date_min, utc_date_max: As _query_metrics
+            after:       (epoch, snapshot id) to continue after, or None
+            limit:       Maximum number of snapshots in the page
+
+        Returns:
+            (rows, next_key) where rows are (snapshot id, guid, aggregator
+            name, device name, epoch, tz mins, metric name, value) tuples in
+            page order, and next_key is the position to pass as `after` for
+            the next page, or None if this was the last page.
+        """
+        epoch_col = MetricSnapshot.client_utc_timestamp_epoch
+        id_col    = MetricSnapshot.metric_snapshot_id
+
+        page = []   # (epoch, snapshot id, partition key)
+        keys = self._partition_keys(session, *self._epoch_range(utc_date_min, utc_date_max))
+        for key in self._each_partition(session, keys):
+            # Partitions are disjoint in time and come oldest first (after
+            # the main database), so one starting after a full page is done
+            if key is not None and len(page) == limit and page[-1][0] < self._partitions.bounds(key)[0]:
+                break
+            snapshot_query = self._filter_metrics(
+                self._snapshot_query(session).with_entities(id_col, epoch_col),
+                guid, device_name, utc_date_min, utc_date_max
+            )
+            if after:
+                after_epoch, after_id = after
+                snapshot_query = snapshot_query.filter(
+                    or_(epoch_col > after_epoch, and_(epoch_col == after_epoch, id_col > after_id))
+                )
+            found = snapshot_query.order_by(epoch_col, id_col).limit(limit).all()
+            page  = sorted(page + [(epoch, snapshot_id, key) for snapshot_id, epoch in found])[:limit]
+        if not page:
+            return [], None
+
+        page_ids = {}
+        for _, snapshot_id, key in page:
+            page_ids.setdefault(key, []).append(snapshot_id)
+        parts = [
+            list(self._merge_value_rows(
+                session,
+                self._metric_rows_query(session, MetricSnapshot.metric_snapshot_id)
+                .filter(MetricValue.metric_snapshot_id.in_(page_ids[key]))
+                .order_by(epoch_col, id_col, literal_column('metric_values.rowid'))
+                .all(),
+                self._packed_rows_query(session, MetricSnapshot.metric_snapshot_id)
+                .filter(PackedMetricValues.metric_snapshot_id.in_(page_ids[key]))
+                .order_by(epoch_col, id_col)
+                .all(),
+                self._chunked_rows(session, self._snapshot_query(session).filter(id_col.in_(page_ids[key]))),
+                key=lambda row: (row[4], row[0])
+            ))
+            for key in self._each_partition(session, list(page_ids))
+        ]
+        rows = parts[0] if len(parts) == 1 else list(heapq.merge(*parts, key=lambda row: (row[4], row[0])))
+        last_epoch, last_id, _ = page[-1]
+        return rows, ((last_epoch, last_id) if len(page) == limit else None)
+
+    def _ndjson_metrics(self, filters: tuple, after: tuple[int, int] | None, limit: int | None):
+        """Generator behind GET /metrics?format=ndjson.
+
+        Walks the matching snapshots in keyset pages of METRICS_PAGE_SIZE,
+        each with its own short-lived session, and yields one JSON line per
+        snapshot as soon as its page is read — so memory use and time to
+        first byte do not depend on the size of the result. When `limit` is
+        set, stops after that many snapshots and yields a final
+        {"next_cursor": ...} line (null when there is nothing more).
+
+        Args:
+            filters: (guid, device_name, utc_date_min, utc_date_max)
+            after:   Keyset position to start after, or None
+            limit:   Maximum number of snapshots to stream, or None for all
+        """
+        dumps     = functools.partial(self.webserver.json.dumps, separators=(',', ':'))
+        remaining = limit
+        try:
+            while True:
+                page_size = METRICS_PAGE_SIZE if remaining is None else min(METRICS_PAGE_SIZE, remaining)
+                session   = Session(self.engine)
+                try:
+                    rows, next_key = self._query_snapshot_page(session, *filters, after, page_size)
+                finally:
+                    session.close()
+
+                current_id, line = None, None
+                for snapshot_id, agg_guid, agg_name, dev_name, epoch, tz_mins, metric_name, value in rows:
+                    if snapshot_id != current_id:
+                        if line is not None:
+                            yield dumps(line) + '\n'
+                        current_id = snapshot_id
+                        line = {
+                            'aggregator':    {'guid': agg_guid, 'name': agg_name},
+                            'device':        dev_name,
+                            'timestamp_utc': datetime.fromtimestamp(epoch),
+                            'timezone_mins': tz_mins,
+                            'metrics':       [],
+                        }
+                    line['metrics'].append({'name': metric_name, 'value': value})
+                if line is not None:
+                    yield dumps(line) + '\n'
+
+                after = next_key
+                if remaining is not None:
+                    remaining -= page_size
+                if next_key is None or (remaining is not None and remaining <= 0):
+                    break
+
+            if limit is not None:
+                yield dumps({'next_cursor': self._encode_cursor(after) if after else None}) + '\n'
+
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            self.logger.exception("Error streaming metrics: %s", str(e))
+            yield dumps({'status': 'error', 'message': str(e)}) + '\n'
+
+    def _query_rollups(self, session, guid, device_name, utc_date_min, utc_date_max,
+                       resolution_secs: int, stat: str) -> list:
+        """Answer a downsampled /metrics request from metric_rollups.
+
+        Returns the same DTO_Aggregator shape as _query_metrics, with one
+        snapshot per bucket whose metric values are the requested statistic.
+        The date filters select buckets by their start time.
+
+        Args:
+            session:          Active SQLAlchemy session
+            guid, device_name, utc_date_min, utc_date_max: As _query_metrics
+            resolution_secs:  Bucket width, one of ROLLUP_RESOLUTIONS' values
+            stat:             Key of ROLLUP_STATS
+        """
         query = (
-            session.query(MetricValue)
-            .join(MetricSnapshot, MetricValue.metric_snapshot_id == MetricSnapshot.metric_snapshot_id)
-            .join(Device,         MetricSnapshot.device_id        == Device.device_id)
-            .join(Aggregator,     Device.aggregator_id            == Aggregator.aggregator_id)
+            session.query(
+                Aggregator.guid,
+                Aggregator.name,
+                Device.name,
+                MetricRollup.bucket_start_epoch,
+                literal_column('0'),
+                DeviceMetricType.name,
+                ROLLUP_STATS[stat],
+            )
+            .select_from(MetricRollup)
+            .join(DeviceMetricType, MetricRollup.device_metric_type_id == DeviceMetricType.device_metric_type_id)
+            .join(Device,           MetricRollup.device_id             == Device.device_id)
+            .join(Aggregator,       Device.aggregator_id               == Aggregator.aggregator_id)
+            .filter(MetricRollup.resolution_secs == resolution_secs)
         )
         if guid:
             query = query.filter(Aggregator.guid == guid)
         if device_name:
             query = query.filter(Device.name == device_name)
         if utc_date_min:
-            query = query.filter(MetricSnapshot.client_utc_timestamp_epoch >= int(utc_date_min.timestamp()))
+            query = query.filter(MetricRollup.bucket_start_epoch >= int(utc_date_min.timestamp()))
         if utc_date_max:
-            query = query.filter(MetricSnapshot.client_utc_timestamp_epoch <= int(utc_date_max.timestamp()))
+            query = query.filter(MetricRollup.bucket_start_epoch <= int(utc_date_max.timestamp()))
+
+        query = query.order_by(
+            MetricRollup.bucket_start_epoch, MetricRollup.device_id, MetricRollup.device_metric_type_id
+        )
+        return self._build_aggregators(query)
+
+    @staticmethod
+    def _query_latest_values(session, aggregator_filter, device_name: str):
+        """Look up a device and its packed latest values in one query.
+
+        Returns:
+            A row with .device_id and .metric_values (None if the device has
+            no snapshots yet), or None if no such device exists.
+        """
+        return (
+            session.query(Device.device_id, DeviceLatestValues.metric_values)
+            .join(Aggregator)
+            .outerjoin(DeviceLatestValues, Device.device_id == DeviceLatestValues.device_id)
+            .filter(aggregator_filter, Device.name == device_name)
+            .first()
+        )
+
+    @staticmethod
+    def _windowed_usage(session, device_id: int, start_epoch: int, end_epoch: int) -> dict:
+        """Sum a device's metrics over a time window from the 1h/1d rollups.
 
-        aggregator_dtos = {}
-        for mv in query.all():
-            device     = session.query(Device).filter_by(device_id=mv.device_metric_type.device_id).first()
-            aggregator = session.query(Aggregator).filter_by(aggregator_id=device.aggregator_id).first()
+        Returns:
+            {metric name: int total}, largest first. Empty if nothing was
+            collected in the window.
+        """
+        total   = func.sum(MetricRollup.sum_value)
+        results = (
+            session.query(DeviceMetricType.name, total)
+            .join(MetricRollup, DeviceMetricType.device_metric_type_id == MetricRollup.device_metric_type_id)
+            .filter(MetricRollup.device_id == device_id)
+            .filter(rollup_window_condition(start_epoch, end_epoch))
+            .group_by(DeviceMetricType.name)
+            .order_by(total.desc(), DeviceMetricType.name)
+            .all()
+        )
+        return {name: int(value) for name, value in results}
 
-            agg_dto = aggregator_dtos.setdefault(
-                aggregator.guid,
-                DTO_Aggregator(guid=aggregator.guid, name=aggregator.name, devices=[])
+    @staticmethod
+    def _parse_window(raw: str | None) -> int | None:
+        """Parse a /pokemon_info window such as '24h' or '7d' into seconds.
+
+        Raises:
+            ValueError: If the value is not a positive number of hours or days.
+        """
+        if raw is None:
+            return None
+        match = WINDOW_PATTERN.fullmatch(raw)
+        if not match or int(match.group(1)) <= 0:
+            raise ValueError('window must be a positive number of hours or days, e.g. 24h or 7d')
+        return int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+
+    def _partition_keys(self, session, start_epoch: int | None = None, end_epoch: int | None = None,
+                        after_id: int | None = None) -> list[str | None]:
+        """Partitions a read has to visit, in time order (see
+        PartitionStore.select); just [None], the main database, when
+        partitioning is off."""
+        if self._partitions is None:
+            return [None]
+        return self._partitions.select(session, start_epoch, end_epoch, after_id)
+
+    def _each_partition(self, session, keys: list[str | None]):
+        """Point the partitioned tables at each of keys in turn, attaching
+        it first if needed, yielding the key; back at the main database when
+        done."""
+        if self._partitions is None:
+            yield from keys
+            return
+        try:
+            for key in keys:
+                self._partitions.read(session, key)
+                yield key
+        finally:
+            self._partitions.use(session, None)
+
+    def _max_snapshot_id(self, session) -> int:
+        """Highest snapshot id stored, in the main database or any partition."""
+        latest = session.query(func.max(MetricSnapshot.metric_snapshot_id)).scalar() or 0
+        if self._partitions is not None:
+            latest = max([latest] + [partition.max_snapshot_id for partition in self._partitions.live(session)])
+        return latest
+
+    @staticmethod
+    def _epoch_range(utc_date_min: datetime | None, utc_date_max: datetime | None) -> tuple[int | None, int | None]:
+        """The /metrics date filters as epochs, the way _filter_metrics applies them."""
+        return (int(utc_date_min.timestamp()) if utc_date_min else None,
+                int(utc_date_max.timestamp()) if utc_date_max else None)
+
+    @staticmethod
+    def _metric_rows_query(session, *leading_columns):
+        """Joined query returning one (guid, aggregator name, device name,
+        epoch, tz mins, metric name, value) row per metric_values row,
+        optionally preceded by leading_columns.
+
+        Only covers snapshots stored in the rows value layout; see
+        _packed_rows_query for the others."""
+        return (
+            session.query(
+                *leading_columns,
+                Aggregator.guid,
+                Aggregator.name,
+                Device.name,
+                MetricSnapshot.client_utc_timestamp_epoch,
+                MetricSnapshot.client_timezone_mins,
+                DeviceMetricType.name,
+                MetricValue.value,
             )
-            dev_dto = next((d for d in agg_dto.devices if d.name == device.name), None)
-            if not dev_dto:
-                dev_dto = DTO_Device(name=device.name, data_snapshots=[])
-                agg_dto.devices.append(dev_dto)
-
-            snapshot_ts = datetime.fromtimestamp(mv.metric_snapshot.client_utc_timestamp_epoch)
-            ds_dto = next(
-                (ds for ds in dev_dto.data_snapshots
-                 if ds.timestamp_utc == snapshot_ts
-                 and ds.timezone_mins == mv.metric_snapshot.client_timezone_mins),
-                None
+            .select_from(MetricValue)
+            .join(MetricSnapshot,   MetricValue.metric_snapshot_id    == MetricSnapshot.metric_snapshot_id)
+            .join(DeviceMetricType, MetricValue.device_metric_type_id == DeviceMetricType.device_metric_type_id)
+            .join(Device,           MetricSnapshot.device_id          == Device.device_id)
+            .join(Aggregator,       Device.aggregator_id              == Aggregator.aggregator_id)
+        )
+
+    @staticmethod
+    def _packed_rows_query(session, *leading_columns):
+        """Joined query returning one (guid, aggregator name, device name,
+        epoch, tz mins, layout id, packed values) row per snapshot stored in
+        the packed value layout (see packed_values.py), optionally preceded
+        by leading_columns."""
+        return (
+            session.query(
+                *leading_columns,
+                Aggregator.guid,
+                Aggregator.name,
+                Device.name,
+                MetricSnapshot.client_utc_timestamp_epoch,
+                MetricSnapshot.client_timezone_mins,
+                PackedMetricValues.layout_id,
+                PackedMetricValues.metric_values,
             )
-            if not ds_dto:
-                ds_dto = DTO_DataSnapshot(
-                    timestamp_utc=snapshot_ts,
-                    timezone_mins=mv.metric_snapshot.client_timezone_mins,
-                    metrics=[]
-                )
-                dev_dto.data_snapshots.append(ds_dto)
+            .select_from(PackedMetricValues)
+            .join(MetricSnapshot, PackedMetricValues.metric_snapshot_id == MetricSnapshot.metric_snapshot_id)
+            .join(Device,         MetricSnapshot.device_id              == Device.device_id)
+            .join(Aggregator,     Device.aggregator_id                  == Aggregator.aggregator_id)
+        )
 
-            ds_dto.metrics.append(DTO_Metric(name=mv.device_metric_type.name, value=mv.value))
+    @staticmethod
+    def _snapshot_query(session):
+        """Query over MetricSnapshot joined to Device and Aggregator, ready
+        for _filter_metrics."""
+        return (
+            session.query(MetricSnapshot)
+            .join(Device,     MetricSnapshot.device_id == Device.device_id)
+            .join(Aggregator, Device.aggregator_id     == Aggregator.aggregator_id)
+        )
 
-        return list(aggregator_dtos.values())
+    @staticmethod
+    def _chunked_rows(session, snapshot_query) -> list:
+        """Fetch the values of snapshots stored in the chunked value layout.
+
+        Only devices that have chunks are considered, and only the chunks
+        overlapping the selected snapshots' time range are decoded (see
+        series_chunks.py). Each snapshot picks up the samples at its
+        timestamp; when several snapshots of a device share a timestamp,
+        each takes the samples tagged with its id (the first one the
+        untagged samples), whichever of them were selected.
+
+        Args:
+            session:        Active SQLAlchemy session
+            snapshot_query: A _snapshot_query, filtered to the snapshots wanted
+
+        Returns:
+            (snapshot id, guid, aggregator name, device name, epoch, tz mins,
+            metric name, value) rows in snapshot id order, each snapshot's
+            metrics in metric type order. Empty if nothing is chunked.
+        """
+        if session.query(MetricChunk.device_id).first() is None:
+            return []
+        headers = (
+            snapshot_query.with_entities(
+                MetricSnapshot.metric_snapshot_id,
+                MetricSnapshot.device_id,
+                Aggregator.guid,
+                Aggregator.name,
+                Device.name,
+                MetricSnapshot.client_utc_timestamp_epoch,
+                MetricSnapshot.client_timezone_mins,
+            )
+            .filter(MetricSnapshot.device_id.in_(select(MetricChunk.device_id).distinct()))
+            .order_by(MetricSnapshot.metric_snapshot_id)
+            .all()
+        )
+        if not headers:
+            return []
+
+        device_ids = {header[1] for header in headers}
+        epochs     = [header[5] for header in headers]
+        samples    = read_samples(session, device_ids, min(epochs), max(epochs))
+        if not samples:
+            return []
+        shared     = shared_epochs(session, device_ids, min(epochs), max(epochs))
+        type_names = dict(
+            session.query(DeviceMetricType.device_metric_type_id, DeviceMetricType.name)
+            .filter(DeviceMetricType.device_id.in_(device_ids))
+        )
+
+        rows = []
+        for snapshot_id, device_id, agg_guid, agg_name, dev_name, epoch, tz_mins in headers:
+            for type_id, value in snapshot_values(samples, shared, snapshot_id, device_id, epoch):
+                rows.append((snapshot_id, agg_guid, agg_name, dev_name, epoch, tz_mins, type_names[type_id], value))
+        return rows
+
+    @staticmethod
+    def _merge_value_rows(session, rows, packed_rows: list, chunked_rows: list, key):
+        """Combine _metric_rows_query rows with _packed_rows_query rows
+        expanded to one row per metric and _chunked_rows rows, in the order
+        given by key.
+
+        Each snapshot is stored in exactly one layout, and key orders by
+        snapshot, so a stable merge keeps every snapshot's metrics together
+        and in the order its layout returns them. With no packed or chunked
+        rows, rows is returned untouched.
+        """
+        others = []
+        if packed_rows:
+            others.append(expand_rows(session, packed_rows))
+        if chunked_rows:
+            others.append(sorted(chunked_rows, key=key))
+        if not others:
+            return rows
+        return heapq.merge(rows, *others, key=key)
+
+    @staticmethod
+    def _filter_metrics(query, guid, device_name, utc_date_min, utc_date_max):
+        """Apply the /metrics filters to a query that joins MetricSnapshot,
+        Device and Aggregator."""
+        if guid:
+            query = query.filter(Aggregator.guid == guid)
+        if device_name:
+            query = query.filter(Device.name == device_name)
+        if utc_date_min:
+            query = query.filter(MetricSnapshot.client_utc_timestamp_epoch >= int(utc_date_min.timestamp()))
+        if utc_date_max:
+            query = query.filter(MetricSnapshot.client_utc_timestamp_epoch <= int(utc_date_max.timestamp()))
+        return query
+
+    @staticmethod
+    def _build_aggregators(rows) -> list:
+        """Group (guid, aggregator name, device name, epoch, tz mins, metric
+        name, value) rows into the DTO_Aggregator → DTO_Device →
+        DTO_DataSnapshot shape in a single pass, preserving first-seen order
+        at every level.
+
+        The result is built from plain dicts and lists, not DTO instances,
+        so serialising it never goes through dataclasses.asdict(); timestamps
+        are formatted the way Flask formats datetimes, once per distinct
+        epoch.
+
+        Snapshots of the same device with the same timestamp and timezone are
+        merged, matching the shape /metrics has always returned.
+        """
+        aggregators = {}   # guid → aggregator dict
+        devices     = {}   # (guid, device name) → device dict
+        snapshots   = {}   # (guid, device name, epoch, tz) → metrics list
+        timestamps  = {}   # epoch → formatted timestamp
+
+        for agg_guid, agg_name, dev_name, epoch, tz_mins, metric_name, value in rows:
+            snapshot_key = (agg_guid, dev_name, epoch, tz_mins)
+            metrics = snapshots.get(snapshot_key)
+            if metrics is None:
+                aggregator = aggregators.get(agg_guid)
+                if aggregator is None:
+                    aggregator = aggregators[agg_guid] = {'guid': agg_guid, 'name': agg_name, 'devices': []}
+
+                device = devices.get((agg_guid, dev_name))
+                if device is None:
+                    device = devices[(agg_guid, dev_name)] = {'name': dev_name, 'data_snapshots': []}
+                    aggregator['devices'].append(device)
+
+                snapshot_ts = timestamps.get(epoch)
+                if snapshot_ts is None:
+                    snapshot_ts = timestamps[epoch] = http_date(datetime.fromtimestamp(epoch))
+
+                metrics = snapshots[snapshot_key] = []
+                device['data_snapshots'].append({
+                    'timestamp_utc': snapshot_ts,
+                    'timezone_mins': tz_mins,
+                    'metrics':       metrics,
+                })
+
+            metrics.append({'name': metric_name, 'value': value})
+
+        return list(aggregators.values())
+
+    @staticmethod
+    def _parse_limit(raw: str | None) -> int | None:
+        """Parse the ?limit= argument, capped at METRICS_MAX_LIMIT.
+
+        Raises:
+            ValueError: If raw is not a positive integer.
+        """
+        if raw is None:
+            return None
+        try:
+            limit = int(raw)
+        except ValueError:
+            raise ValueError('limit must be a positive integer')
+        if limit <= 0:
+            raise ValueError('limit must be a positive integer')
+        return min(limit, METRICS_MAX_LIMIT)
+
+    @staticmethod
+    def _encode_cursor(key: tuple[int, int]) -> str:
+        """Encode an (epoch, snapshot id) keyset position as an opaque cursor."""
+        return base64.urlsafe_b64encode(f"{key[0]}:{key[1]}".encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple[int, int]:
+        """Decode a cursor produced by _encode_cursor.
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        try:
+            epoch, snapshot_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+            return int(epoch), int(snapshot_id)
+        except Exception:
+            raise ValueError('Invalid cursor')
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Entry point
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def run(self) -> int:
+    def check_schema(self) -> bool:
+        """Check that the database has every migration the routes rely on,
+        logging what to do if not.
+
+        The read API never migrates the database itself; the ingest API,
+        init_db.py and migrations.py do. Serving an older schema would
+        answer almost every request with a 500.
+        """
+        version = current_version(self.engine)
+        if version >= LATEST_VERSION:
+            return True
+        self.logger.error(
+            "Database schema is at version %d, the read API needs version %d: "
+            "run 'python migrations.py' (or start the ingest API, which upgrades it) first",
+            version, LATEST_VERSION
+        )
+        return False
+
+    def run(self, sock: socket.socket | None = None) -> int:
+        """Serve the read API with the server named by read_api.server:
+        'flask' (threaded development server, the default) or 'asgi'
+        (uvicorn, see read_api_asgi.py). Refuses to start on a database
+        that has not been migrated (see check_schema).
+
+        Args:
+            sock: Already listening socket to accept connections from, as
+                  inherited by server.py serve's workers; by default one is
+                  opened on read_api.port
+        """
+        if not self.check_schema():
+            return 1
+        server = getattr(self.config.read_api, 'server', DEFAULT_SERVER)
+        if server == 'asgi':
+            from api.read_api_asgi import run_asgi
+            return run_asgi(self, sock)
+        if server != 'flask':
+            self.logger.error("read_api.server must be 'flask' or 'asgi', got %r", server)
+            return 1
+
         try:
             self.logger.info("Starting ReadAPI on port %s", self.config.read_api.port)
+            if sock is not None:
+                make_server(
+                    '0.0.0.0', self.config.read_api.port, self.webserver,
+                    threaded=True, fd=sock.fileno()
+                ).serve_forever()
+                return 0
             self.webserver.run(
 		host='0.0.0.0',
                 debug=self.config.read_api.debug,
@@ -0,0 +1,152 @@
+"""
+api/read_api_asgi.py
+
+Asyncio serving mode for the read API, for deployments with thousands of
+concurrently connected /stream clients.
+
+Under Flask's threaded server every SSE client owns an OS thread for as long
+as it stays connected. Here the same ReadAPI instance is served by uvicorn:
+
+  - /stream is a native async route. Each client is a coroutine waiting on an
+    asyncio.Event that the SSE producer thread sets through the hub, so an
+    idle dashboard costs a few kilobytes rather than a thread.
+
+  - Every other route is the unchanged Flask handler, mounted through
+    WSGIMiddleware — same routes, same response bodies, same response cache
+    and conditional GET behaviour.
+
+  - All blocking work (the mounted Flask routes, and the database reads a
+    connecting SSE client may trigger) runs on anyio's worker thread pool,
+    capped at read_api.asgi.db_threads so a burst of requests queues instead
+    of outrunning the database connection pool.
+
+Set "server": "asgi" under read_api in config.json to have ReadAPI.run() —
+and so 'python server.py read' and 'both' — use this mode, or run uvicorn
+directly.
+
+Usage:
+    uvicorn --factory api.read_api_asgi:create_app --host 0.0.0.0 --port 5002
+"""
+
+import asyncio
+import functools
+import logging
+import socket
+from contextlib import asynccontextmanager
+
+import anyio
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, StreamingResponse
+
+from api.read_api import ReadAPI, HEARTBEAT_INTERVAL
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_DB_THREADS = 32   # worker threads for Flask routes and database reads
+
+# Seconds uvicorn waits for open connections on shutdown. SSE streams never
+# finish on their own, so without a limit shutdown would wait forever.
+SHUTDOWN_GRACE_SECS = 5
+
+
+def create_app(read: ReadAPI | None = None) -> FastAPI:
+    """Build the ASGI application for a ReadAPI instance.
+
+    Args:
+        read: The ReadAPI to serve; a new one is created if omitted (which is
+              what 'uvicorn --factory' does)
+
+    Returns:
+        A FastAPI application serving every ReadAPI route.
+
+    Raises:
+        RuntimeError: If a new ReadAPI finds the database not migrated
+    """
+    if read is None:
+        # ReadAPI.run() checks its own instance before getting here
+        read = ReadAPI()
+        if not read.check_schema():
+            raise RuntimeError("Database schema is out of date, run 'python migrations.py'")
+    settings   = getattr(read.config.read_api, 'asgi', None)
+    db_threads = int(getattr(settings, 'db_threads', DEFAULT_DB_THREADS))
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        anyio.to_thread.current_default_thread_limiter().total_tokens = db_threads
+        _logger.info("ReadAPI (asgi): blocking work limited to %d threads", db_threads)
+        yield
+
+    app = FastAPI(lifespan=lifespan, openapi_url=None, docs_url=None, redoc_url=None)
+
+    @app.get('/stream')
+    async def stream(request: Request):
+        """Async version of ReadAPI.stream — same arguments and events."""
+        try:
+            kind, last_event_id, guid, device_name = read.parse_stream_args(
+                request.query_params, request.headers
+            )
+        except ValueError as e:
+            # Serialised by Flask, so the body matches the threaded server's
+            with read.webserver.app_context():
+                error = read.webserver.json.response({'status': 'error', 'message': str(e)})
+            return Response(error.get_data(), status_code=400, media_type=error.mimetype)
+        encoding = read.negotiate_encoding(request.headers)
+        return StreamingResponse(
+            _sse_events(read, kind, last_event_id, guid, device_name, encoding),
+            media_type='text/event-stream',
+            headers=read.sse_headers(encoding),
+        )
+
+    app.mount('/', WSGIMiddleware(read.webserver))
+    return app
+
+
+async def _sse_events(read: ReadAPI, kind: str, last_event_id: int | None,
+                      guid: str | None, device_name: str | None, encoding: str | None):
+    """Drive the SSE stream for one client as a coroutine."""
+    loop  = asyncio.get_running_loop()
+    ready = asyncio.Event()
+
+    def waker():
+        try:
+            loop.call_soon_threadsafe(ready.set)
+        except RuntimeError:
+            pass   # event loop already closed during shutdown
+
+    # Subscribing may build the first full-state event, which reads the database
+    subscriber = await anyio.to_thread.run_sync(functools.partial(
+        read.sse_subscribe, kind, last_event_id, guid, device_name, waker, encoding
+    ))
+    try:
+        async for frame in read.sse_hub.astream(subscriber, HEARTBEAT_INTERVAL, ready):
+            yield frame
+        if subscriber.lagged:
+            _logger.info("SSE client fell behind and was disconnected")
+    finally:
+        _logger.info("SSE client disconnected")
+
+
+def run_asgi(read: ReadAPI, sock: socket.socket | None = None) -> int:
+    """Serve read with uvicorn until interrupted. Called by ReadAPI.run().
+
+    Args:
+        read: The ReadAPI to serve
+        sock: Already listening socket to accept from, instead of binding
+              read_api.port
+    """
+    try:
+        _logger.info("Starting ReadAPI (asgi) on port %s", read.config.read_api.port)
+        server = uvicorn.Server(uvicorn.Config(
+            create_app(read),
+            host='0.0.0.0',
+            port=read.config.read_api.port,
+            log_level='debug' if read.config.read_api.debug else 'info',
+            timeout_graceful_shutdown=SHUTDOWN_GRACE_SECS,
+        ))
+        server.run(sockets=[sock] if sock is not None else None)
+        return 0
+    except Exception as e:
+        _logger.exception("ReadAPI (asgi) failed: %s", str(e))
+        return 1
@@ -0,0 +1,173 @@
+"""
+api/response_cache.py
+
+Bounded LRU + TTL cache of serialised ReadAPI responses.
+
+Entries are keyed on the route plus its normalised query string and tagged
+with the parts of the data they were built from, as (aggregator guid, device
+name) pairs. A device name of None stands for every device of that
+aggregator, and an entry with no tags at all depends on everything.
+
+When new snapshots are committed the cache is told which (guid, device)
+pairs changed and drops only the entries that could have been affected; an
+unscoped invalidation clears it completely. The TTL is a backstop for
+anything the tags cannot see.
+
+Bodies are stored as CachedBody objects, which also keep each compressed
+form of the body once it has been asked for, so a popular response is
+compressed once rather than on every request that accepts gzip or zstd.
+
+Every invalidation also advances a generation counter. A response computed
+while an invalidation happened is not stored, so a request that raced an
+ingest can never put stale data back into the cache.
+
+Usage:
+    cache      = ResponseCache(max_entries=1024, ttl=300)
+    generation = cache.generation
+    entry      = cache.get(key)
+    if entry is None:
+        entry = CachedBody(build_response())
+        cache.put(key, entry, tags={(guid, None)}, generation=generation)
+    body = entry.encoded('gzip')
+    cache.invalidate({(guid, 'gen9ou')})   # after ingest
+    cache.invalidate()                     # everything
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from compression import compress
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECS    = 300
+
+# Tag set meaning "depends on every aggregator and device"
+ANY_CHANGE = None
+
+
+class CachedBody:
+    """A serialised response body plus its compressed forms, built on demand.
+
+    Args:
+        data: The uncompressed body
+    """
+
+    def __init__(self, data: bytes):
+        self.data     = data
+        self._encoded: dict[str, bytes] = {}
+
+    def encoded(self, encoding: str) -> bytes:
+        """Return the body compressed in encoding, compressing it on first use."""
+        body = self._encoded.get(encoding)
+        if body is None:
+            body = self._encoded[encoding] = compress(self.data, encoding)
+        return body
+
+
+class ResponseCache:
+    """Thread-safe LRU map of cache keys to responses with per-entry expiry.
+
+    Args:
+        max_entries: Maximum number of responses held before the least
+                     recently used are evicted. 0 disables caching.
+        ttl:         Seconds an entry stays valid even if never invalidated.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL_SECS):
+        self._max_entries = max_entries
+        self._ttl         = ttl
+        self._entries: OrderedDict[Any, tuple[float, frozenset | None, Any]] = OrderedDict()
+        self._lock         = threading.Lock()
+        self.generation    = 0
+        self.hits          = 0
+        self.misses        = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_entries > 0
+
+    def get(self, key) -> Any | None:
+        """Return the cached value for key, or None if absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, _, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, tags: set | None, generation: int):
+        """Store value under key unless the cache was invalidated since
+        generation was read.
+
+        Args:
+            key:        Cache key
+            value:      Value to cache
+            tags:       (aggregator guid, device name or None) pairs the value
+                        was built from, or ANY_CHANGE
+            generation: self.generation as read before building value
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (
+                time.monotonic() + self._ttl,
+                None if tags is ANY_CHANGE else frozenset(tags),
+                value,
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, changes: set | None = None) -> int:
+        """Drop every entry that may depend on changes.
+
+        Args:
+            changes: (aggregator guid, device name) pairs that received new
+                     data, or None to drop everything.
+
+        Returns:
+            The number of entries removed.
+        """
+        with self._lock:
+            self.generation    += 1
+            self.invalidations += 1
+            if changes is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+
+            changed_guids = {guid for guid, _ in changes}
+            stale = [
+                key for key, (_, tags, _) in self._entries.items()
+                if tags is None or any(
+                    (guid in changed_guids) if device is None else ((guid, device) in changes)
+                    for guid, device in tags
+                )
+            ]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def stats(self) -> dict:
+        """Return size and hit/miss counters for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries':       len(self._entries),
+                'max_entries':   self._max_entries,
+                'ttl_secs':      self._ttl,
+                'hits':          self.hits,
+                'misses':        self.misses,
+                'hit_ratio':     round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,482 @@
+"""
+api/retention.py
+
+Retention policies for metrics.db, enforced by a background maintenance
+thread in the process that writes the database.
+
+Rules come from ingest_api.retention in config.json and are set per
+aggregator name, with the top-level raw_days/rollup_days applying to every
+aggregator that has no rule of its own. A value of null keeps data forever.
+
+    raw_days      snapshots older than this are deleted together with their
+                  values in every layout: metric_values and
+                  packed_metric_values rows, and whole metric_chunks once
+                  their newest sample has expired
+    rollup_days   metric_rollups buckets that ended this long ago; either a
+                  number for every resolution or {"1m": 30, "1h": 365, ...}
+
+metric_totals and device_latest_values are never trimmed: they describe all
+of history and the newest snapshot respectively.
+
+With partitioned storage (see partitions.py) the raw deletes run in the main
+database and in every partition that starts before the cutoff. When every
+rule has a finite raw_days, a partition that ended longer ago than the
+longest of them holds nothing worth keeping and is dropped whole: its file is
+deleted instead of its rows.
+
+Each pass deletes in batches of batch_size rows. Every batch is its own
+short transaction taken under the ingest write lock, and the thread sleeps
+batch_pause_ms between batches, so ingest never waits behind more than one
+batch. Afterwards, if the database uses incremental auto-vacuum (new
+databases do, see database.py; existing ones can be converted with
+'python migrations.py vacuum'), freed pages are returned to the filesystem
+vacuum_pages at a time in the same way.
+
+Rows deleted, time spent in batches and time spent waiting for the write
+lock are counted and reported by stats(), which IngestAPI serves at
+GET /maintenance_stats.
+
+Usage:
+    task = RetentionTask(engine, write_lock, config.ingest_api.retention, on_deleted=publish)
+    task.start()
+    task.stats()
+"""
+
+import time
+import logging
+import threading
+from typing import Callable, NamedTuple
+from sqlalchemy import delete, literal_column, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import (
+    Aggregator, Device, MetricChunk, MetricRollup, MetricSnapshot, MetricValue, PackedMetricValues
+)
+from api.materialized import ROLLUP_RESOLUTIONS
+from partitions import PartitionStore
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL_SECS  = 3600   # between maintenance passes
+DEFAULT_BATCH_SIZE     = 500    # rows deleted per transaction
+DEFAULT_BATCH_PAUSE    = 0.05   # seconds between transactions, for ingest to get in
+DEFAULT_VACUUM_PAGES   = 1024   # pages returned to the filesystem per transaction
+
+_DAY_SECS = 86400
+
+# PRAGMA auto_vacuum value of a database in incremental mode
+_AUTO_VACUUM_INCREMENTAL = 2
+
+# Every table retention deletes from, in the order stats() reports them
+_TABLES = ('metric_snapshots', 'metric_values', 'packed_metric_values', 'metric_chunks', 'metric_rollups')
+
+_ROWID = literal_column('rowid')
+
+
+class RetentionRule(NamedTuple):
+    """How long one aggregator's data is kept, in seconds (None = forever)."""
+    raw_secs:    int | None
+    rollup_secs: dict[int, int | None]   # resolution_secs → retention
+
+
+# ---------------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------------
+
+def _days_to_secs(days, what: str) -> int | None:
+    if days is None:
+        return None
+    if isinstance(days, bool) or not isinstance(days, (int, float)) or days <= 0:
+        raise ValueError(f"retention {what} must be a positive number of days or null, got {days!r}")
+    return int(days * _DAY_SECS)
+
+
+def parse_rule(settings, inherit: RetentionRule | None = None) -> RetentionRule:
+    """Build a RetentionRule from a config section with raw_days and
+    rollup_days, taking anything it leaves out from inherit.
+
+    Raises:
+        ValueError: If a period is not a positive number or null, or
+                    rollup_days names an unknown resolution.
+    """
+    raw_secs    = inherit.raw_secs if inherit else None
+    rollup_secs = dict(inherit.rollup_secs) if inherit else {res: None for res in ROLLUP_RESOLUTIONS.values()}
+
+    if hasattr(settings, 'raw_days'):
+        raw_secs = _days_to_secs(settings.raw_days, 'raw_days')
+
+    if hasattr(settings, 'rollup_days'):
+        rollup_days = settings.rollup_days
+        if rollup_days is None or isinstance(rollup_days, (int, float)):
+            secs        = _days_to_secs(rollup_days, 'rollup_days')
+            rollup_secs = {res: secs for res in ROLLUP_RESOLUTIONS.values()}
+        else:
+            for name, days in vars(rollup_days).items():
+                if name not in ROLLUP_RESOLUTIONS:
+                    raise ValueError(
+                        f"retention rollup_days keys must be in {list(ROLLUP_RESOLUTIONS)}, got {name!r}"
+                    )
+                rollup_secs[ROLLUP_RESOLUTIONS[name]] = _days_to_secs(days, f'rollup_days.{name}')
+
+    return RetentionRule(raw_secs, rollup_secs)
+
+
+def parse_rules(settings) -> tuple[RetentionRule, dict[str, RetentionRule]]:
+    """Read the default rule and the per-aggregator rules from a retention
+    config section. Aggregator rules inherit whatever they leave out.
+
+    Returns:
+        (default rule, {aggregator name: rule})
+    """
+    default   = parse_rule(settings)
+    overrides = getattr(settings, 'aggregators', None)
+    rules     = {
+        name: parse_rule(rule, inherit=default)
+        for name, rule in (vars(overrides).items() if overrides is not None else ())
+    }
+    return default, rules
+
+
+# ---------------------------------------------------------------------------
+# Maintenance thread
+# ---------------------------------------------------------------------------
+
+class RetentionTask:
+    """Background thread that enforces retention rules and vacuums.
+
+    Args:
+        engine:     The writer's engine (BEGIN IMMEDIATE transactions)
+        write_lock: Lock every write transaction of this process holds, so
+                    maintenance batches interleave with ingest commits
+        settings:   The ingest_api.retention config section
+        on_deleted: Called after a pass that deleted anything, without the
+                    write lock held, so caches and ETags can move on
+        partitions: The PartitionStore when partitioned storage is enabled
+    """
+
+    def __init__(self, engine: Engine, write_lock: threading.Lock, settings,
+                 on_deleted: Callable[[], None] | None = None, partitions: PartitionStore | None = None):
+        self._engine       = engine
+        self._write_lock   = write_lock
+        self._on_deleted   = on_deleted
+        self._partitions   = partitions
+        self._default, self._rules = parse_rules(settings)
+        self._interval     = float(getattr(settings, 'interval_secs',  DEFAULT_INTERVAL_SECS))
+        self._batch_size   = int(getattr(settings, 'batch_size',       DEFAULT_BATCH_SIZE))
+        self._batch_pause  = getattr(settings, 'batch_pause_ms', DEFAULT_BATCH_PAUSE * 1000) / 1000
+        self._vacuum_pages = int(getattr(settings, 'vacuum_pages',     DEFAULT_VACUUM_PAGES))
+        if self._batch_size <= 0:
+            raise ValueError(f"retention batch_size must be positive, got {self._batch_size}")
+
+        self._stop         = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._stats_lock   = threading.Lock()
+        self._deleted      = dict.fromkeys(_TABLES, 0)
+        self._passes       = 0
+        self._batches      = 0
+        self._busy_secs    = 0.0
+        self._lock_wait    = 0.0
+        self._max_wait     = 0.0
+        self._vacuumed     = 0
+        self._dropped      = 0
+        self._freelist: int | None = None
+        self._last_pass: dict | None = None
+        self._last_error: str | None = None
+
+    def start(self):
+        """Start the maintenance thread. Safe to call more than once."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='RetentionTask', daemon=True)
+        self._thread.start()
+        _logger.info("Retention maintenance started (every %ds, batches of %d rows)",
+                     self._interval, self._batch_size)
+
+    def stop(self):
+        """Ask the thread to stop after the current batch."""
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pass()
+            except Exception as e:
+                self._last_error = str(e)
+                _logger.exception("Retention pass failed: %s", str(e))
+            self._stop.wait(self._interval)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # One pass
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def run_pass(self, now: int | None = None) -> dict[str, int]:
+        """Delete everything that has expired, then vacuum.
+
+        Args:
+            now: UTC epoch to measure ages from; defaults to the current time
+
+        Returns:
+            Rows deleted per table during this pass.
+        """
+        now     = int(time.time()) if now is None else now
+        started = time.monotonic()
+        deleted = dict.fromkeys(_TABLES, 0)
+
+        scopes = [(name, rule) for name, rule in self._rules.items()]
+        scopes.append((None, self._default))
+        dropped    = self._drop_partitions(now, [rule for _, rule in scopes])
+        partitions = self._live_partitions()
+        for name, rule in scopes:
+            devices = self._devices(name)
+            if rule.raw_secs is not None:
+                cutoff = now - rule.raw_secs
+                for key in [None] + [p.key for p in partitions if p.start_epoch < cutoff]:
+                    self._drain(deleted, lambda session: self._delete_snapshots(session, devices, cutoff), key)
+                    self._drain(deleted, lambda session: self._delete_chunks(session, devices, cutoff), key)
+            for resolution, secs in rule.rollup_secs.items():
+                if secs is not None:
+                    cutoff = now - secs
+                    self._drain(deleted, lambda session: self._delete_rollups(session, devices, resolution, cutoff))
+
+        if (dropped or any(deleted.values())) and self._on_deleted is not None:
+            self._on_deleted()
+        self._vacuum(partitions)
+
+        elapsed = time.monotonic() - started
+        with self._stats_lock:
+            self._passes   += 1
+            self._last_pass = {
+                'finished_epoch': int(time.time()),
+                'duration_secs':  round(elapsed, 3),
+                'rows_deleted':   deleted,
+                'partitions_dropped': dropped,
+            }
+            self._last_error = None
+        if dropped:
+            _logger.info("Retention pass dropped partitions %s", ', '.join(dropped))
+        if any(deleted.values()):
+            _logger.info("Retention pass deleted %s in %.2fs",
+                         ', '.join(f'{n} {t}' for t, n in deleted.items() if n), elapsed)
+        return deleted
+
+    def _devices(self, name: str | None):
+        """Subquery of the device ids a rule applies to: one aggregator's, or
+        for the default rule those of every aggregator without a rule."""
+        query = select(Device.device_id).join(Aggregator, Device.aggregator_id == Aggregator.aggregator_id)
+        if name is None:
+            return query.where(Aggregator.name.not_in(list(self._rules)))
+        return query.where(Aggregator.name == name)
+
+    def _live_partitions(self) -> list:
+        """The catalog's live partitions, or none when partitioning is off."""
+        if self._partitions is None:
+            return []
+        with self._write_lock, Session(self._engine) as session:
+            return self._partitions.live(session)
+
+    def _drop_partitions(self, now: int, rules: list[RetentionRule]) -> list[str]:
+        """Drop the partitions that ended before the longest raw retention,
+        if every rule has one. Returns the keys dropped."""
+        if self._partitions is None or any(rule.raw_secs is None for rule in rules):
+            return []
+        cutoff  = now - max(rule.raw_secs for rule in rules)
+        dropped = []
+        for partition in self._live_partitions():
+            if partition.end_epoch > cutoff or self._stop.is_set():
+                break
+            with self._write_lock:
+                self._partitions.drop(self._engine, partition.key)
+            dropped.append(partition.key)
+        with self._stats_lock:
+            self._dropped += len(dropped)
+        return dropped
+
+    def _drain(self, totals: dict[str, int], delete_batch: Callable[[Session], dict[str, int]],
+               key: str | None = None):
+        """Run delete_batch in one short transaction after another until it
+        deletes nothing, pausing between transactions.
+
+        Args:
+            totals:       Rows deleted per table, added to
+            delete_batch: Deletes one batch in the session it is given
+            key:          Partition to delete from, or None for the main database
+        """
+        while not self._stop.is_set():
+            deleted = self._in_transaction(delete_batch, key)
+            for table, count in deleted.items():
+                totals[table] += count
+            if not any(deleted.values()):
+                return
+            self._stop.wait(self._batch_pause)
+
+    def _in_transaction(self, work: Callable[[Session], dict[str, int]], key: str | None = None) -> dict[str, int]:
+        """Run work in its own write transaction, with the partitioned tables
+        pointed at partition key, and record its costs.
+
+        The lock wait covers both the in-process write lock and BEGIN
+        IMMEDIATE, which waits for writers in other processes.
+        """
+        requested = time.monotonic()
+        with self._write_lock, self._session(key) as session:
+            try:
+                session.connection()
+                acquired = time.monotonic()
+                if key is not None:
+                    self._partitions.use(session, key)
+                deleted  = work(session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finished = time.monotonic()
+
+        with self._stats_lock:
+            wait = acquired - requested
+            self._batches   += 1
+            self._busy_secs += finished - acquired
+            self._lock_wait += wait
+            self._max_wait   = max(self._max_wait, wait)
+            for table, count in deleted.items():
+                self._deleted[table] += count
+        return deleted
+
+    def _session(self, key: str | None):
+        """Session on the main database, with partition key attached if given."""
+        if key is None:
+            return Session(self._engine)
+        return self._partitions.session(self._engine, [key])
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Batches
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _delete_snapshots(self, session: Session, devices, cutoff: int) -> dict[str, int]:
+        """Delete up to batch_size expired snapshots and their values."""
+        snapshot_ids = session.execute(
+            select(MetricSnapshot.metric_snapshot_id)
+            .where(MetricSnapshot.device_id.in_(devices),
+                   MetricSnapshot.client_utc_timestamp_epoch < cutoff)
+            .limit(self._batch_size)
+        ).scalars().all()
+        if not snapshot_ids:
+            return {}
+        deleted = {}
+        for table, column in (
+            ('metric_values',        MetricValue.metric_snapshot_id),
+            ('packed_metric_values', PackedMetricValues.metric_snapshot_id),
+            ('metric_snapshots',     MetricSnapshot.metric_snapshot_id),
+        ):
+            deleted[table] = session.execute(
+                delete(column.table).where(column.in_(snapshot_ids))
+            ).rowcount
+        return deleted
+
+    def _delete_chunks(self, session: Session, devices, cutoff: int) -> dict[str, int]:
+        """Delete up to batch_size chunks whose newest sample has expired."""
+        chunks = MetricChunk.__table__
+        return {'metric_chunks': _delete_limited(session, chunks, self._batch_size,
+            chunks.c.device_id.in_(devices),
+            chunks.c.chunk_start_epoch < cutoff,
+            chunks.c.last_epoch < cutoff,
+        )}
+
+    def _delete_rollups(self, session: Session, devices, resolution: int, cutoff: int) -> dict[str, int]:
+        """Delete up to batch_size rollup buckets of one resolution that
+        ended before cutoff."""
+        rollups = MetricRollup.__table__
+        return {'metric_rollups': _delete_limited(session, rollups, self._batch_size,
+            rollups.c.device_id.in_(devices),
+            rollups.c.resolution_secs == resolution,
+            rollups.c.bucket_start_epoch <= cutoff - resolution,
+        )}
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Vacuum
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _vacuum(self, partitions: list):
+        """Return free pages to the filesystem, vacuum_pages per transaction,
+        in the main database and each live partition that is in incremental
+        auto-vacuum mode. freelist_pages reports the main database."""
+        if self._engine.dialect.name != 'sqlite' or self._vacuum_pages <= 0:
+            return
+        with self._engine.connect() as connection:
+            sqlite = connection.connection.driver_connection
+            self._freelist = self._vacuum_schema(sqlite, 'main')
+            for partition in partitions:
+                if self._stop.is_set():
+                    break
+                self._partitions.attach(connection, [partition.key])
+                self._vacuum_schema(sqlite, self._partitions.schema(partition.key))
+
+    def _vacuum_schema(self, sqlite, schema: str) -> int:
+        """Incrementally vacuum one attached database; returns the pages
+        still free afterwards."""
+        if sqlite.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != _AUTO_VACUUM_INCREMENTAL:
+            return sqlite.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+        while not self._stop.is_set():
+            before = sqlite.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+            if not before:
+                break
+            requested = time.monotonic()
+            with self._write_lock:
+                acquired = time.monotonic()
+                # executescript steps the pragma to completion; a plain
+                # execute() frees a single page
+                sqlite.executescript(f"PRAGMA {schema}.incremental_vacuum({self._vacuum_pages})")
+                finished = time.monotonic()
+            after = sqlite.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+            with self._stats_lock:
+                wait = acquired - requested
+                self._busy_secs += finished - acquired
+                self._lock_wait += wait
+                self._max_wait   = max(self._max_wait, wait)
+                self._vacuumed  += before - after
+            if after >= before:
+                break
+            self._stop.wait(self._batch_pause)
+        return sqlite.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Monitoring
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def stats(self) -> dict:
+        """Return rule settings and maintenance counters for monitoring."""
+        def days(secs):
+            return None if secs is None else secs / _DAY_SECS
+
+        def rule_days(rule: RetentionRule) -> dict:
+            return {
+                'raw_days':    days(rule.raw_secs),
+                'rollup_days': {name: days(rule.rollup_secs[res]) for name, res in ROLLUP_RESOLUTIONS.items()},
+            }
+
+        with self._stats_lock:
+            return {
+                'enabled':            True,
+                'interval_secs':      self._interval,
+                'batch_size':         self._batch_size,
+                'default':            rule_days(self._default),
+                'aggregators':        {name: rule_days(rule) for name, rule in self._rules.items()},
+                'passes':             self._passes,
+                'batches':            self._batches,
+                'rows_deleted':       dict(self._deleted),
+                'time_spent_secs':    round(self._busy_secs, 3),
+                'lock_wait_secs':     round(self._lock_wait, 3),
+                'max_lock_wait_secs': round(self._max_wait, 3),
+                'pages_vacuumed':     self._vacuumed,
+                'partitions_dropped': self._dropped,
+                'freelist_pages':     self._freelist,
+                'last_pass':          self._last_pass,
+                'last_error':         self._last_error,
+            }
+
+
+def _delete_limited(session: Session, table, limit: int, *conditions) -> int:
+    """DELETE at most limit rows of table matching conditions; returns the
+    number deleted."""
+    return session.execute(
+        delete(table).where(_ROWID.in_(select(_ROWID).select_from(table).where(*conditions).limit(limit)))
+    ).rowcount
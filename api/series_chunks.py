@@ -0,0 +1,535 @@
+"""
+api/series_chunks.py
+
+Time-series chunk store for metric values: the "chunked" value layout.
+
+Host metrics such as PCInfo's change slowly or monotonically from one
+snapshot to the next, so storing every value as its own float row wastes
+most of the space. In this layout each device metric gets a run of
+fixed-duration chunks in metric_chunks (chunk_secs wide, aligned to
+multiples of it), and every sample is appended to the chunk covering its
+timestamp with the encoding from Facebook's Gorilla paper:
+
+    timestamps  delta-of-delta against the previous sample:
+                  '0'                    same interval as last time
+                  '10'   +  7-bit value  -64 .. 63
+                  '110'  +  9-bit value  -256 .. 255
+                  '1110' + 12-bit value  -2048 .. 2047
+                  '1111' + 64-bit value  anything else
+    values      XOR with the previous value's bits:
+                  '0'                    unchanged
+                  '10' + meaningful bits XOR fits the previous leading/trailing
+                                         zero window
+                  '11' + 5-bit leading zeros + 6-bit length - 1 + meaningful bits
+
+The first sample of a chunk is stored as a raw 64-bit timestamp and value.
+A steady 30 s interval and an unchanged value cost two bits per sample.
+
+The newest chunk of each metric is open: its bitstream is stored as it is,
+with the encoder state (last timestamp, interval, value bits, XOR window and
+bit length) alongside, so an append only touches the new bits. When a sample
+arrives for a later chunk the open one is sealed: its bitstream is zlib
+compressed and the encoder state dropped. Late samples for a sealed chunk
+are rare and simply re-encode it.
+
+Snapshot header rows stay in metric_snapshots. A snapshot's values are
+found again by matching its device and timestamp against the decoded
+samples (see read_samples and snapshot_values), and reads only decode the
+chunks overlapping the time range they cover. Within a snapshot, metrics
+come back in metric type order, the order the device first reported them.
+
+Several snapshots of a device can share a timestamp, e.g. when a batch is
+resent after its reply was lost. Samples of the first such snapshot (the
+lowest id) are stored as usual; those of the others are tagged with their
+snapshot id in the chunk's snapshot_tags, as (sample index, snapshot id)
+pairs, so a read of any subset of the snapshots gives each its own values.
+
+Usage:
+    from api.series_chunks import append_samples, read_samples, Sample
+
+    append_samples(session, [Sample(type_id, device_id, epoch, value)], chunk_secs=7200)
+    samples = read_samples(session, device_ids, start_epoch, end_epoch)
+    shared  = shared_epochs(session, device_ids, start_epoch, end_epoch)
+    values  = snapshot_values(samples, shared, snapshot_id, device_id, epoch)
+
+    python -m api.series_chunks    # encode/decode and store round-trip self-checks
+"""
+
+import struct
+import zlib
+import logging
+from typing import NamedTuple
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import MetricChunk, MetricSnapshot
+
+_logger = logging.getLogger(__name__)
+
+# Default width of a chunk (ingest_api.chunk_secs): 240 samples at PCInfo's
+# 30 s interval, 7200 at one per second
+DEFAULT_CHUNK_SECS = 7200
+
+# Compression level for sealed chunks
+ZLIB_LEVEL = 6
+
+# Open chunk encoder state: last timestamp, last interval, last value bits,
+# leading and trailing zeros of the XOR window (-1 before the first) and
+# the bitstream length
+_STATE = struct.Struct('<qqQbbI')
+
+# snapshot_tags entry: index of the sample in the chunk, snapshot id
+_TAG = struct.Struct('<Iq')
+
+_DOUBLE = struct.Struct('<d')
+_UINT64 = struct.Struct('<Q')
+
+# Delta-of-delta buckets: (prefix, bits); values that fit none use '1111' + 64
+_DOD_BUCKETS = (('10', 7), ('110', 9), ('1110', 12))
+
+# SQLite limits the number of bound parameters per statement
+_IN_CHUNK_SIZE = 250
+
+
+class Sample(NamedTuple):
+    """One metric value to append to the chunk store."""
+    type_id:   int      # device_metric_type_id
+    device_id: int
+    epoch:     int      # client_utc_timestamp_epoch
+    value:     float
+    # Only for a snapshot that is not the first of its device at epoch
+    snapshot_id: int | None = None
+
+
+# ---------------------------------------------------------------------------
+# Bitstream encoding
+# ---------------------------------------------------------------------------
+
+class _Encoder:
+    """Appends samples to a chunk's bitstream, built as a string of '0' and
+    '1' characters so each field is one format() call."""
+
+    def __init__(self, bits: str = '', state: tuple | None = None):
+        self.pieces = [bits]
+        if state is None:
+            self.count = 0
+            self.last_epoch, self.last_delta, self.last_bits = 0, 0, 0
+            self.leading, self.trailing = -1, 0
+        else:
+            self.last_epoch, self.last_delta, self.last_bits, self.leading, self.trailing, _ = state
+            self.count = 1   # anything but the first sample
+
+    @classmethod
+    def resume(cls, data: bytes, state: bytes) -> '_Encoder':
+        """Continue an open chunk from its stored bitstream and state."""
+        unpacked = _STATE.unpack(state)
+        return cls(_to_bits(data)[:unpacked[-1]], unpacked)
+
+    def append(self, epoch: int, value: float):
+        bits = _UINT64.unpack(_DOUBLE.pack(value))[0]
+        if self.count == 0:
+            self.pieces.append(format(epoch & 0xFFFFFFFFFFFFFFFF, '064b'))
+            self.pieces.append(format(bits, '064b'))
+        else:
+            delta = epoch - self.last_epoch
+            self._append_dod(delta - self.last_delta)
+            self.last_delta = delta
+            self._append_xor(bits ^ self.last_bits)
+        self.last_epoch = epoch
+        self.last_bits  = bits
+        self.count     += 1
+
+    def _append_dod(self, dod: int):
+        if dod == 0:
+            self.pieces.append('0')
+            return
+        for prefix, width in _DOD_BUCKETS:
+            if -(1 << (width - 1)) <= dod < (1 << (width - 1)):
+                self.pieces.append(prefix + format(dod & ((1 << width) - 1), f'0{width}b'))
+                return
+        self.pieces.append('1111' + format(dod & 0xFFFFFFFFFFFFFFFF, '064b'))
+
+    def _append_xor(self, xor: int):
+        if xor == 0:
+            self.pieces.append('0')
+            return
+        leading  = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if self.leading >= 0 and leading >= self.leading and trailing >= self.trailing:
+            width = 64 - self.leading - self.trailing
+            self.pieces.append('10' + format(xor >> self.trailing, f'0{width}b'))
+            return
+        width = 64 - leading - trailing
+        self.pieces.append('11' + format(leading, '05b') + format(width - 1, '06b')
+                           + format(xor >> trailing, f'0{width}b'))
+        self.leading, self.trailing = leading, trailing
+
+    def bits(self) -> str:
+        bits = ''.join(self.pieces)
+        self.pieces = [bits]
+        return bits
+
+    def state(self, bit_length: int) -> bytes:
+        return _STATE.pack(self.last_epoch, self.last_delta, self.last_bits,
+                           self.leading, self.trailing, bit_length)
+
+
+def _to_bits(data: bytes) -> str:
+    return format(int.from_bytes(data, 'big'), f'0{len(data) * 8}b') if data else ''
+
+
+def _to_bytes(bits: str) -> bytes:
+    padded = bits + '0' * (-len(bits) % 8)
+    return int(padded, 2).to_bytes(len(padded) // 8, 'big') if padded else b''
+
+
+def decode(data: bytes, sample_count: int) -> list[tuple[int, float]]:
+    """Decode sample_count (epoch, value) samples from a raw bitstream, in
+    the order they were appended."""
+    if sample_count == 0:
+        return []
+    bits  = _to_bits(data)
+    epoch = int(bits[0:64], 2)
+    if epoch >= 1 << 63:
+        epoch -= 1 << 64
+    value_bits = int(bits[64:128], 2)
+    value      = _DOUBLE.unpack(_UINT64.pack(value_bits))[0]
+    samples    = [(epoch, value)]
+    append     = samples.append
+    pos        = 128
+    delta      = 0
+    remaining  = sample_count - 1
+    leading, trailing = 0, 0
+
+    while remaining:
+        # A run of '00' pairs is a run of samples at the same interval with
+        # an unchanged value, the common case for slow-moving metrics:
+        # emit it in one go
+        if bits.startswith('00', pos):
+            run_end = bits.find('1', pos)
+            run     = min(((run_end if run_end >= 0 else len(bits)) - pos) // 2, remaining)
+            if delta:
+                # delta is negative for late samples stepping back in time
+                samples.extend([(epoch + delta * i, value) for i in range(1, run + 1)])
+            else:
+                samples.extend([(epoch, value)] * run)
+            epoch     += delta * run
+            pos       += 2 * run
+            remaining -= run
+            continue
+
+        # Timestamp: delta of delta, almost always '0' for a steady interval
+        if bits[pos] == '0':
+            pos += 1
+        else:
+            for prefix, width in _DOD_BUCKETS + (('1111', 64),):
+                if bits.startswith(prefix, pos):
+                    break
+            pos += len(prefix)
+            dod  = int(bits[pos:pos + width], 2)
+            if dod >= 1 << (width - 1):
+                dod -= 1 << width
+            pos   += width
+            delta += dod
+        epoch += delta
+
+        # Value: XOR with the previous one; only rebuilt when it changed
+        if bits[pos] == '0':
+            pos += 1
+        else:
+            if bits[pos + 1] == '1':
+                leading  = int(bits[pos + 2:pos + 7], 2)
+                width    = int(bits[pos + 7:pos + 13], 2) + 1
+                trailing = 64 - leading - width
+                pos     += 13
+            else:
+                width = 64 - leading - trailing
+                pos  += 2
+            value_bits ^= int(bits[pos:pos + width], 2) << trailing
+            value       = _DOUBLE.unpack(_UINT64.pack(value_bits))[0]
+            pos        += width
+        append((epoch, value))
+        remaining -= 1
+    return samples
+
+
+def decode_chunk(data: bytes, sample_count: int, sealed: bool) -> list[tuple[int, float]]:
+    """Decode a metric_chunks row's samples, decompressing it if sealed."""
+    return decode(zlib.decompress(data) if sealed else data, sample_count)
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+
+def append_samples(session: Session, samples: list[Sample], chunk_secs: int = DEFAULT_CHUNK_SECS):
+    """Append a batch of samples to the chunk store without committing.
+
+    Reads the chunks the batch touches plus each metric's open chunk with two
+    SELECTs, appends in memory, and writes every changed chunk back with one
+    executemany upsert. Afterwards only the newest chunk of each metric in
+    the batch is open; any older one it touched is sealed.
+
+    Args:
+        session:    The active SQLAlchemy session
+        samples:    Values to store, in snapshot order, with snapshot_id set
+                    as shared_epochs() says
+        chunk_secs: Width of a chunk; chunks start at multiples of it
+    """
+    if not samples:
+        return
+
+    by_chunk = {}   # (type_id, chunk_start) → [Sample, ...]
+    for sample in samples:
+        key = (sample.type_id, sample.epoch - sample.epoch % chunk_secs)
+        by_chunk.setdefault(key, []).append(sample)
+
+    type_ids = list({type_id for type_id, _ in by_chunk})
+    keys     = list(by_chunk)
+    existing = {}
+    columns  = (MetricChunk.device_metric_type_id, MetricChunk.chunk_start_epoch, MetricChunk.device_id,
+                MetricChunk.first_epoch, MetricChunk.last_epoch, MetricChunk.sample_count, MetricChunk.data,
+                MetricChunk.encoder_state, MetricChunk.snapshot_tags)
+    for start in range(0, len(type_ids), _IN_CHUNK_SIZE):
+        for row in session.execute(select(*columns).where(
+            MetricChunk.device_metric_type_id.in_(type_ids[start:start + _IN_CHUNK_SIZE]),
+            MetricChunk.encoder_state.is_not(None)
+        )):
+            existing[(row[0], row[1])] = row
+    missing = [key for key in keys if key not in existing]
+    for start in range(0, len(missing), _IN_CHUNK_SIZE):
+        for row in session.execute(select(*columns).where(
+            tuple_(MetricChunk.device_metric_type_id, MetricChunk.chunk_start_epoch)
+            .in_(missing[start:start + _IN_CHUNK_SIZE])
+        )):
+            existing[(row[0], row[1])] = row
+
+    # The newest chunk of each metric stays open
+    newest = {}
+    for type_id, chunk_start in list(existing) + keys:
+        newest[type_id] = max(newest.get(type_id, chunk_start), chunk_start)
+
+    changed = []
+    for key in set(existing) | set(by_chunk):
+        type_id, chunk_start = key
+        row   = existing.get(key)
+        new   = by_chunk.get(key, [])
+        stays_open = chunk_start == newest[type_id]
+        if row is not None and not new and (row.encoder_state is not None) == stays_open:
+            continue   # untouched and already in the right state
+
+        tags = (row.snapshot_tags or b'') if row is not None else b''
+        if row is None:
+            encoder, first, last, count = _Encoder(), None, None, 0
+        elif row.encoder_state is not None:
+            encoder, first, last, count = _Encoder.resume(row.data, row.encoder_state), \
+                row.first_epoch, row.last_epoch, row.sample_count
+        else:
+            # Late samples for a sealed chunk: re-encode it
+            encoder = _Encoder()
+            for epoch, value in decode_chunk(row.data, row.sample_count, sealed=True):
+                encoder.append(epoch, value)
+            first, last, count = row.first_epoch, row.last_epoch, row.sample_count
+
+        for index, sample in enumerate(new, start=count):
+            encoder.append(sample.epoch, sample.value)
+            if sample.snapshot_id is not None:
+                tags += _TAG.pack(index, sample.snapshot_id)
+        epochs = [sample.epoch for sample in new] + ([first, last] if count else [])
+        bits   = encoder.bits()
+        data   = _to_bytes(bits)
+        changed.append({
+            'device_metric_type_id': type_id,
+            'chunk_start_epoch':     chunk_start,
+            'device_id':             new[0].device_id if new else row.device_id,
+            'first_epoch':           min(epochs),
+            'last_epoch':            max(epochs),
+            'sample_count':          count + len(new),
+            'data':                  data if stays_open else zlib.compress(data, ZLIB_LEVEL),
+            'encoder_state':         encoder.state(len(bits)) if stays_open else None,
+            'snapshot_tags':         tags or None,
+        })
+
+    stmt     = sqlite_insert(MetricChunk)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device_metric_type_id', 'chunk_start_epoch'],
+        set_={
+            'first_epoch':   excluded.first_epoch,
+            'last_epoch':    excluded.last_epoch,
+            'sample_count':  excluded.sample_count,
+            'data':          excluded.data,
+            'encoder_state': excluded.encoder_state,
+            'snapshot_tags': excluded.snapshot_tags,
+        }
+    )
+    session.execute(stmt, changed)
+    _logger.debug("Wrote %d sample(s) to %d chunk(s)", len(samples), len(changed))
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+def read_samples(session: Session, device_ids, start_epoch: int, end_epoch: int) -> dict:
+    """Decode every sample of the given devices in [start_epoch, end_epoch].
+
+    Only chunks whose samples overlap the range are read and decoded.
+
+    Returns:
+        {(device_id, epoch): {type_id: [(snapshot id, value), ...]}}, each
+        list in the order the values were appended. The snapshot id is None
+        for values of the first snapshot of the device at epoch, see
+        shared_epochs().
+    """
+    device_ids = list(device_ids)
+    samples    = {}
+    for start in range(0, len(device_ids), _IN_CHUNK_SIZE):
+        rows = session.execute(
+            select(MetricChunk.device_id, MetricChunk.device_metric_type_id, MetricChunk.sample_count,
+                   MetricChunk.data, MetricChunk.encoder_state, MetricChunk.snapshot_tags)
+            .where(
+                MetricChunk.device_id.in_(device_ids[start:start + _IN_CHUNK_SIZE]),
+                MetricChunk.chunk_start_epoch <= end_epoch,
+                MetricChunk.first_epoch       <= end_epoch,
+                MetricChunk.last_epoch        >= start_epoch,
+            )
+            .order_by(MetricChunk.device_metric_type_id, MetricChunk.chunk_start_epoch)
+        )
+        for device_id, type_id, sample_count, data, encoder_state, snapshot_tags in rows:
+            tags = dict(_TAG.iter_unpack(snapshot_tags)) if snapshot_tags else {}
+            for index, (epoch, value) in enumerate(decode_chunk(data, sample_count, sealed=encoder_state is None)):
+                if start_epoch <= epoch <= end_epoch:
+                    samples.setdefault((device_id, epoch), {}).setdefault(type_id, []).append(
+                        (tags.get(index), value)
+                    )
+    return samples
+
+
+def shared_epochs(session: Session, device_ids, start_epoch: int, end_epoch: int) -> dict:
+    """Find the timestamps in [start_epoch, end_epoch] that more than one
+    snapshot of a device has, with the first (lowest) snapshot id of each.
+
+    Writers tag the samples of every other snapshot at such a timestamp;
+    readers give the untagged samples to the first one.
+
+    Returns:
+        {(device_id, epoch): first snapshot id}
+    """
+    device_ids = list(device_ids)
+    shared     = {}
+    for start in range(0, len(device_ids), _IN_CHUNK_SIZE):
+        shared.update(
+            ((device_id, epoch), first_id) for device_id, epoch, first_id in session.execute(
+                select(MetricSnapshot.device_id, MetricSnapshot.client_utc_timestamp_epoch,
+                       func.min(MetricSnapshot.metric_snapshot_id))
+                .where(
+                    MetricSnapshot.device_id.in_(device_ids[start:start + _IN_CHUNK_SIZE]),
+                    MetricSnapshot.client_utc_timestamp_epoch.between(start_epoch, end_epoch),
+                )
+                .group_by(MetricSnapshot.device_id, MetricSnapshot.client_utc_timestamp_epoch)
+                .having(func.count() > 1)
+            )
+        )
+    return shared
+
+
+def snapshot_values(samples: dict, shared: dict, snapshot_id: int, device_id: int,
+                    epoch: int) -> list[tuple[int, float]]:
+    """Pick one snapshot's values out of read_samples() output.
+
+    Args:
+        samples: As returned by read_samples()
+        shared:  As returned by shared_epochs() for the same range
+
+    Returns:
+        (type id, value) pairs in metric type order.
+    """
+    by_type = samples.get((device_id, epoch))
+    if not by_type:
+        return []
+    owner  = None if shared.get((device_id, epoch), snapshot_id) == snapshot_id else snapshot_id
+    values = []
+    for type_id in sorted(by_type):
+        for tag, value in by_type[type_id]:
+            if tag == owner:
+                values.append((type_id, value))
+                break
+    return values
+
+
+# ---------------------------------------------------------------------------
+# Self-check
+# ---------------------------------------------------------------------------
+
+def _round_trip_check():
+    """Encode and decode sample series covering forward, zero and backward
+    (late sample) intervals, with runs of unchanged values, and fail on any
+    mismatch."""
+    base   = 1780000000
+    series = {
+        'forward':          [(base + 30 * i, 1.5) for i in range(20)],
+        'zero delta':       [(base, 2.0)] * 10,
+        'backward':         [(base + 600 - 30 * i, 3.0) for i in range(20)],
+        'backward, varied': [(base + 600, 1.0), (base + 570, 1.0), (base + 540, 1.0), (base + 510, 4.0)],
+        'mixed':            [(base, 1.0), (base + 30, 1.0), (base + 60, 1.0), (base + 30, 1.0),
+                             (base, 1.0), (base, 1.0), (base, 1.0), (base + 90, 2.5), (base + 120, 2.5)],
+    }
+    for name, samples in series.items():
+        encoder = _Encoder()
+        for epoch, value in samples:
+            encoder.append(epoch, value)
+        decoded = decode(_to_bytes(encoder.bits()), len(samples))
+        assert decoded == samples, f"{name}: decoded {decoded}, expected {samples}"
+    print(f"series_chunks round trip OK ({len(series)} series)")
+
+
+def _store_round_trip_check():
+    """Write snapshots through append_samples the way IngestAPI does, into an
+    in-memory database, and read each one back on its own, as a one-snapshot
+    page would: repeated timestamps, different metrics at one timestamp and
+    a late sample re-encoding a sealed chunk."""
+    from sqlalchemy import create_engine, insert
+    from models import PARTITION_SCHEMA
+
+    engine = create_engine('sqlite://').execution_options(schema_translate_map={PARTITION_SCHEMA: None})
+    MetricChunk.metadata.create_all(engine, tables=[MetricSnapshot.__table__, MetricChunk.__table__])
+    base    = 1780000020
+    batches = [                                                  # [(epoch, {type_id: value})] per write
+        [(base, {1: 1.0})], [(base, {1: 2.0})], [(base, {1: 3.0})],   # a batch resent twice
+        [(base + 30, {1: 1.0}), (base + 30, {2: 2.0})],               # same timestamp, other metrics
+        [(base + 60, {1: 5.0, 2: 6.0})],                              # seals the first chunk
+        [(base + 15, {1: 7.0}), (base, {2: 8.0})],                    # late, into the sealed chunk
+    ]
+    written = []
+    with Session(engine) as session:
+        for batch in batches:
+            ids = [
+                session.execute(insert(MetricSnapshot).values(
+                    device_id=1, client_utc_timestamp_epoch=epoch, client_timezone_mins=0,
+                    server_utc_timestamp_epoch=epoch, server_timezone_mins=0
+                ).returning(MetricSnapshot.metric_snapshot_id)).scalar()
+                for epoch, _ in batch
+            ]
+            epochs  = [epoch for epoch, _ in batch]
+            shared  = shared_epochs(session, [1], min(epochs), max(epochs))
+            samples = []
+            for snapshot_id, (epoch, values) in zip(ids, batch):
+                owner = None if shared.get((1, epoch), snapshot_id) == snapshot_id else snapshot_id
+                samples.extend(Sample(type_id, 1, epoch, value, owner) for type_id, value in values.items())
+                written.append((snapshot_id, epoch, sorted(values.items())))
+            append_samples(session, samples, chunk_secs=60)
+        session.commit()
+
+        for snapshot_id, epoch, expected in written:
+            samples = read_samples(session, [1], epoch, epoch)
+            shared  = shared_epochs(session, [1], epoch, epoch)
+            got     = snapshot_values(samples, shared, snapshot_id, 1, epoch)
+            assert got == expected, f"snapshot {snapshot_id} at {epoch}: read {got}, wrote {expected}"
+    print(f"series_chunks store round trip OK ({len(written)} snapshots)")
+
+
+if __name__ == "__main__":
+    _round_trip_check()
+    _store_round_trip_check()
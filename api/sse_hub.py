@@ -0,0 +1,362 @@
+"""
+api/sse_hub.py
+
+Fan-out of Server-Sent Events from one producer to many connected clients.
+
+ReadAPI builds and serialises each update exactly once and publishes the
+resulting frame here; every subscribed client receives the same bytes through
+its own bounded queue. Nothing a client does can slow the producer down or
+make another client miss an update.
+
+                producer thread (one per process)
+                    │  publish() — frame built and serialised once
+                    ▼
+          ┌───────────────────┐
+          │      SSEHub       │  ← replay ring of recent frames
+          └──┬──────┬──────┬──┘
+             ▼      ▼      ▼      one bounded queue per client
+           client client client
+
+Frames are published under a topic of (kind, aggregator guid, device name).
+Each subscriber asks for one kind ('metrics' for full-state updates,
+'snapshots' for deltas) and optionally narrows it to one aggregator and/or
+device, so a client only receives the frames it asked for while each frame
+is still serialised once, whoever receives it. Frames published with no
+topic (errors) go to everyone.
+
+Every published frame gets a monotonic event id. Ids start at the current
+time in milliseconds, so they keep increasing across restarts. The last
+replay_size frames are kept in a ring buffer, so a client reconnecting with
+Last-Event-ID is sent exactly the frames it missed. A client that cannot be
+resumed (its id is too old, from before a restart, or updates of its kind
+were skipped while nobody was listening) is sent the most recent full-state
+frame of its kind if there is one, and a 'resync' event otherwise, telling it
+to reload from the REST API.
+
+When several worker processes serve /stream (server.py serve), each has its
+own hub. Their ids are kept apart (worker i of n only issues ids congruent to
+i mod n), so a client whose reconnect lands on a different worker is seen
+as not resumable instead of being replayed another worker's history.
+
+A client may also be sent its stream compressed (gzip or zstd). Each frame
+is then compressed once, on its own, the first time any client needs it in
+that encoding, and the result is kept with the frame for every other client
+and for replays from the ring (see compression.compress_chunk).
+
+A client that falls more than queue_size frames behind is disconnected rather
+than buffered without bound; its browser reconnects with Last-Event-ID and
+catches up from the ring.
+
+Clients are served either by a thread blocking in stream(), or by a coroutine
+in astream() for asyncio servers. The coroutine is woken from the producer
+thread through the waker callable it subscribed with, so any number of them
+can wait without holding a thread each.
+
+Usage:
+    hub        = SSEHub(replay_size=256, queue_size=32)
+    subscriber = hub.subscribe('snapshots', last_event_id=None, guid=guid, encoding='gzip')
+    hub.publish('snapshots', json_bytes, topic=('snapshots', guid, device))   # producer
+    for frame in hub.stream(subscriber, heartbeat_interval=15):                # client
+        yield frame
+    async for frame in hub.astream(subscriber, 15, ready):                     # asyncio client
+        yield frame
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Iterator
+
+from compression import StreamEncoder, compress_chunk
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_REPLAY_SIZE = 256   # frames kept for Last-Event-ID resume
+DEFAULT_QUEUE_SIZE  = 32    # frames a client may fall behind before it is dropped
+
+_CLOSE = object()  # queued in place of frames to end a lagging client's stream
+
+
+class Frame(bytes):
+    """A serialised SSE frame that keeps its compressed forms, so each is
+    built once however many clients receive it."""
+
+    def encoded(self, encoding: str) -> bytes:
+        """Return this frame compressed on its own in encoding."""
+        cache = self.__dict__.setdefault('_encoded', {})
+        data  = cache.get(encoding)
+        if data is None:
+            data = cache[encoding] = compress_chunk(self, encoding)
+        return data
+
+
+HEARTBEAT_FRAME = Frame(b"event: heartbeat\ndata: {}\n\n")
+RESYNC_FRAME    = Frame(b"event: resync\ndata: {}\n\n")
+
+
+class Subscriber:
+    """One connected client: what it subscribed to, its queue, and the
+    frames owed to it on connect."""
+
+    def __init__(self, kind: str, guid: str | None, device: str | None, queue_size: int,
+                 waker: Callable[[], None] | None = None, encoding: str | None = None):
+        self.kind           = kind
+        self.guid           = guid
+        self.device         = device
+        self.waker          = waker
+        self.encoding       = encoding
+        self.queue          = queue.Queue(maxsize=queue_size)
+        self.backlog: list[Frame] = []
+        self.lagged         = False
+        # True if the client could not be resumed and no full-state frame of
+        # its kind existed to start it from — the producer should publish one
+        self.needs_snapshot = False
+        self._encoder       = StreamEncoder(encoding) if encoding else None
+
+    def accepts(self, topic: tuple[str, str | None, str | None] | None) -> bool:
+        """Return True if a frame published under topic is meant for this client."""
+        if topic is None:
+            return True
+        kind, guid, device = topic
+        return (kind == self.kind
+                and (self.guid   is None or guid   == self.guid)
+                and (self.device is None or device == self.device))
+
+    def opening(self) -> bytes:
+        """Bytes to send before the first frame (a gzip header, or nothing)."""
+        return self._encoder.header() if self._encoder else b''
+
+    def render(self, frame: Frame) -> bytes:
+        """Return frame as it goes on this client's wire."""
+        if self._encoder is None:
+            return frame
+        return self._encoder.chunk(frame, frame.encoded(self.encoding))
+
+    def closing(self) -> bytes:
+        """Bytes that properly end the stream (a gzip trailer, or nothing)."""
+        return self._encoder.trailer() if self._encoder else b''
+
+
+class SSEHub:
+    """Thread-safe publisher of SSE frames to any number of subscribers.
+
+    Args:
+        replay_size:  Number of recent frames kept for Last-Event-ID resume.
+        queue_size:   Frames a client may have waiting before it is dropped.
+        worker_index: This process's index among worker_count processes
+                      serving /stream, so their event ids never collide.
+        worker_count: Number of such processes.
+    """
+
+    def __init__(self, replay_size: int = DEFAULT_REPLAY_SIZE, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 worker_index: int = 0, worker_count: int = 1):
+        self._queue_size  = queue_size
+        self._id_offset   = worker_index
+        self._id_stride   = worker_count
+        self._ring: deque[tuple[int, tuple | None, Frame]] = deque(maxlen=replay_size)
+        self._snapshots: dict[str, tuple[int, Frame]] = {}   # kind → latest full-state frame
+        self._resumable_from: dict[str, int] = {}            # kind → oldest id safe to resume after
+        self._subscribers: set[Subscriber] = set()
+        self._next_id     = int(time.time() * 1000) * worker_count + worker_index
+        self._lock        = threading.Lock()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Producer side
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def publish(self, event_name: str, data: bytes, topic: tuple | None = None,
+                snapshot: bool = False) -> int:
+        """Assign the next event id to a frame and queue it for every client
+        whose subscription matches topic.
+
+        Args:
+            event_name: SSE event type seen by the frontend listener
+            data:       Serialised JSON payload
+            topic:      (kind, aggregator guid, device name), or None to send
+                        the frame to every client
+            snapshot:   True if the payload is the complete current state for
+                        its kind, so it can be sent on its own to a client that
+                        connects fresh or cannot be resumed
+
+        Returns:
+            The event id assigned to the frame.
+        """
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += self._id_stride
+            frame = Frame(b"id: %d\nevent: %s\ndata: %s\n\n" % (event_id, event_name.encode(), data))
+            self._ring.append((event_id, topic, frame))
+            if snapshot and topic is not None:
+                self._snapshots[topic[0]] = (event_id, frame)
+
+            recipients = [s for s in self._subscribers if s.accepts(topic)]
+            # Compress here, once per encoding in use, rather than in the
+            # first client to dequeue the frame (an event loop, under asgi)
+            for encoding in {s.encoding for s in recipients if s.encoding}:
+                frame.encoded(encoding)
+
+            for subscriber in recipients:
+                try:
+                    subscriber.queue.put_nowait(frame)
+                except queue.Full:
+                    self._drop(subscriber)
+                if subscriber.waker is not None:
+                    subscriber.waker()
+        return event_id
+
+    def subscriber_count(self, kind: str | None = None) -> int:
+        """Return the number of connected clients, optionally of one kind."""
+        with self._lock:
+            return sum(1 for s in self._subscribers if kind is None or s.kind == kind)
+
+    def has_snapshot(self, kind: str) -> bool:
+        with self._lock:
+            return kind in self._snapshots
+
+    def skip(self, kind: str):
+        """Record that an update of this kind was not published, because
+        nobody was subscribed to it.
+
+        Forgets the kind's full-state frame and makes every earlier event id
+        unresumable for it, since resuming would silently miss the update.
+        """
+        with self._lock:
+            self._snapshots.pop(kind, None)
+            self._resumable_from[kind] = self._next_id
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Client side
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def subscribe(self, kind: str, last_event_id: int | None = None,
+                  guid: str | None = None, device: str | None = None,
+                  waker: Callable[[], None] | None = None, encoding: str | None = None) -> Subscriber:
+        """Register a client and work out which frames it is owed.
+
+        Args:
+            kind:          Kind of frame to receive, e.g. 'metrics' or 'snapshots'
+            last_event_id: Value of the client's Last-Event-ID, if reconnecting
+            guid:          Only receive frames for this aggregator
+            device:        Only receive frames for this device name
+            waker:         Called from the publishing thread after each frame is
+                           queued, for clients served by astream()
+            encoding:      Content-Encoding to send the stream in, or None
+
+        Returns:
+            A Subscriber whose backlog holds the missed frames (or the latest
+            full-state frame) and whose queue receives everything published
+            from now on, with no gap or overlap between the two.
+        """
+        with self._lock:
+            subscriber = Subscriber(kind, guid, device, self._queue_size, waker, encoding)
+            self._fill_backlog(subscriber, last_event_id)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stream(self, subscriber: Subscriber, heartbeat_interval: float) -> Iterator[bytes]:
+        """Yield a subscriber's frames, in its encoding, sending a heartbeat
+        whenever nothing has been published for heartbeat_interval seconds.
+        Ends when the client is dropped for lagging; unsubscribes when closed."""
+        try:
+            if subscriber.opening():
+                yield subscriber.opening()
+            for frame in subscriber.backlog:
+                yield subscriber.render(frame)
+            while True:
+                try:
+                    frame = subscriber.queue.get(timeout=heartbeat_interval)
+                except queue.Empty:
+                    yield subscriber.render(HEARTBEAT_FRAME)
+                    continue
+                if frame is _CLOSE:
+                    if subscriber.closing():
+                        yield subscriber.closing()
+                    return
+                yield subscriber.render(frame)
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def astream(self, subscriber: Subscriber, heartbeat_interval: float,
+                      ready: asyncio.Event) -> AsyncIterator[bytes]:
+        """Asyncio counterpart of stream().
+
+        ready is the asyncio.Event that the subscriber's waker sets (via
+        loop.call_soon_threadsafe) whenever a frame is queued; waiting on it
+        costs a coroutine, not a thread.
+        """
+        try:
+            if subscriber.opening():
+                yield subscriber.opening()
+            for frame in subscriber.backlog:
+                yield subscriber.render(frame)
+            while True:
+                try:
+                    frame = subscriber.queue.get_nowait()
+                except queue.Empty:
+                    # Clear before re-checking, so a frame queued in between
+                    # still sets the event and is not slept through
+                    ready.clear()
+                    if subscriber.queue.empty():
+                        try:
+                            await asyncio.wait_for(ready.wait(), timeout=heartbeat_interval)
+                        except asyncio.TimeoutError:
+                            yield subscriber.render(HEARTBEAT_FRAME)
+                    continue
+                if frame is _CLOSE:
+                    if subscriber.closing():
+                        yield subscriber.closing()
+                    return
+                yield subscriber.render(frame)
+        finally:
+            self.unsubscribe(subscriber)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Internals (call with self._lock held)
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _fill_backlog(self, subscriber: Subscriber, last_event_id: int | None):
+        """Set the frames to send a new subscriber before its live queue."""
+        issued_here = last_event_id is not None and last_event_id % self._id_stride == self._id_offset
+        if issued_here and self._ring:
+            oldest, newest = self._ring[0][0], self._ring[-1][0]
+            if (oldest - self._id_stride <= last_event_id <= newest
+                    and last_event_id >= self._resumable_from.get(subscriber.kind, 0)):
+                subscriber.backlog = [
+                    frame for event_id, topic, frame in self._ring
+                    if event_id > last_event_id and subscriber.accepts(topic)
+                ]
+                return
+
+        # Fresh connection, or not resumable: start from the latest full
+        # state and whatever was published after it
+        snapshot = self._snapshots.get(subscriber.kind)
+        if snapshot is not None:
+            snapshot_id, snapshot_frame = snapshot
+            subscriber.backlog = [snapshot_frame] + [
+                frame for event_id, topic, frame in self._ring
+                if event_id > snapshot_id and subscriber.accepts(topic)
+            ]
+            return
+
+        subscriber.needs_snapshot = True
+        if last_event_id is not None:
+            subscriber.backlog = [RESYNC_FRAME]
+
+    def _drop(self, subscriber: Subscriber):
+        """Disconnect a subscriber whose queue is full."""
+        self._subscribers.discard(subscriber)
+        subscriber.lagged = True
+        while True:
+            try:
+                subscriber.queue.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.queue.put_nowait(_CLOSE)
+        _logger.info("SSE client dropped after falling %d events behind", self._queue_size)
@@ -0,0 +1,168 @@
+"""
+api/writer_channel.py
+
+Hands validated snapshots from ingest worker processes to the single process
+that writes them (server.py serve).
+
+SQLite allows one writer at a time. Letting several ingest processes write
+would make them queue on the database lock, and each would keep its own
+identity cache and group-commit queue. Instead every ingest worker parses
+and validates requests in parallel, then sends the resulting records over a
+local socket to one designated writer process, which stores them through an
+ordinary IngestAPI. The writer's reply carries the HTTP status (201 stored,
+202 queued, 503 queue full, 504 durable wait timed out), so clients see
+exactly what a single-process ingest API would return.
+
+    ingest worker ─┐
+    ingest worker ─┼──► WriterServer ──► IngestAPI.write_snapshots() ──► SQLite
+    ingest worker ─┘   (one process)       └─► ChangeNotifier ──► read workers
+
+Usage:
+    # writer process
+    WriterServer(ingest, address, authkey).serve_forever()
+
+    # ingest worker
+    ingest.use_remote_writer(WriterClient(address, authkey))
+"""
+
+import logging
+import threading
+from multiprocessing.connection import Client, Connection, Listener
+
+_logger = logging.getLogger(__name__)
+
+# How long a worker keeps trying to reach the writer, e.g. while it restarts
+CONNECT_ATTEMPTS    = 10
+CONNECT_RETRY_DELAY = 0.5   # seconds
+
+# Sent instead of a (records, durable) tuple to ask for the writer's
+# maintenance counters (see retention.py)
+STATS_REQUEST = 'maintenance_stats'
+
+
+class WriterError(Exception):
+    """The designated writer failed to store a batch; carries its message."""
+
+
+class WriterServer:
+    """Accepts connections from ingest workers and stores what they send.
+
+    Each connection gets its own thread. Messages are (AggregatorRecord
+    list, durable) tuples; replies are (status, error message or None).
+    STATS_REQUEST is answered with IngestAPI.maintenance_stats().
+
+    Args:
+        ingest:  The IngestAPI that performs the writes
+        address: Unix socket path to listen on
+        authkey: Shared secret every worker must present
+    """
+
+    def __init__(self, ingest, address: str, authkey: bytes):
+        self._ingest   = ingest
+        self._listener = Listener(address, family='AF_UNIX', authkey=authkey)
+
+    def serve_forever(self):
+        _logger.info("Designated writer listening on %s", self._listener.address)
+        while True:
+            try:
+                connection = self._listener.accept()
+            except Exception as e:
+                # A worker presenting a bad key, or closing mid-handshake
+                _logger.warning("Writer rejected a connection: %s", str(e))
+                continue
+            threading.Thread(
+                target=self._serve_connection, args=(connection,), name='WriterConnection', daemon=True
+            ).start()
+
+    def _serve_connection(self, connection: Connection):
+        with connection:
+            while True:
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    return
+                if message == STATS_REQUEST:
+                    try:
+                        connection.send(self._ingest.maintenance_stats())
+                    except OSError:
+                        return
+                    continue
+                records, durable = message
+                try:
+                    reply = self._ingest.write_snapshots(records, durable)
+                except Exception as e:
+                    _logger.exception("Designated writer failed to store %d snapshot(s): %s",
+                                      len(records), str(e))
+                    reply = (500, str(e))
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+
+
+class WriterClient:
+    """Ingest worker side: sends snapshots to the designated writer.
+
+    Connections are not thread-safe, so each request thread opens and keeps
+    its own.
+
+    Args:
+        address: Unix socket path of the WriterServer
+        authkey: Shared secret the WriterServer expects
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self._address = address
+        self._authkey = authkey
+        self._local   = threading.local()
+
+    def write(self, records: list, durable: bool) -> tuple[int, str | None]:
+        """Have the writer store records.
+
+        Returns:
+            (HTTP status, error message or None), as from
+            IngestAPI.write_snapshots().
+
+        Raises:
+            WriterError: If the writer raised while storing the batch, or
+                         cannot be reached.
+        """
+        connection = self._connection()
+        try:
+            connection.send((records, durable))
+            status, message = connection.recv()
+        except (EOFError, OSError) as e:
+            # The writer restarted under us. The batch may or may not have been
+            # committed, so report failure and let the agent retry it.
+            self._local.connection = None
+            raise WriterError(f'Lost connection to the designated writer: {e}')
+        if status == 500:
+            raise WriterError(message)
+        return status, message
+
+    def maintenance_stats(self) -> dict:
+        """Fetch the writer's maintenance counters.
+
+        Raises:
+            WriterError: If the writer cannot be reached.
+        """
+        connection = self._connection()
+        try:
+            connection.send(STATS_REQUEST)
+            return connection.recv()
+        except (EOFError, OSError) as e:
+            self._local.connection = None
+            raise WriterError(f'Lost connection to the designated writer: {e}')
+
+    def _connection(self) -> Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                connection = Client(self._address, family='AF_UNIX', authkey=self._authkey)
+                self._local.connection = connection
+                return connection
+            except (FileNotFoundError, ConnectionRefusedError):
+                threading.Event().wait(CONNECT_RETRY_DELAY)
+        raise WriterError(f'Designated writer is not reachable at {self._address}')
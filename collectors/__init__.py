@@ -35,7 +35,9 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from config import Config
 from collectors.snapshot_builder import build_snapshot
+from collectors.metrics_codec import WIRE_JSON
 from collectors.uploader_queue import UploaderQueue
+from compression import DEFAULT_MIN_BYTES
 
 _logger = logging.getLogger(__name__)
 
@@ -65,8 +67,9 @@ for _loader, _module_name, _is_pkg in pkgutil.iter_modules(__path__):
 # Packaging helper
 # ---------------------------------------------------------------------------
 
-def _package(collector: dict) -> str | None:
-    """Package a single-device collector's result into a snapshot JSON string.
+def _package(collector: dict, wire_format: str = WIRE_JSON) -> str | bytes | None:
+    """Package a single-device collector's result into a snapshot, serialized
+    as JSON or in the binary wire format.
 
     Multi-device collectors are expanded into individual single-device entries
     before this is called (see run_agent), so this function always handles
@@ -83,7 +86,8 @@ def _package(collector: dict) -> str | None:
     return build_snapshot(
         aggregator_name=collector["aggregator_name"],
         aggregator_guid=collector["aggregator_guid"],
-        device_metrics=device_metrics
+        device_metrics=device_metrics,
+        wire_format=wire_format
     )
 
 
@@ -167,10 +171,10 @@ def _collector_loop(collector: dict, upload_queue: UploaderQueue):
         if (datetime.now() - last_run).total_seconds() >= interval:
             last_run = datetime.now()
             try:
-                raw_json = _package(collector)
-                if raw_json is None:
+                payload = _package(collector, upload_queue.wire_format)
+                if payload is None:
                     continue
-                upload_queue.enqueue(raw_json)
+                upload_queue.enqueue(payload)
                 _logger.debug("Collector '%s' device '%s' snapshot enqueued", name, device)
             except Exception as e:
                 _logger.exception("Collector '%s' device '%s' failed during packaging: %s",
@@ -266,7 +270,13 @@ def run_agent(collector_names: list = None):
         raise ValueError("No collector devices found after expansion.")
 
     # Start the shared uploader queue before any collector threads
-    upload_queue = UploaderQueue(ingest_url=ingest_url)
+    compression  = getattr(config.client, 'compression', None)
+    upload_queue = UploaderQueue(
+        ingest_url=ingest_url,
+        encoding=getattr(compression, 'encoding', None),
+        compress_min_bytes=getattr(compression, 'min_bytes', DEFAULT_MIN_BYTES),
+        wire_format=getattr(config.client, 'wire_format', WIRE_JSON),
+    )
     upload_queue.start()
 
     # Start one thread per device
@@ -0,0 +1,355 @@
+"""
+collectors/metrics_codec.py
+
+Fast conversion between the snapshot JSON defined by metrics_datamodel.py
+and the plain values each side of the system actually works with.
+
+dataclasses_json converts DTOs reflectively: it walks every field through
+marshmallow and builds a dataclass instance per metric, which for a large
+PokemonInfo snapshot costs more than storing it in SQLite. The functions
+here perform the same conversions written out for this one schema, with no
+intermediate DTO tree:
+
+    encode_snapshot()     metric dicts → snapshot JSON            (agent)
+    decode_aggregator()   parsed JSON  → AggregatorRecord tuples  (ingest API)
+
+A compact binary alternative to the JSON, sent with Content-Type
+BINARY_CONTENT_TYPE, carries the same data with each snapshot's metric names
+in one string table and its values as one contiguous float64 array:
+
+    encode_snapshot_binary()    metric dicts → binary message        (agent)
+    decode_aggregators_binary() binary body  → AggregatorRecord list (ingest API)
+
+Decoding follows what DTO_Aggregator.from_dict() accepted — numeric
+timestamps, values coerced with float(), missing optional fields defaulted,
+unknown keys ignored — but reports malformed input as a SnapshotFormatError
+naming the offending field.
+
+The field names used here are checked against the DTO dataclasses when the
+module is imported, so renaming a DTO field without updating the codec fails
+straight away rather than silently producing the wrong JSON.
+
+Usage:
+    from collectors.metrics_codec import encode_snapshot, decode_aggregator
+
+    raw_json = encode_snapshot("Devices", guid, {"SavageLaptop": {"cpu-usage": 14.2}})
+    record   = decode_aggregator(json.loads(raw_json))
+    for device in record.devices:
+        for snapshot in device.snapshots:
+            print(device.name, snapshot.epoch, dict(zip(snapshot.names, snapshot.values)))
+"""
+
+import sys
+import json
+import time
+import struct
+import dataclasses
+from array import array
+from uuid import UUID
+from typing import NamedTuple
+
+from collectors.metrics_datamodel import (
+    DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+)
+
+
+JSON_CONTENT_TYPE   = 'application/json'
+BINARY_CONTENT_TYPE = 'application/x-metrics-snapshot'
+
+# Values in config.json's client.wire_format
+WIRE_JSON   = 'json'
+WIRE_BINARY = 'binary'
+
+
+class SnapshotFormatError(ValueError):
+    """A snapshot does not match the DTO_Aggregator schema."""
+
+
+class SnapshotRecord(NamedTuple):
+    epoch:         int           # client UTC timestamp, whole seconds
+    timezone_mins: int
+    names:         list[str]     # metric names, in the order they were sent
+    values:        list[float]   # the matching values
+
+
+class DeviceRecord(NamedTuple):
+    name:      str
+    snapshots: list[SnapshotRecord]
+
+
+class AggregatorRecord(NamedTuple):
+    guid:    str
+    name:    str
+    devices: list[DeviceRecord]
+
+
+# Wire field names, per DTO class, in declaration order
+_SCHEMA = {
+    DTO_Aggregator:   ('guid', 'name', 'devices'),
+    DTO_Device:       ('name', 'data_snapshots'),
+    DTO_DataSnapshot: ('timestamp_utc', 'timezone_mins', 'metrics'),
+    DTO_Metric:       ('name', 'value'),
+}
+
+for _dto, _names in _SCHEMA.items():
+    if tuple(f.name for f in dataclasses.fields(_dto)) != _names:
+        raise ImportError(f'metrics_codec is out of date with {_dto.__name__}; expected fields {_names}')
+
+
+# ---------------------------------------------------------------------------
+# Encoding (agent)
+# ---------------------------------------------------------------------------
+
+def encode_snapshot(aggregator_name: str,
+                    aggregator_guid: UUID | str,
+                    device_metrics: dict[str, dict],
+                    timestamp: float | None = None) -> str:
+    """Serialise one snapshot per device as DTO_Aggregator JSON.
+
+    Produces the same text as building the DTO tree and calling to_json():
+    same key order, same separators and a float timestamp_utc.
+
+    Args:
+        aggregator_name: Name of the aggregator
+        aggregator_guid: UUID identifying the aggregator
+        device_metrics:  Dict mapping device name → flat metrics dict
+        timestamp:       UTC epoch seconds for every snapshot; defaults to now
+
+    Returns:
+        Serialized JSON string.
+
+    Raises:
+        SnapshotFormatError: If a metric value cannot be converted to float.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+
+    devices = []
+    for device_name, metrics in device_metrics.items():
+        try:
+            metric_list = [{'name': name, 'value': float(value)} for name, value in metrics.items()]
+        except (TypeError, ValueError) as e:
+            raise SnapshotFormatError(f'device {device_name!r}: metric value is not a number: {e}') from None
+        devices.append({
+            'name':           device_name,
+            'data_snapshots': [{'timestamp_utc': timestamp, 'timezone_mins': 0, 'metrics': metric_list}],
+        })
+
+    return json.dumps({'guid': str(aggregator_guid), 'name': aggregator_name, 'devices': devices})
+
+
+# ---------------------------------------------------------------------------
+# Decoding (ingest API)
+# ---------------------------------------------------------------------------
+
+def decode_aggregator(data) -> AggregatorRecord:
+    """Validate one parsed DTO_Aggregator JSON object and convert it to records.
+
+    Args:
+        data: The object returned by json.loads() for one snapshot
+
+    Returns:
+        AggregatorRecord with its devices and their snapshots.
+
+    Raises:
+        SnapshotFormatError: If a required field is missing or has the wrong type.
+    """
+    if not isinstance(data, dict):
+        raise SnapshotFormatError('snapshot must be a JSON object')
+    guid = _required(data, 'guid', '')
+    name = _required(data, 'name', '')
+    if not isinstance(guid, str):
+        raise SnapshotFormatError('guid must be a string')
+
+    return AggregatorRecord(guid, name, [
+        _decode_device(device, f'devices[{i}]')
+        for i, device in enumerate(_list(data, 'devices', ''))
+    ])
+
+
+def _decode_device(data, path: str) -> DeviceRecord:
+    if not isinstance(data, dict):
+        raise SnapshotFormatError(f'{path} must be a JSON object')
+    name = _required(data, 'name', path)
+    if not isinstance(name, str):
+        raise SnapshotFormatError(f'{path}.name must be a string')
+
+    return DeviceRecord(name, [
+        _decode_snapshot(snapshot, f'{path}.data_snapshots[{i}]')
+        for i, snapshot in enumerate(_list(data, 'data_snapshots', path))
+    ])
+
+
+def _decode_snapshot(data, path: str) -> SnapshotRecord:
+    if not isinstance(data, dict):
+        raise SnapshotFormatError(f'{path} must be a JSON object')
+
+    timestamp = data.get('timestamp_utc')
+    if timestamp is None:
+        epoch = int(time.time())   # the DTO defaults a missing timestamp to now
+    elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        epoch = int(timestamp)
+    else:
+        raise SnapshotFormatError(f'{path}.timestamp_utc must be a number of seconds since the epoch')
+
+    timezone_mins = data.get('timezone_mins', 0)
+    if not isinstance(timezone_mins, int) or isinstance(timezone_mins, bool):
+        raise SnapshotFormatError(f'{path}.timezone_mins must be an integer')
+
+    metrics = _list(data, 'metrics', path)
+    names   = []
+    values  = []
+    try:
+        for metric in metrics:
+            name = metric['name']
+            if type(name) is not str:
+                raise TypeError
+            names.append(name)
+            values.append(float(metric['value']))
+    except (KeyError, TypeError, ValueError):
+        # Only the failure path pays for working out which metric it was
+        index = len(values)
+        raise SnapshotFormatError(
+            f'{path}.metrics[{index}] must be an object with a string name and a numeric value'
+        ) from None
+
+    return SnapshotRecord(epoch, timezone_mins, names, values)
+
+
+def _required(data: dict, key: str, path: str):
+    try:
+        return data[key]
+    except KeyError:
+        raise SnapshotFormatError(f'{path + "." if path else ""}{key} is required') from None
+
+
+def _list(data: dict, key: str, path: str) -> list:
+    value = data.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise SnapshotFormatError(f'{path + "." if path else ""}{key} must be an array')
+    return value
+
+
+# ---------------------------------------------------------------------------
+# Binary wire format
+# ---------------------------------------------------------------------------
+#
+# A body is one or more messages back to back: the bulk endpoint takes any
+# number, the single-snapshot endpoint exactly one. Everything is
+# little-endian.
+#
+#   message  := MAGIC  guid:16 bytes  name:str  device_count:u16  device*
+#   device   := name:str  snapshot_count:u32  snapshot*
+#   snapshot := timestamp_utc:f64  timezone_mins:i32  metric_count:u32
+#               names_size:u32  names:names_size bytes  values:metric_count × f64
+#   str      := size:u16  UTF-8 bytes
+#
+# names is the snapshot's metric names in UTF-8, separated by NUL characters,
+# so the whole table decodes with one decode() and one split().
+
+_MAGIC    = b'MSN1'   # format and version
+_U16      = struct.Struct('<H')
+_U32      = struct.Struct('<I')
+_SNAPSHOT = struct.Struct('<diII')
+_SWAP     = sys.byteorder != 'little'   # array('d') uses the host byte order
+
+
+def encode_snapshot_binary(aggregator_name: str,
+                           aggregator_guid: UUID | str,
+                           device_metrics: dict[str, dict],
+                           timestamp: float | None = None) -> bytes:
+    """Binary counterpart of encode_snapshot(): one message, one snapshot per device.
+
+    Raises:
+        SnapshotFormatError: If a value is not a number, a metric name
+                             contains NUL, or a name is too long.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    try:
+        parts = [_MAGIC, UUID(str(aggregator_guid)).bytes, _pack_str(aggregator_name),
+                 _U16.pack(len(device_metrics))]
+        for device_name, metrics in device_metrics.items():
+            names = '\0'.join(metrics).encode('utf-8')
+            if names.count(0) != max(len(metrics) - 1, 0):
+                raise SnapshotFormatError(f'device {device_name!r}: metric names cannot contain NUL')
+            values = array('d', map(float, metrics.values()))
+            if _SWAP:
+                values.byteswap()
+            parts += [_pack_str(device_name), _U32.pack(1),
+                      _SNAPSHOT.pack(timestamp, 0, len(metrics), len(names)), names, values.tobytes()]
+    except (TypeError, ValueError, struct.error) as e:
+        if isinstance(e, SnapshotFormatError):
+            raise
+        raise SnapshotFormatError(f'snapshot cannot be encoded: {e}') from None
+    return b''.join(parts)
+
+
+def decode_aggregators_binary(body: bytes) -> list[AggregatorRecord]:
+    """Validate and decode a binary body of one or more messages.
+
+    Raises:
+        SnapshotFormatError: If the body is truncated or not in this format.
+    """
+    view    = memoryview(body)
+    records = []
+    offset  = 0
+    try:
+        while offset < len(body):
+            record, offset = _decode_message(body, view, offset)
+            records.append(record)
+    except SnapshotFormatError:
+        raise
+    except (struct.error, ValueError, IndexError) as e:
+        raise SnapshotFormatError(f'message {len(records)} (from byte {offset}) is truncated or malformed: {e}') from None
+    if not records:
+        raise SnapshotFormatError('body holds no snapshots')
+    return records
+
+
+def _decode_message(body: bytes, view: memoryview, offset: int) -> tuple[AggregatorRecord, int]:
+    if body[offset:offset + 4] != _MAGIC:
+        raise SnapshotFormatError(f'no {BINARY_CONTENT_TYPE} message at byte {offset}')
+    guid            = str(UUID(bytes=body[offset + 4:offset + 20]))
+    name, offset    = _unpack_str(body, offset + 20)
+    (device_count,) = _U16.unpack_from(body, offset)
+    offset += 2
+
+    devices = []
+    for _ in range(device_count):
+        device_name, offset = _unpack_str(body, offset)
+        (snapshot_count,)   = _U32.unpack_from(body, offset)
+        offset += 4
+
+        snapshots = []
+        for _ in range(snapshot_count):
+            timestamp, timezone_mins, count, names_size = _SNAPSHOT.unpack_from(body, offset)
+            offset += _SNAPSHOT.size
+            names   = str(view[offset:offset + names_size], 'utf-8').split('\0') if count else []
+            offset += names_size
+            values  = array('d')
+            values.frombytes(view[offset:offset + 8 * count])
+            offset += 8 * count
+            if len(names) != count or len(values) != count:
+                raise SnapshotFormatError(f'snapshot ending at byte {offset}: expected {count} metric names and values')
+            if _SWAP:
+                values.byteswap()
+            snapshots.append(SnapshotRecord(int(timestamp), timezone_mins, names, values.tolist()))
+        devices.append(DeviceRecord(device_name, snapshots))
+
+    return AggregatorRecord(guid, name, devices), offset
+
+
+def _pack_str(text: str) -> bytes:
+    data = text.encode('utf-8')
+    return _U16.pack(len(data)) + data
+
+
+def _unpack_str(body: bytes, offset: int) -> tuple[str, int]:
+    (size,) = _U16.unpack_from(body, offset)
+    offset += 2
+    if offset + size > len(body):
+        raise SnapshotFormatError(f'string at byte {offset} runs past the end of the body')
+    return body[offset:offset + size].decode('utf-8'), offset + size
@@ -3,7 +3,8 @@ collectors/snapshot_builder.py
 
 Utility functions for DTO packaging and machine identity.
 Used by collectors/__init__.py to convert raw metric dicts into serialized
-DTO_Aggregator JSON ready to POST to the ingest API.
+DTO_Aggregator JSON (or the equivalent binary message) ready to POST to the
+ingest API.
 
 Nothing in here is collector-specific — it works with any flat dict of
 metric name → value pairs regardless of where the data came from.
@@ -12,11 +13,7 @@ metric name → value pairs regardless of where the data came from.
 import uuid
 import logging
 from uuid import UUID
-from dataclasses import dataclass
-from dataclasses_json import dataclass_json
-from collectors.metrics_datamodel import (
-    DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
-)
+from collectors.metrics_codec import WIRE_BINARY, WIRE_JSON, encode_snapshot, encode_snapshot_binary
 
 try:
     import winreg
@@ -69,33 +66,10 @@ def get_machine_guid() -> UUID:
 # DTO packaging
 # ---------------------------------------------------------------------------
 
-@dataclass_json
-@dataclass
-class _AggregatorPackage(DTO_Aggregator):
-    """Internal packaging class — not used directly outside this module."""
-
-    def __init__(self, aggregator_name: str, aggregator_guid: UUID):
-        self.name    = aggregator_name
-        self.guid    = aggregator_guid
-        self.devices = []
-
-    def _ensure_device(self, name: str) -> DTO_Device:
-        for device in self.devices:
-            if device.name == name:
-                return device
-        new_device = DTO_Device(name=name)
-        self.devices.append(new_device)
-        return new_device
-
-    def _new_snapshot(self, device: DTO_Device) -> DTO_DataSnapshot:
-        snapshot = DTO_DataSnapshot()
-        device.data_snapshots.append(snapshot)
-        return snapshot
-
-
 def build_snapshot(aggregator_name: str,
                    aggregator_guid: UUID,
-                   device_metrics: dict[str, dict]) -> str:
+                   device_metrics: dict[str, dict],
+                   wire_format: str = WIRE_JSON) -> str | bytes:
     """Package metrics into a serialized DTO_Aggregator JSON string.
 
     Args:
@@ -105,18 +79,14 @@ def build_snapshot(aggregator_name: str,
                           Single device:  {"SavageLaptop": {"cpu-usage": 14.2, ...}}
                           Multi device:   {"gen9ou": {"Garchomp": 12, ...},
                                            "gen8ou": {"Toxapex": 9, ...}}
+        wire_format:      WIRE_JSON, or WIRE_BINARY for the compact binary
+                          encoding (sent as metrics_codec.BINARY_CONTENT_TYPE)
 
     Returns:
-        Serialized JSON string of the fully packaged DTO_Aggregator.
+        Serialized JSON string of the fully packaged DTO_Aggregator, or the
+        binary message as bytes.
     """
-    package = _AggregatorPackage(aggregator_name, aggregator_guid)
-
-    for device_name, metrics in device_metrics.items():
-        device   = package._ensure_device(device_name)
-        snapshot = package._new_snapshot(device)
-        for metric_name, metric_value in metrics.items():
-            snapshot.metrics.append(
-                DTO_Metric(name=metric_name, value=float(metric_value))
-            )
-
-    return package.to_json()
+    # Written straight to the wire format by the codec rather than through a DTO tree
+    if wire_format == WIRE_BINARY:
+        return encode_snapshot_binary(aggregator_name, aggregator_guid, device_metrics)
+    return encode_snapshot(aggregator_name, aggregator_guid, device_metrics)
@@ -22,10 +22,31 @@ is temporarily unavailable.
                     ▼
                    DB
 
+When several snapshots are waiting, the background thread drains up to
+MAX_BATCH_SIZE of them and posts them together to the bulk endpoint
+(<ingest_url>/bulk), which stores the whole batch in one transaction. A lone
+snapshot is still posted to the single-snapshot endpoint. Because one bad
+snapshot fails the whole transaction, a bulk request answered with a 4xx
+(400 malformed, 413 too large) is resent one snapshot at a time; a snapshot
+rejected on its own is logged and dropped, as resending it cannot help.
+Only 5xx responses and network errors are retried with backoff.
+
+With an encoding set, request bodies of at least compress_min_bytes are
+compressed (gzip instead of zstd if the zstandard package is missing), which
+matters for agents on slow links: snapshot JSON repeats the same metric names
+endlessly. If the ingest API answers 415, the queue switches to an encoding
+from the 415's Accept-Encoding header, or to none, and resends straight away.
+An ingest API that predates compressed uploads answers 400 or 500 instead, so
+those get one immediate uncompressed resend before the usual backoff.
+
+With wire_format='binary' snapshots are built and sent in the compact binary
+format from metrics_codec.py instead of JSON; a bulk request is then simply
+the binary messages back to back.
+
 Usage:
     queue = UploaderQueue(ingest_url="http://localhost:5001/aggregator_snapshots")
     queue.start()
-    queue.enqueue(raw_json)   # non-blocking, returns immediately
+    queue.enqueue(payload)    # non-blocking, returns immediately
 """
 
 import logging
@@ -36,6 +57,9 @@ import time
 from dataclasses import dataclass, field
 from datetime import datetime
 
+from compression import ENCODINGS, DEFAULT_MIN_BYTES, GZIP, ZSTD, compress
+from collectors.metrics_codec import BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, WIRE_BINARY, WIRE_JSON
+
 _logger = logging.getLogger(__name__)
 
 # Maximum number of snapshots to hold in memory before dropping the oldest.
@@ -47,12 +71,16 @@ INITIAL_RETRY_DELAY = 5    # seconds before first retry
 MAX_RETRY_DELAY     = 300  # seconds — cap so retries don't stretch to infinity
 BACKOFF_FACTOR      = 2    # multiply delay by this after each failed attempt
 
+# Maximum number of snapshots sent in a single bulk request. Keeps request
+# bodies bounded when a long backlog builds up while the ingest API is down.
+MAX_BATCH_SIZE = 50
+
 
 @dataclass
 class _QueueItem:
     """A single snapshot waiting to be uploaded, with retry metadata."""
 
-    raw_json:    str               # serialized DTO_Aggregator JSON
+    payload:     str | bytes       # serialized snapshot, in the queue's wire format
     enqueued_at: datetime          # when this item entered the queue
     attempts:    int   = 0         # how many upload attempts have been made
     next_retry:  float = field(    # earliest time (epoch) to attempt next upload
@@ -67,13 +95,33 @@ class UploaderQueue:
     backoff. The queue is bounded to prevent memory exhaustion.
     """
 
-    def __init__(self, ingest_url: str):
+    def __init__(self, ingest_url: str, bulk_url: str | None = None,
+                 encoding: str | None = None, compress_min_bytes: int = DEFAULT_MIN_BYTES,
+                 wire_format: str = WIRE_JSON):
         """
         Args:
-            ingest_url: Full URL of the ingest API snapshot endpoint,
-                        e.g. "http://localhost:5001/aggregator_snapshots"
+            ingest_url:         Full URL of the ingest API snapshot endpoint,
+                                e.g. "http://localhost:5001/aggregator_snapshots"
+            bulk_url:           Full URL of the bulk snapshot endpoint. Defaults
+                                to ingest_url + "/bulk".
+            encoding:           Content-Encoding for request bodies ('zstd' or
+                                'gzip'), or None (the default) to send them
+                                uncompressed
+            compress_min_bytes: Bodies smaller than this are sent uncompressed
+            wire_format:        WIRE_JSON or WIRE_BINARY; every payload
+                                enqueued must be built in this format
         """
+        if wire_format not in (WIRE_JSON, WIRE_BINARY):
+            raise ValueError(f"wire_format must be '{WIRE_JSON}' or '{WIRE_BINARY}'")
+        self.wire_format  = wire_format
+        self._mimetype    = BINARY_CONTENT_TYPE if wire_format == WIRE_BINARY else JSON_CONTENT_TYPE
         self._ingest_url  = ingest_url
+        self._bulk_url    = bulk_url or f"{ingest_url.rstrip('/')}/bulk"
+        # zstd needs the zstandard package; without it gzip is the next best
+        self._encoding    = GZIP if encoding == ZSTD and ZSTD not in ENCODINGS else encoding
+        if self._encoding not in ENCODINGS:
+            self._encoding = None
+        self._min_bytes   = compress_min_bytes
         self._queue       = queue.Queue(maxsize=MAX_QUEUE_SIZE)
         self._retry_items = []          # items waiting for their next retry
         self._lock        = threading.Lock()
@@ -95,7 +143,7 @@ class UploaderQueue:
         self._running = False
         _logger.info("UploaderQueue stopping")
 
-    def enqueue(self, raw_json: str):
+    def enqueue(self, payload: str | bytes):
         """Add a serialized snapshot to the upload queue.
 
         Non-blocking — returns immediately regardless of queue state.
@@ -103,9 +151,10 @@ class UploaderQueue:
         warning is logged, ensuring recent data is always prioritised.
 
         Args:
-            raw_json: Serialized DTO_Aggregator JSON string from build_snapshot()
+            payload: Serialized snapshot from build_snapshot(), built with
+                     this queue's wire_format
         """
-        item = _QueueItem(raw_json=raw_json, enqueued_at=datetime.utcnow())
+        item = _QueueItem(payload=payload, enqueued_at=datetime.utcnow())
         try:
             self._queue.put_nowait(item)
             _logger.debug("Snapshot enqueued (queue size: ~%d)", self._queue.qsize())
@@ -132,10 +181,14 @@ class UploaderQueue:
 
         On each iteration:
           1. Re-enqueue any retry items whose next_retry time has passed
-          2. Pull the next item from the queue (blocking with timeout)
-          3. Attempt to POST it to the ingest API
-          4. On success: discard the item
-          5. On failure: calculate next retry time and park it in _retry_items
+          2. Pull the next item from the queue (blocking with timeout), then
+             drain up to MAX_BATCH_SIZE - 1 more without blocking
+          3. Attempt to POST them to the ingest API in one request
+          4. On success: discard the items
+          5. On a 4xx for a bulk request: resend the items one at a time, and
+             drop any the ingest API still rejects
+          6. On a 5xx or network error: calculate next retry time and park
+             them in _retry_items
         """
         while self._running:
             self._requeue_ready_retries()
@@ -145,7 +198,14 @@ class UploaderQueue:
             except queue.Empty:
                 continue
 
-            self._attempt_upload(item)
+            batch = [item]
+            while len(batch) < MAX_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._attempt_upload(batch)
 
     def _requeue_ready_retries(self):
         """Move any retry items whose wait period has elapsed back into the
@@ -167,44 +227,139 @@ class UploaderQueue:
             except queue.Full:
                 _logger.warning("Queue full during retry re-queue, snapshot dropped")
 
-    def _attempt_upload(self, item: _QueueItem):
-        """Try to POST a single snapshot to the ingest API.
+    def _attempt_upload(self, items: list[_QueueItem]):
+        """Try to POST a batch of snapshots to the ingest API.
+
+        A single item is posted to the snapshot endpoint as-is. Several items
+        are joined into one JSON array (or binary messages are concatenated)
+        and posted to the bulk endpoint, which
+        stores them all in one transaction — so the batch succeeds or fails
+        as a whole.
 
-        On success the item is discarded. On failure the retry delay is
-        calculated using exponential backoff and the item is parked in
-        _retry_items to be re-queued later.
+        On success the items are discarded. A 4xx for a bulk request means
+        the ingest API rejected something in it, so each item is then sent on
+        its own and only the ones rejected again are dropped. On a 5xx or a
+        network error each item's retry delay is calculated using exponential
+        backoff and the items are parked in _retry_items to be re-queued later.
 
         Args:
-            item: The _QueueItem to attempt uploading
+            items: The _QueueItems to attempt uploading
         """
-        item.attempts += 1
-        try:
-            response = requests.post(
-                self._ingest_url,
-                data=item.raw_json,
-                headers={'Content-Type': 'application/json'},
-                timeout=10
+        for item in items:
+            item.attempts += 1
+
+        status = self._send(items)
+        if len(items) > 1 and not _retryable(status) and status not in (201, 202):
+            _logger.warning(
+                "Ingest API rejected a bulk request of %d snapshots; sending them one at a time",
+                len(items)
             )
-            if response.status_code == 201:
-                age = (datetime.utcnow() - item.enqueued_at).total_seconds()
-                _logger.info(
-                    "Snapshot uploaded successfully (attempt %d, age %.1fs)",
-                    item.attempts, age
-                )
-                # Item is discarded — do not add to retry list
-                return
+            for item in items:
+                self._settle([item], self._send([item]))
+            return
+
+        self._settle(items, status)
+
+    def _send(self, items: list[_QueueItem]) -> int | None:
+        """POST items in one request and return the response status code, or
+        None if the request failed at the network level."""
+        if len(items) == 1:
+            url  = self._ingest_url
+            body = items[0].payload
+        elif self.wire_format == WIRE_BINARY:
+            url  = self._bulk_url
+            body = b"".join(item.payload for item in items)
+        else:
+            url  = self._bulk_url
+            body = "[" + ",".join(item.payload for item in items) + "]"
 
+        try:
+            response = self._post(url, body.encode('utf-8') if isinstance(body, str) else body)
+        except requests.exceptions.RequestException as e:
+            _logger.warning(
+                "Upload of %d snapshot(s) failed (network error): %s",
+                len(items), str(e)
+            )
+            return None
+
+        # 202 means the ingest API accepted the batch into its
+        # write-behind queue; it is committed shortly afterwards.
+        if response.status_code in (201, 202):
+            oldest = min(item.enqueued_at for item in items)
+            age    = (datetime.utcnow() - oldest).total_seconds()
+            _logger.info(
+                "%d snapshot(s) uploaded successfully (oldest age %.1fs)",
+                len(items), age
+            )
+        else:
             _logger.error(
-                "Ingest API returned %d on attempt %d: %s",
-                response.status_code, item.attempts, response.text
+                "Ingest API returned %d for %d snapshot(s): %s",
+                response.status_code, len(items), response.text
             )
+        return response.status_code
+
+    def _settle(self, items: list[_QueueItem], status: int | None):
+        """Discard, drop or schedule a retry for items given the status their
+        upload got (None for a network error)."""
+        if status in (201, 202):
+            return   # uploaded — do not add to retry list
+        if not _retryable(status):
+            # The ingest API will reject these however often they are sent
+            for item in items:
+                _logger.error(
+                    "Dropping snapshot enqueued at %s: the ingest API rejected it with %d",
+                    item.enqueued_at.isoformat(), status
+                )
+            return
+        for item in items:
+            self._schedule_retry(item)
 
-        except requests.exceptions.RequestException as e:
+    def _post(self, url: str, data: bytes) -> requests.Response:
+        """POST a JSON body, compressed if it is large enough.
+
+        A 415 for a compressed body means the ingest API cannot decode that
+        encoding: fall back to one its Accept-Encoding header lists, or to
+        none, for this and every later request, and send the body again.
+
+        An ingest API older than compressed uploads does not answer 415; it
+        fails to parse the body and answers 400 or 500. Either for a
+        compressed body gets one immediate uncompressed resend, and if that
+        is accepted compression stays off for every later request.
+        """
+        while True:
+            headers  = {'Content-Type': self._mimetype}
+            encoding = self._encoding if len(data) >= self._min_bytes else None
+            if encoding is None:
+                return requests.post(url, data=data, headers=headers, timeout=10)
+
+            headers['Content-Encoding'] = encoding
+            response = requests.post(url, data=compress(data, encoding), headers=headers, timeout=10)
+            if response.status_code in (400, 500):
+                del headers['Content-Encoding']
+                response = requests.post(url, data=data, headers=headers, timeout=10)
+                if response.status_code in (201, 202):
+                    self._encoding = None
+                    _logger.warning(
+                        "Ingest API could not read a %s request body but accepted it uncompressed; "
+                        "sending uncompressed bodies from now on", encoding
+                    )
+                return response
+            if response.status_code != 415:
+                return response
+
+            supported = {e.strip().lower() for e in response.headers.get('Accept-Encoding', '').split(',')}
+            self._encoding = next((e for e in ENCODINGS if e != encoding and e in supported), None)
             _logger.warning(
-                "Upload attempt %d failed (network error): %s",
-                item.attempts, str(e)
+                "Ingest API cannot decode %s request bodies; sending %s from now on",
+                encoding, self._encoding or "uncompressed bodies"
             )
 
+    def _schedule_retry(self, item: _QueueItem):
+        """Park a failed item in _retry_items with exponential backoff.
+
+        Args:
+            item: The _QueueItem whose upload attempt just failed
+        """
         # Schedule retry with exponential backoff, capped at MAX_RETRY_DELAY
         delay          = min(INITIAL_RETRY_DELAY * (BACKOFF_FACTOR ** (item.attempts - 1)),
                              MAX_RETRY_DELAY)
@@ -215,3 +370,9 @@ class UploaderQueue:
         )
         with self._lock:
             self._retry_items.append(item)
+
+
+def _retryable(status: int | None) -> bool:
+    """Whether an upload that got this status (None for a network error) may
+    succeed if sent again. Any other 4xx rejects the request itself."""
+    return status is None or status >= 500 or status in (408, 429)
@@ -0,0 +1,214 @@
+"""
+compression.py
+
+HTTP Content-Encoding support shared by the agent and both APIs.
+
+Snapshot and /metrics JSON is dominated by the same Pokémon, move and metric
+names repeated over and over, so it shrinks several times over when
+compressed. This module provides the pieces each side needs:
+
+  - agent:      compress() a request body, in the encoding the ingest API
+                last accepted (it answers 415 with an Accept-Encoding list
+                if it cannot decode one)
+  - ingest API: decompress() a request body according to its Content-Encoding
+  - read API:   negotiate() an encoding from Accept-Encoding, then compress()
+                whole responses or, for SSE, encode each event once with
+                compress_chunk() so every client can be sent the same bytes
+
+zstd is used when the zstandard package is installed, gzip otherwise. Both
+sides negotiate, so a peer without zstandard is never sent zstd.
+
+Usage:
+    from compression import compress, decompress, negotiate
+
+    encoding = negotiate(request.headers.get('Accept-Encoding'))   # 'zstd', 'gzip' or None
+    body     = compress(payload, encoding) if encoding else payload
+    payload  = decompress(body, request.headers.get('Content-Encoding'))
+"""
+
+import gzip
+import zlib
+from werkzeug.http import parse_accept_header
+
+try:
+    import zstandard
+    _ZSTD_AVAILABLE = True
+except ImportError:
+    _ZSTD_AVAILABLE = False
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# Encodings this process can produce and decode, most preferred first
+ENCODINGS: tuple[str, ...] = (ZSTD, GZIP) if _ZSTD_AVAILABLE else (GZIP,)
+
+# Bodies smaller than this are sent as they are: compressing them saves
+# less than the CPU it costs
+DEFAULT_MIN_BYTES = 1024
+
+# Compression levels: fast enough to run on every response
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Upper bound on a decompressed request body, so a small compressed upload
+# cannot expand without limit
+MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+
+# Fixed gzip member header (no name, mtime 0, OS unknown) for SSE streams
+_GZIP_STREAM_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+class ContentEncodingError(ValueError):
+    """A request body could not be decoded."""
+
+
+class UnsupportedEncodingError(ContentEncodingError):
+    """The body uses a Content-Encoding this process cannot decode."""
+
+
+class BodyTooLargeError(ContentEncodingError):
+    """The body decompresses to more than MAX_DECOMPRESSED_BYTES."""
+
+
+# ---------------------------------------------------------------------------
+# Whole bodies
+# ---------------------------------------------------------------------------
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data as a complete body in the given encoding."""
+    if encoding == ZSTD and _ZSTD_AVAILABLE:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == GZIP:
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    raise UnsupportedEncodingError(f'Unsupported Content-Encoding {encoding!r}')
+
+
+def decompress(data: bytes, encoding: str | None, max_size: int = MAX_DECOMPRESSED_BYTES) -> bytes:
+    """Undo a request's Content-Encoding.
+
+    Args:
+        data:     The body as received
+        encoding: Value of the Content-Encoding header, or None
+        max_size: Largest decompressed size accepted
+
+    Returns:
+        The decoded body (data itself when it was not encoded).
+
+    Raises:
+        UnsupportedEncodingError: For an encoding not in ENCODINGS.
+        BodyTooLargeError:        If the body expands beyond max_size.
+        ContentEncodingError:     If the body is not valid for its encoding.
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return data
+    if encoding in (GZIP, 'x-gzip'):
+        return _gunzip(data, max_size)
+    if encoding == ZSTD and _ZSTD_AVAILABLE:
+        return _unzstd(data, max_size)
+    raise UnsupportedEncodingError(f'Unsupported Content-Encoding {encoding!r}')
+
+
+def _gunzip(data: bytes, max_size: int) -> bytes:
+    decoder = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    try:
+        result = decoder.decompress(data, max_size + 1)
+    except zlib.error as e:
+        raise ContentEncodingError(f'Invalid gzip body: {e}') from None
+    if len(result) > max_size:
+        raise BodyTooLargeError(f'Body is larger than {max_size} bytes when decompressed')
+    if not decoder.eof:
+        raise ContentEncodingError('Invalid gzip body: truncated')
+    return result
+
+
+def _unzstd(data: bytes, max_size: int) -> bytes:
+    reader = zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True)
+    try:
+        result = reader.read(max_size + 1)
+    except zstandard.ZstdError as e:
+        raise ContentEncodingError(f'Invalid zstd body: {e}') from None
+    if len(result) > max_size:
+        raise BodyTooLargeError(f'Body is larger than {max_size} bytes when decompressed')
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Negotiation
+# ---------------------------------------------------------------------------
+
+def negotiate(accept_encoding: str | None, available: tuple[str, ...] = ENCODINGS) -> str | None:
+    """Pick the encoding to send a response in.
+
+    Args:
+        accept_encoding: The request's Accept-Encoding header, or None
+        available:       Candidate encodings, most preferred first
+
+    Returns:
+        The client's highest-quality choice among available (ties go to the
+        earlier entry), or None to send the body unencoded.
+    """
+    if not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accepted.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# ---------------------------------------------------------------------------
+# Streams (SSE)
+# ---------------------------------------------------------------------------
+
+def compress_chunk(data: bytes, encoding: str) -> bytes:
+    """Compress one piece of a streamed body on its own.
+
+    The result depends only on data, not on what was sent before, so it can
+    be computed once and sent to every client. Concatenated after
+    stream_header(), the chunks form a valid stream: each zstd chunk is a
+    complete frame, and each gzip chunk is a run of deflate blocks ending
+    on a byte boundary (a sync flush) that refers back to nothing earlier.
+    """
+    if encoding == ZSTD and _ZSTD_AVAILABLE:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == GZIP:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    raise UnsupportedEncodingError(f'Unsupported Content-Encoding {encoding!r}')
+
+
+class StreamEncoder:
+    """Frames the output of compress_chunk() for one client's stream.
+
+    gzip needs a header before the first chunk and a trailer with the CRC
+    and length of everything sent; zstd frames need neither.
+
+    Args:
+        encoding: The stream's Content-Encoding
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self._crc     = 0
+        self._size    = 0
+
+    def header(self) -> bytes:
+        return _GZIP_STREAM_HEADER if self.encoding == GZIP else b''
+
+    def chunk(self, data: bytes, encoded: bytes) -> bytes:
+        """Account for data and return its already compressed form, encoded."""
+        if self.encoding == GZIP:
+            self._crc  = zlib.crc32(data, self._crc)
+            self._size += len(data)
+        return encoded
+
+    def trailer(self) -> bytes:
+        if self.encoding != GZIP:
+            return b''
+        # An empty final block, then CRC32 and length mod 2^32
+        return (b'\x03\x00'
+                + self._crc.to_bytes(4, 'little')
+                + (self._size & 0xFFFFFFFF).to_bytes(4, 'little'))
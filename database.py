@@ -0,0 +1,137 @@
+"""
+database.py
+
+Shared SQLAlchemy engine factory. Every component that talks to the metrics
+database (IngestAPI, ReadAPI, init_db.py, migrations.py) builds its engine
+here, so the storage profile in the "database" section of config.json is
+applied the same way everywhere.
+
+For SQLite the profile is applied as PRAGMAs on every new pooled connection:
+
+    auto_vacuum      "incremental" lets the retention task (api/retention.py)
+                     hand freed pages back to the filesystem. Only takes
+                     effect when the database file is created; convert an
+                     existing one with 'python migrations.py vacuum'
+    journal_mode     "wal" lets readers run while a writer commits, instead
+                     of the default rollback journal that blocks them
+    synchronous      "normal" is durable across application crashes in WAL
+                     mode and only fsyncs at checkpoints
+    cache_size_kib   page cache per connection
+    mmap_size_mb     memory-mapped I/O for reads
+    busy_timeout_ms  how long to wait for a lock before "database is locked"
+    pool_size        connections kept open per engine
+
+Any key that is missing falls back to the defaults below. Non-SQLite
+connection strings are passed through with only the pool settings applied.
+
+Every engine maps the tables declared in models.PARTITION_SCHEMA to the
+main database. Partitioned storage (partitions.py, configured under
+database.partitions) re-points them per session.
+
+Usage:
+    from database import create_db_engine
+    engine = create_db_engine(config)                          # readers
+    engine = create_db_engine(config, immediate_writes=True)   # the writer
+"""
+
+import logging
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+from models import PARTITION_SCHEMA
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_AUTO_VACUUM     = 'incremental'
+DEFAULT_JOURNAL_MODE    = 'wal'
+DEFAULT_SYNCHRONOUS     = 'normal'
+DEFAULT_CACHE_SIZE_KIB  = 65536   # 64 MiB
+DEFAULT_MMAP_SIZE_MB    = 256
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_POOL_SIZE       = 8
+
+_AUTO_VACUUM   = {'none', 'full', 'incremental'}
+_JOURNAL_MODES = {'delete', 'truncate', 'persist', 'memory', 'wal', 'off'}
+_SYNCHRONOUS   = {'off', 'normal', 'full', 'extra'}
+
+
+def create_db_engine(config, immediate_writes: bool = False) -> Engine:
+    """Create an engine for config.database with the storage profile applied.
+
+    Args:
+        config:           Loaded Config instance
+        immediate_writes: Start every transaction with BEGIN IMMEDIATE so the
+                          write lock is taken up front. Use this for the
+                          engine that writes: a deferred transaction that
+                          reads first and writes later cannot wait for the
+                          lock in WAL mode and fails with "database is
+                          locked" straight away if another process wrote in
+                          between.
+
+    Returns:
+        A configured SQLAlchemy Engine.
+
+    Raises:
+        ValueError: If auto_vacuum, journal_mode or synchronous is not a valid
+                    SQLite value.
+    """
+    settings  = config.database
+    url       = settings.connection_string
+    pool_size = int(getattr(settings, 'pool_size', DEFAULT_POOL_SIZE))
+
+    if not url.startswith('sqlite'):
+        return create_engine(url, pool_size=pool_size, pool_pre_ping=True).execution_options(
+            schema_translate_map={PARTITION_SCHEMA: None}
+        )
+
+    auto_vacuum  = str(getattr(settings, 'auto_vacuum',  DEFAULT_AUTO_VACUUM)).lower()
+    journal_mode = str(getattr(settings, 'journal_mode', DEFAULT_JOURNAL_MODE)).lower()
+    synchronous  = str(getattr(settings, 'synchronous',  DEFAULT_SYNCHRONOUS)).lower()
+    if auto_vacuum not in _AUTO_VACUUM:
+        raise ValueError(f"database.auto_vacuum must be one of {sorted(_AUTO_VACUUM)}, got {auto_vacuum!r}")
+    if journal_mode not in _JOURNAL_MODES:
+        raise ValueError(f"database.journal_mode must be one of {sorted(_JOURNAL_MODES)}, got {journal_mode!r}")
+    if synchronous not in _SYNCHRONOUS:
+        raise ValueError(f"database.synchronous must be one of {sorted(_SYNCHRONOUS)}, got {synchronous!r}")
+
+    cache_size_kib  = int(getattr(settings, 'cache_size_kib',  DEFAULT_CACHE_SIZE_KIB))
+    mmap_size_bytes = int(getattr(settings, 'mmap_size_mb',    DEFAULT_MMAP_SIZE_MB)) * 1024 * 1024
+    busy_timeout_ms = int(getattr(settings, 'busy_timeout_ms', DEFAULT_BUSY_TIMEOUT_MS))
+
+    is_memory = url in ('sqlite://', 'sqlite:///:memory:')
+    engine = create_engine(
+        url,
+        # In-memory databases use a single shared connection, so pool
+        # sizing does not apply to them
+        **({} if is_memory else {'pool_size': pool_size, 'max_overflow': pool_size}),
+        connect_args={'timeout': busy_timeout_ms / 1000, 'check_same_thread': False},
+    )
+
+    @event.listens_for(engine, 'connect')
+    def _apply_profile(dbapi_connection, _connection_record):
+        if immediate_writes:
+            # Hand transaction control to the 'begin' hook below
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            # Must come first: once journal_mode has written the header of a
+            # new file, auto_vacuum can only be changed by a VACUUM
+            cursor.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute(f"PRAGMA cache_size=-{cache_size_kib}")
+            cursor.execute(f"PRAGMA mmap_size={mmap_size_bytes}")
+            cursor.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+        finally:
+            cursor.close()
+
+    if immediate_writes:
+        @event.listens_for(engine, 'begin')
+        def _begin_immediate(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    _logger.debug(
+        "Engine created for %s (journal_mode=%s, synchronous=%s, pool_size=%d, immediate_writes=%s)",
+        url, journal_mode, synchronous, pool_size, immediate_writes
+    )
+    return engine.execution_options(schema_translate_map={PARTITION_SCHEMA: None})
@@ -1,14 +1,18 @@
 # init_db.py
 # this initilises the database only needs to be run once
+# re-running it on an existing database is safe and applies any pending
+# schema migrations (see migrations.py)
 # init_db.py
-from sqlalchemy import create_engine
 from models import Base
 from config import Config
+from database import create_db_engine
+from migrations import upgrade
 
 config = Config(__file__)
-engine = create_engine(config.database.connection_string)
+engine = create_db_engine(config, immediate_writes=True)
 
 # sqlite_sequence is an internal SQLite table, skip it
 tables_to_create = [t for name, t in Base.metadata.tables.items() if name != 'sqlite_sequence']
 Base.metadata.create_all(engine, tables=tables_to_create)
-print("Done — tables created in metrics.db")
\ No newline at end of file
+version = upgrade(engine)
+print(f"Done — tables created in metrics.db (schema version {version})")
\ No newline at end of file
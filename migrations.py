@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+migrations.py
+
+Versioned, in-place schema upgrades for the metrics database.
+
+init_db.py creates any missing tables with create_all, but create_all never
+alters a table that already exists — so indexes and columns added after a
+database was first created have to be applied here. Each migration runs in
+its own transaction together with the schema_migrations row that records it,
+so an interrupted upgrade can simply be re-run.
+
+Migrations are append-only: never edit or reorder one that has shipped, add a
+new one with the next version number instead. Every step must also be safe on
+a freshly created database, where create_all has already built the latest
+tables and indexes (hence IF NOT EXISTS everywhere).
+
+Usage:
+    python migrations.py            — upgrade to the latest version
+    python migrations.py status     — print current and latest versions
+    python migrations.py vacuum     — switch an existing database to
+                                      incremental auto-vacuum (rewrites the
+                                      whole file once; stop the APIs first)
+"""
+
+import sys
+import logging
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from config import Config
+from database import create_db_engine
+from models import SchemaMigration
+from partitions import partition_store
+from api.materialized import pack_latest_values
+
+_logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    name:    str
+    apply:   Callable[[Connection], None]
+
+
+# ---------------------------------------------------------------------------
+# Migration steps
+# ---------------------------------------------------------------------------
+
+def _require_unique(conn: Connection, table: str, columns: str):
+    """Raise a descriptive error if table already holds duplicate values for
+    columns, which would make a unique index impossible to create."""
+    duplicates = conn.execute(text(
+        f"SELECT {columns}, COUNT(*) FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 5"
+    )).all()
+    if duplicates:
+        raise RuntimeError(
+            f"Cannot add a unique index on {table}({columns}): duplicate rows exist, "
+            f"e.g. {[tuple(row) for row in duplicates]}. Merge them and re-run the migration."
+        )
+
+
+def _add_secondary_indexes(conn: Connection):
+    """Index the real access paths of the ingest and read APIs.
+
+    - aggregators(guid)                                   ingest + every guid filter
+    - devices(aggregator_id, name)                        device lookup by name
+    - device_metric_types(device_id, name)                metric type lookup by name
+    - metric_snapshots(device_id, client_utc_timestamp_epoch)
+                                                          per-device history and
+                                                          "latest snapshot" reads
+    The three identity keys are unique, which also turns a cross-process
+    find-or-create race into an IntegrityError instead of a duplicate row.
+    """
+    _require_unique(conn, 'aggregators', 'guid')
+    _require_unique(conn, 'devices', 'aggregator_id, name')
+    _require_unique(conn, 'device_metric_types', 'device_id, name')
+
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_aggregators_guid "
+        "ON aggregators (guid)"
+    ))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_devices_aggregator_name "
+        "ON devices (aggregator_id, name)"
+    ))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_device_metric_types_device_name "
+        "ON device_metric_types (device_id, name)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_metric_snapshots_device_ts "
+        "ON metric_snapshots (device_id, client_utc_timestamp_epoch)"
+    ))
+    # Refresh planner statistics so the new indexes are used straight away
+    conn.execute(text("ANALYZE"))
+
+
+def _add_metric_rollups(conn: Connection):
+    """Create metric_rollups and backfill it from the raw values already
+    stored, one pass per resolution (1m, 1h, 1d).
+
+    INSERT OR REPLACE recomputes each bucket from the raw rows, so this is
+    correct whether the table is empty or already partly maintained.
+    """
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS metric_rollups ("
+        " device_metric_type_id INTEGER NOT NULL,"
+        " resolution_secs INTEGER NOT NULL,"
+        " bucket_start_epoch INTEGER NOT NULL,"
+        " device_id INTEGER NOT NULL,"
+        " sample_count INTEGER NOT NULL,"
+        " min_value FLOAT NOT NULL,"
+        " max_value FLOAT NOT NULL,"
+        " sum_value FLOAT NOT NULL,"
+        " last_value FLOAT NOT NULL,"
+        " last_epoch INTEGER NOT NULL,"
+        " PRIMARY KEY (device_metric_type_id, resolution_secs, bucket_start_epoch),"
+        " FOREIGN KEY(device_metric_type_id) REFERENCES device_metric_types (device_metric_type_id)"
+        ")"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_metric_rollups_device_bucket "
+        "ON metric_rollups (device_id, resolution_secs, bucket_start_epoch)"
+    ))
+    for resolution in (60, 3600, 86400):
+        conn.execute(text(
+            "INSERT OR REPLACE INTO metric_rollups ("
+            " device_metric_type_id, resolution_secs, bucket_start_epoch, device_id,"
+            " sample_count, min_value, max_value, sum_value, last_value, last_epoch)"
+            " SELECT type_id, :res, bucket, device_id,"
+            "  COUNT(*), MIN(value), MAX(value), SUM(value),"
+            "  MAX(CASE WHEN rn = 1 THEN value END), MAX(epoch)"
+            " FROM ("
+            "  SELECT v.device_metric_type_id AS type_id, s.device_id AS device_id,"
+            "   s.client_utc_timestamp_epoch AS epoch, v.value AS value,"
+            "   s.client_utc_timestamp_epoch - s.client_utc_timestamp_epoch % :res AS bucket,"
+            "   ROW_NUMBER() OVER ("
+            "    PARTITION BY v.device_metric_type_id, s.client_utc_timestamp_epoch - s.client_utc_timestamp_epoch % :res"
+            "    ORDER BY s.client_utc_timestamp_epoch DESC, s.metric_snapshot_id DESC"
+            "   ) AS rn"
+            "  FROM metric_values v"
+            "  JOIN metric_snapshots s ON s.metric_snapshot_id = v.metric_snapshot_id"
+            " )"
+            " GROUP BY type_id, bucket"
+        ), {'res': resolution})
+
+
+def _add_metric_totals(conn: Connection):
+    """Create metric_totals and backfill it from the raw values already
+    stored. INSERT OR REPLACE makes a re-run recompute every total."""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS metric_totals ("
+        " device_metric_type_id INTEGER NOT NULL,"
+        " device_id INTEGER NOT NULL,"
+        " sample_count INTEGER NOT NULL,"
+        " total_value FLOAT NOT NULL,"
+        " PRIMARY KEY (device_metric_type_id),"
+        " FOREIGN KEY(device_metric_type_id) REFERENCES device_metric_types (device_metric_type_id)"
+        ")"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_metric_totals_device "
+        "ON metric_totals (device_id)"
+    ))
+    conn.execute(text(
+        "INSERT OR REPLACE INTO metric_totals (device_metric_type_id, device_id, sample_count, total_value)"
+        " SELECT v.device_metric_type_id, s.device_id, COUNT(*), SUM(v.value)"
+        " FROM metric_values v"
+        " JOIN metric_snapshots s ON s.metric_snapshot_id = v.metric_snapshot_id"
+        " GROUP BY v.device_metric_type_id"
+    ))
+
+
+def _add_device_latest_values(conn: Connection):
+    """Create device_latest_values and fill it with each device's newest
+    snapshot (latest client timestamp, highest id on a tie).
+
+    Packing is done in Python with the same helper ingest uses, so rows
+    written here and rows written by ingest are identical.
+    """
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS device_latest_values ("
+        " device_id INTEGER NOT NULL,"
+        " metric_snapshot_id INTEGER NOT NULL,"
+        " client_utc_timestamp_epoch INTEGER NOT NULL,"
+        " metric_values TEXT NOT NULL,"
+        " PRIMARY KEY (device_id),"
+        " FOREIGN KEY(device_id) REFERENCES devices (device_id)"
+        ")"
+    ))
+    latest = conn.execute(text(
+        "SELECT device_id, metric_snapshot_id, client_utc_timestamp_epoch FROM ("
+        " SELECT device_id, metric_snapshot_id, client_utc_timestamp_epoch,"
+        "  ROW_NUMBER() OVER (PARTITION BY device_id"
+        "   ORDER BY client_utc_timestamp_epoch DESC, metric_snapshot_id DESC) AS rn"
+        " FROM metric_snapshots"
+        ") WHERE rn = 1"
+    )).all()
+    for device_id, snapshot_id, epoch in latest:
+        pairs = conn.execute(text(
+            "SELECT v.device_metric_type_id, t.name, v.value"
+            " FROM metric_values v"
+            " JOIN device_metric_types t ON t.device_metric_type_id = v.device_metric_type_id"
+            " WHERE v.metric_snapshot_id = :id"
+        ), {'id': snapshot_id}).all()
+        conn.execute(text(
+            "INSERT OR REPLACE INTO device_latest_values"
+            " (device_id, metric_snapshot_id, client_utc_timestamp_epoch, metric_values)"
+            " VALUES (:device_id, :snapshot_id, :epoch, :packed)"
+        ), {'device_id': device_id, 'snapshot_id': snapshot_id, 'epoch': epoch,
+            'packed': pack_latest_values(pairs)})
+
+
+def _add_system_state_version(conn: Connection):
+    """Add the system_state.version data-version counter used for ETags."""
+    columns = {row[1] for row in conn.execute(text("PRAGMA table_info(system_state)"))}
+    if 'version' not in columns:
+        conn.execute(text("ALTER TABLE system_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+
+def _add_packed_metric_values(conn: Connection):
+    """Create metric_layouts and packed_metric_values for the packed value
+    layout (see api/packed_values.py). Existing metric_values rows stay
+    where they are; the read API reads both layouts."""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS metric_layouts ("
+        " layout_id INTEGER NOT NULL,"
+        " device_id INTEGER NOT NULL,"
+        " type_ids BLOB NOT NULL,"
+        " PRIMARY KEY (layout_id),"
+        " FOREIGN KEY(device_id) REFERENCES devices (device_id)"
+        ")"
+    ))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_metric_layouts_device_type_ids "
+        "ON metric_layouts (device_id, type_ids)"
+    ))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS packed_metric_values ("
+        " metric_snapshot_id INTEGER NOT NULL,"
+        " layout_id INTEGER NOT NULL,"
+        " metric_values BLOB NOT NULL,"
+        " PRIMARY KEY (metric_snapshot_id),"
+        " FOREIGN KEY(metric_snapshot_id) REFERENCES metric_snapshots (metric_snapshot_id),"
+        " FOREIGN KEY(layout_id) REFERENCES metric_layouts (layout_id)"
+        ")"
+    ))
+
+
+def _add_metric_chunks(conn: Connection):
+    """Create metric_chunks for the chunked value layout (see
+    api/series_chunks.py). Existing values are left where they are."""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS metric_chunks ("
+        " device_metric_type_id INTEGER NOT NULL,"
+        " chunk_start_epoch INTEGER NOT NULL,"
+        " device_id INTEGER NOT NULL,"
+        " first_epoch INTEGER NOT NULL,"
+        " last_epoch INTEGER NOT NULL,"
+        " sample_count INTEGER NOT NULL,"
+        " data BLOB NOT NULL,"
+        " encoder_state BLOB,"
+        " PRIMARY KEY (device_metric_type_id, chunk_start_epoch),"
+        " FOREIGN KEY(device_metric_type_id) REFERENCES device_metric_types (device_metric_type_id)"
+        ")"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_metric_chunks_device_start "
+        "ON metric_chunks (device_id, chunk_start_epoch)"
+    ))
+
+
+def _add_metric_partitions(conn: Connection):
+    """Create the metric_partitions catalog used by partitioned storage
+    (see partitions.py). Existing data stays in this database."""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS metric_partitions ("
+        " partition_key TEXT NOT NULL,"
+        " start_epoch INTEGER NOT NULL,"
+        " end_epoch INTEGER NOT NULL,"
+        " max_snapshot_id INTEGER NOT NULL,"
+        " dropped_epoch INTEGER,"
+        " PRIMARY KEY (partition_key)"
+        ")"
+    ))
+
+
+def _add_metric_chunk_snapshot_tags(conn: Connection):
+    """Add metric_chunks.snapshot_tags, which tells apart the samples of
+    snapshots sharing a device and timestamp (see api/series_chunks.py)."""
+    columns = {row[1] for row in conn.execute(text("PRAGMA table_info(metric_chunks)"))}
+    if 'snapshot_tags' not in columns:
+        conn.execute(text("ALTER TABLE metric_chunks ADD COLUMN snapshot_tags BLOB"))
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, 'add_secondary_indexes',    _add_secondary_indexes),
+    Migration(2, 'add_metric_rollups',       _add_metric_rollups),
+    Migration(3, 'add_metric_totals',        _add_metric_totals),
+    Migration(4, 'add_device_latest_values', _add_device_latest_values),
+    Migration(5, 'add_system_state_version', _add_system_state_version),
+    Migration(6, 'add_packed_metric_values', _add_packed_metric_values),
+    Migration(7, 'add_metric_chunks',        _add_metric_chunks),
+    Migration(8, 'add_metric_partitions',    _add_metric_partitions),
+    Migration(9, 'add_metric_chunk_snapshot_tags', _add_metric_chunk_snapshot_tags),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def current_version(engine: Engine) -> int:
+    """Return the highest applied migration version, or 0 if none have been
+    applied (or the schema_migrations table does not exist yet)."""
+    if not inspect(engine).has_table('schema_migrations'):
+        return 0
+    with engine.connect() as conn:
+        version = conn.execute(text("SELECT MAX(version) FROM schema_migrations")).scalar()
+    return version or 0
+
+
+def upgrade(engine: Engine) -> int:
+    """Apply every migration newer than the database's current version.
+
+    Each migration and its schema_migrations row are committed together, so
+    a failure leaves the database at the last fully applied version.
+
+    Args:
+        engine: Engine connected to the database to upgrade
+
+    Returns:
+        The schema version after upgrading.
+    """
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    version = current_version(engine)
+
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        _logger.info("Applying migration %d: %s", migration.version, migration.name)
+        with engine.begin() as conn:
+            migration.apply(conn)
+            conn.execute(
+                SchemaMigration.__table__.insert().values(
+                    version=migration.version,
+                    name=migration.name,
+                    applied_at=int(datetime.now(timezone.utc).timestamp())
+                )
+            )
+        version = migration.version
+
+    _logger.info("Database schema is at version %d", version)
+    return version
+
+
+def enable_incremental_vacuum(engine: Engine):
+    """Rebuild the database with auto_vacuum=INCREMENTAL so the retention
+    task can shrink the file. New databases are created that way already
+    (see database.py); older ones need this once. VACUUM copies the whole
+    database and holds an exclusive lock while it does."""
+    if engine.dialect.name != 'sqlite':
+        _logger.info("Incremental vacuum only applies to SQLite databases")
+        return
+    connection = engine.raw_connection()
+    try:
+        sqlite = connection.driver_connection
+        if sqlite.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            _logger.info("Database already uses incremental auto-vacuum")
+            return
+        _logger.info("Rebuilding the database with incremental auto-vacuum")
+        sqlite.executescript("PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+    finally:
+        connection.close()
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO)
+    config = Config(__file__)
+    engine = create_db_engine(config, immediate_writes=True)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        print(f"current: {current_version(engine)}  latest: {LATEST_VERSION}")
+        return 0
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'vacuum':
+        try:
+            enable_incremental_vacuum(engine)
+            return 0
+        except Exception as e:
+            _logger.exception("Vacuum failed: %s", str(e))
+            return 1
+
+    try:
+        upgrade(engine)
+        store = partition_store(config)
+        if store is not None:
+            store.upgrade_files()
+        return 0
+    except Exception as e:
+        _logger.exception("Migration failed: %s", str(e))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
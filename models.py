@@ -1,5 +1,5 @@
 # coding: utf-8
-from sqlalchemy import Column, Float, ForeignKey, Integer, Table, Text
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, LargeBinary, Table, Text
 from sqlalchemy.sql.sqltypes import NullType
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -7,9 +7,17 @@ from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 metadata = Base.metadata
 
+# Schema of the tables that grow with every snapshot. database.py maps it to
+# the main database; with partitioned storage (see partitions.py) a session
+# can point it at one of the attached partition files instead.
+PARTITION_SCHEMA = 'partition'
+
 
 class Aggregator(Base):
     __tablename__ = 'aggregators'
+    __table_args__ = (
+        Index('ux_aggregators_guid', 'guid', unique=True),
+    )
 
     aggregator_id = Column(Integer, primary_key=True)
     guid          = Column(Text, nullable=False)
@@ -18,6 +26,10 @@ class Aggregator(Base):
 
 class MetricSnapshot(Base):
     __tablename__ = 'metric_snapshots'
+    __table_args__ = (
+        Index('ix_metric_snapshots_device_ts', 'device_id', 'client_utc_timestamp_epoch'),
+        {'schema': PARTITION_SCHEMA},
+    )
 
     metric_snapshot_id         = Column(Integer, primary_key=True)
     device_id                  = Column(Integer, nullable=False)
@@ -36,6 +48,9 @@ t_sqlite_sequence = Table(
 
 class Device(Base):
     __tablename__ = 'devices'
+    __table_args__ = (
+        Index('ux_devices_aggregator_name', 'aggregator_id', 'name', unique=True),
+    )
 
     device_id     = Column(Integer, primary_key=True)
     aggregator_id = Column(ForeignKey('aggregators.aggregator_id'), nullable=False)
@@ -47,6 +62,9 @@ class Device(Base):
 
 class DeviceMetricType(Base):
     __tablename__ = 'device_metric_types'
+    __table_args__ = (
+        Index('ux_device_metric_types_device_name', 'device_id', 'name', unique=True),
+    )
 
     device_metric_type_id = Column(Integer, primary_key=True)
     device_id             = Column(ForeignKey('devices.device_id'), nullable=False)
@@ -57,25 +75,184 @@ class DeviceMetricType(Base):
 
 class MetricValue(Base):
     __tablename__ = 'metric_values'
+    __table_args__ = (
+        {'schema': PARTITION_SCHEMA},
+    )
 
-    metric_snapshot_id    = Column(ForeignKey('metric_snapshots.metric_snapshot_id'),          primary_key=True, nullable=False)
-    device_metric_type_id = Column(ForeignKey('device_metric_types.device_metric_type_id'),    primary_key=True, nullable=False)
+    metric_snapshot_id    = Column(ForeignKey(f'{PARTITION_SCHEMA}.metric_snapshots.metric_snapshot_id'), primary_key=True, nullable=False)
+    device_metric_type_id = Column(ForeignKey('device_metric_types.device_metric_type_id'),               primary_key=True, nullable=False)
     value                 = Column(Float, nullable=False)
 
     device_metric_type = relationship('DeviceMetricType')
     metric_snapshot    = relationship('MetricSnapshot')
 
 
+class MetricLayout(Base):
+    """The metric type ids of a device's snapshots, in the order the agent
+    sent them, packed as a little-endian uint32 array. Shared by every
+    packed snapshot of the device with the same metrics, and never changed
+    once written (see api/packed_values.py).
+    """
+    __tablename__ = 'metric_layouts'
+    __table_args__ = (
+        Index('ux_metric_layouts_device_type_ids', 'device_id', 'type_ids', unique=True),
+    )
+
+    layout_id = Column(Integer, primary_key=True)
+    device_id = Column(ForeignKey('devices.device_id'), nullable=False)
+    type_ids  = Column(LargeBinary, nullable=False)
+
+
+class PackedMetricValues(Base):
+    """All metric values of one snapshot in a single row, written instead of
+    metric_values rows when ingest_api.value_layout is "packed".
+
+    metric_values is a little-endian float64 array in the order of the
+    layout's type ids.
+    """
+    __tablename__ = 'packed_metric_values'
+    __table_args__ = (
+        {'schema': PARTITION_SCHEMA},
+    )
+
+    metric_snapshot_id = Column(ForeignKey(f'{PARTITION_SCHEMA}.metric_snapshots.metric_snapshot_id'), primary_key=True)
+    layout_id          = Column(ForeignKey('metric_layouts.layout_id'), nullable=False)
+    metric_values      = Column(LargeBinary, nullable=False)
+
+
+class MetricChunk(Base):
+    """A fixed-duration run of one device metric's samples, written instead of
+    metric_values rows for aggregators stored in the "chunked" value layout.
+
+    data is a Gorilla-style bitstream (delta-of-delta timestamps, XOR
+    encoded values; see api/series_chunks.py). The newest chunk of a metric
+    is open and keeps its encoder_state so samples can be appended; older
+    ones are sealed, with data zlib compressed and encoder_state NULL.
+    first_epoch and last_epoch bound the samples so range reads can skip
+    chunks that do not overlap. snapshot_tags names the snapshot of each
+    sample whose snapshot is not the first of its device at that timestamp.
+    """
+    __tablename__ = 'metric_chunks'
+    __table_args__ = (
+        Index('ix_metric_chunks_device_start', 'device_id', 'chunk_start_epoch'),
+        {'schema': PARTITION_SCHEMA},
+    )
+
+    device_metric_type_id = Column(ForeignKey('device_metric_types.device_metric_type_id'), primary_key=True, nullable=False)
+    chunk_start_epoch     = Column(Integer, primary_key=True, nullable=False)
+    device_id             = Column(Integer, nullable=False)
+    first_epoch           = Column(Integer, nullable=False)
+    last_epoch            = Column(Integer, nullable=False)
+    sample_count          = Column(Integer, nullable=False)
+    data                  = Column(LargeBinary, nullable=False)
+    encoder_state         = Column(LargeBinary)   # NULL once sealed
+    snapshot_tags         = Column(LargeBinary)   # (sample index, snapshot id) pairs, if any
+
+
+class MetricRollup(Base):
+    """Time-bucketed summary of one device metric, maintained incrementally
+    by ingest_api in the same transaction as the raw values. One row per
+    (metric type, resolution, bucket); resolution_secs is 60, 3600 or 86400.
+
+    Lets read_api answer /metrics?resolution= from one row per bucket instead
+    of scanning every raw sample in the range.
+    """
+    __tablename__ = 'metric_rollups'
+    __table_args__ = (
+        Index('ix_metric_rollups_device_bucket', 'device_id', 'resolution_secs', 'bucket_start_epoch'),
+    )
+
+    device_metric_type_id = Column(ForeignKey('device_metric_types.device_metric_type_id'), primary_key=True, nullable=False)
+    resolution_secs       = Column(Integer, primary_key=True, nullable=False)
+    bucket_start_epoch    = Column(Integer, primary_key=True, nullable=False)
+    device_id             = Column(Integer, nullable=False)
+    sample_count          = Column(Integer, nullable=False)
+    min_value             = Column(Float,   nullable=False)
+    max_value             = Column(Float,   nullable=False)
+    sum_value             = Column(Float,   nullable=False)
+    last_value            = Column(Float,   nullable=False)
+    last_epoch            = Column(Integer, nullable=False)  # client epoch of last_value
+
+
+class MetricTotal(Base):
+    """All-time running total of one device metric, maintained incrementally
+    by ingest_api in the same transaction as the raw values.
+
+    Lets read_api answer /pokemon_info (usage counts summed over every
+    snapshot a format has ever stored) with one keyed read per device.
+    """
+    __tablename__ = 'metric_totals'
+    __table_args__ = (
+        Index('ix_metric_totals_device', 'device_id'),
+    )
+
+    device_metric_type_id = Column(ForeignKey('device_metric_types.device_metric_type_id'), primary_key=True)
+    device_id             = Column(Integer, nullable=False)
+    sample_count          = Column(Integer, nullable=False)
+    total_value           = Column(Float,   nullable=False)
+
+    device_metric_type    = relationship('DeviceMetricType')
+
+
+class DeviceLatestValues(Base):
+    """The newest snapshot of each device with its metric values packed into
+    one JSON column, maintained incrementally by ingest_api in the same
+    transaction as the raw values.
+
+    metric_values is a JSON list of [metric name, value] pairs in metric type
+    order. Lets read_api answer the "current state" endpoints (/pc_device_info,
+    /trainer_info) with a single keyed read.
+    """
+    __tablename__ = 'device_latest_values'
+
+    device_id                  = Column(ForeignKey('devices.device_id'), primary_key=True)
+    metric_snapshot_id         = Column(Integer, nullable=False)
+    client_utc_timestamp_epoch = Column(Integer, nullable=False)
+    metric_values              = Column(Text,    nullable=False)
+
+
 class SystemState(Base):
     """Single-row table used as a lightweight signal between ingest_api and
     read_api. ingest_api updates last_updated after every successful snapshot
     write. read_api's SSE endpoint watches this value and pushes updates to
     connected frontend clients whenever it changes.
 
+    version is incremented by every committed write, so unlike last_updated
+    it changes even when two writes land in the same second. read_api uses
+    it as the data version behind its ETag headers.
+
     Only one row ever exists (id=1). It is created automatically on first
     snapshot ingest if it doesn't exist.
     """
     __tablename__ = 'system_state'
 
     id           = Column(Integer, primary_key=True)
-    last_updated = Column(Integer, nullable=False)  # UTC epoch timestamp
\ No newline at end of file
+    last_updated = Column(Integer, nullable=False)  # UTC epoch timestamp
+    version      = Column(Integer, nullable=False, server_default='0')
+
+
+class MetricPartition(Base):
+    """Catalog of the partition files used by partitioned storage (see
+    partitions.py): the period each one covers and the highest snapshot id
+    written to it. Rows of dropped partitions are kept, with dropped_epoch
+    set, so their snapshot ids are never handed out again.
+    """
+    __tablename__ = 'metric_partitions'
+
+    partition_key   = Column(Text,    primary_key=True)   # '2026-10'
+    start_epoch     = Column(Integer, nullable=False)      # inclusive
+    end_epoch       = Column(Integer, nullable=False)      # exclusive
+    max_snapshot_id = Column(Integer, nullable=False)
+    dropped_epoch   = Column(Integer)                       # NULL while live
+
+
+class SchemaMigration(Base):
+    """One row per schema migration applied by migrations.py. The highest
+    version present is the database's current schema version, so upgrades
+    can be re-run safely and only apply what is missing.
+    """
+    __tablename__ = 'schema_migrations'
+
+    version    = Column(Integer, primary_key=True)
+    name       = Column(Text, nullable=False)
+    applied_at = Column(Integer, nullable=False)  # UTC epoch timestamp
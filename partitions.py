@@ -0,0 +1,406 @@
+"""
+partitions.py
+
+Optional time-partitioned storage for the raw snapshot tables.
+
+By default everything lives in the one database file. With
+database.partitions.enabled set in config.json, the tables that grow with
+every snapshot are written to one SQLite file per period instead (monthly
+by default):
+
+    metrics.db                      identities, rollups, totals, latest values,
+                                    system state and the metric_partitions catalog
+    partitions/metrics-2026-10.db   metric_snapshots, metric_values,
+    partitions/metrics-2026-11.db   packed_metric_values and metric_chunks for
+    ...                             snapshots taken in that month
+
+A snapshot goes to the partition of its client timestamp, so each file
+covers a fixed time range and its indexes stay as small as one period's
+data. The files are ATTACHed to a connection only when a query needs them
+(at most max_attached at a time per connection, least recently used ones
+are detached first).
+
+The partitioned tables are declared with the schema PARTITION_SCHEMA in
+models.py. database.py maps that schema to the main database on every
+engine, so unpartitioned databases work exactly as before; use() re-points
+it at an attached partition for the queries that follow on that session.
+
+metric_partitions records each partition's time range and highest snapshot
+id. Snapshot ids stay unique and increasing in commit order across all
+files (the writer allocates them, see allocate_ids()), so readers can still
+page by id, and the catalog lets them skip every partition that cannot
+hold a snapshot in the requested time range or above a given id.
+
+Dropping a partition marks it dropped in the catalog and deletes its file:
+no DELETE statements, no free pages left behind. Partitions whose period
+ended more than cold_after_days ago are attached read-only by readers and
+memory-mapped (cold_mmap_size_mb).
+
+SQLite only commits atomically across attached files in rollback-journal
+mode; in WAL mode a crash in the middle of a commit can leave a batch's
+snapshots in a partition without the matching rollups in metrics.db, or the
+other way round.
+
+Usage:
+    store = partition_store(config)            # None unless enabled
+    with store.session(engine, keys) as session:
+        store.use(session, key)                # partition tables → that file
+        ...
+    for key in store.select(session, start_epoch, end_epoch):
+        store.read(session, key)               # attach on demand, then use()
+        ...
+"""
+
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import NamedTuple
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+
+from models import (
+    PARTITION_SCHEMA, MetricChunk, MetricPartition, MetricSnapshot, MetricValue, PackedMetricValues
+)
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_PERIOD            = 'month'
+DEFAULT_DIRECTORY         = 'partitions'   # relative to the main database file
+DEFAULT_MAX_ATTACHED      = 8              # SQLite allows 10 by default
+DEFAULT_COLD_AFTER_DAYS   = 31
+DEFAULT_COLD_MMAP_SIZE_MB = 256
+
+PERIODS = ('month', 'day')
+
+# Tables stored in each partition file
+PARTITIONED_TABLES = [
+    MetricSnapshot.__table__, MetricValue.__table__, PackedMetricValues.__table__, MetricChunk.__table__,
+]
+
+# connection.info key holding {schema: (path, st_ino, read_only)} in attach order
+_ATTACHED = 'attached_partitions'
+
+
+class Partition(NamedTuple):
+    """One live row of the metric_partitions catalog."""
+    key:             str
+    start_epoch:     int   # inclusive
+    end_epoch:       int   # exclusive
+    max_snapshot_id: int
+
+
+def partition_store(config) -> 'PartitionStore | None':
+    """Build the PartitionStore for config.database.partitions, or None if
+    partitioned storage is not enabled."""
+    settings = getattr(config.database, 'partitions', None)
+    if settings is None or not getattr(settings, 'enabled', False):
+        return None
+    return PartitionStore(config.database.connection_string, settings)
+
+
+class PartitionStore:
+    """Names, creates, attaches and drops partition files.
+
+    Args:
+        connection_string: The main database URL; partition files live in a
+                           directory next to it
+        settings:          The database.partitions config section
+
+    Raises:
+        ValueError: If the period is unknown or the database is not a SQLite
+                    file.
+    """
+
+    def __init__(self, connection_string: str, settings):
+        url = make_url(connection_string)
+        if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+            raise ValueError("database.partitions requires a file-based SQLite database")
+        self._period = getattr(settings, 'period', DEFAULT_PERIOD)
+        if self._period not in PERIODS:
+            raise ValueError(f"database.partitions.period must be one of {list(PERIODS)}, got {self._period!r}")
+        main_dir             = Path(url.database).resolve().parent
+        self._directory      = main_dir / getattr(settings, 'directory', DEFAULT_DIRECTORY)
+        self._max_attached   = int(getattr(settings, 'max_attached',    DEFAULT_MAX_ATTACHED))
+        self._cold_after     = int(getattr(settings, 'cold_after_days', DEFAULT_COLD_AFTER_DAYS)) * 86400
+        self._cold_mmap_size = int(getattr(settings, 'cold_mmap_size_mb', DEFAULT_COLD_MMAP_SIZE_MB)) * 1024 * 1024
+        self._create_lock    = threading.Lock()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Naming
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def key_for(self, epoch: int) -> str:
+        """Partition key of a client timestamp: '2026-10', or '2026-10-18'
+        with daily partitions."""
+        moment = datetime.fromtimestamp(epoch, timezone.utc)
+        return moment.strftime('%Y-%m' if self._period == 'month' else '%Y-%m-%d')
+
+    def bounds(self, key: str) -> tuple[int, int]:
+        """(start, end) epochs of a partition; end is exclusive."""
+        if self._period == 'month':
+            start = datetime.strptime(key, '%Y-%m').replace(tzinfo=timezone.utc)
+            end   = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+            return int(start.timestamp()), int(end.timestamp())
+        start = int(datetime.strptime(key, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+        return start, start + 86400
+
+    @staticmethod
+    def schema(key: str) -> str:
+        """Name a partition is attached under."""
+        return 'p_' + key.replace('-', '_')
+
+    def path(self, key: str) -> Path:
+        return self._directory / f'metrics-{key}.db'
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Sessions
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @contextmanager
+    def session(self, engine: Engine, keys=(), create: bool = False):
+        """Open a Session whose connection has the given partitions attached.
+
+        Attaching is done before the session begins its transaction, as
+        SQLite requires, so this is how writers get a session. Readers can
+        use read() instead.
+
+        Args:
+            engine: Engine to connect with
+            keys:   Partition keys the session will use
+            create: Create partition files that do not exist yet (writer only)
+        """
+        connection = engine.connect()
+        try:
+            if create:
+                for key in keys:
+                    self.ensure_created(key)
+            self.attach(connection, keys)
+            with Session(bind=connection) as session:
+                yield session
+        finally:
+            connection.close()
+
+    def use(self, session: Session, key: str | None):
+        """Point the partitioned tables at partition key (which must be
+        attached), or back at the main database with None, for the rest of
+        the session."""
+        session.connection().execution_options(
+            schema_translate_map={PARTITION_SCHEMA: None if key is None else self.schema(key)}
+        )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Files
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def ensure_created(self, key: str):
+        """Create a partition file with the partitioned tables if it does not
+        exist yet."""
+        path = self.path(key)
+        if path.exists():
+            return
+        with self._create_lock:
+            if path.exists():
+                return
+            self._directory.mkdir(parents=True, exist_ok=True)
+            engine = self._file_engine(path)
+            try:
+                PARTITIONED_TABLES[0].metadata.create_all(engine, tables=PARTITIONED_TABLES)
+            finally:
+                engine.dispose()
+            _logger.info("Created partition %s at %s", key, path)
+
+    def upgrade_files(self):
+        """Add the columns models.py has gained since each existing partition
+        file was created. The partition counterpart of migrations.upgrade(),
+        run wherever that is."""
+        if not self._directory.is_dir():
+            return
+        for path in sorted(self._directory.glob('metrics-*.db')):
+            engine = self._file_engine(path)
+            try:
+                with engine.begin() as connection:
+                    for table in PARTITIONED_TABLES:
+                        present = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table.name})")}
+                        for column in table.columns:
+                            if column.name not in present:
+                                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                                connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+                                _logger.info("Added %s.%s to %s", table.name, column.name, path)
+            finally:
+                engine.dispose()
+
+    @staticmethod
+    def _file_engine(path: Path) -> Engine:
+        """Engine on one partition file by itself, for creating and upgrading it."""
+        engine = create_engine(f'sqlite:///{path}').execution_options(
+            schema_translate_map={PARTITION_SCHEMA: None}
+        )
+
+        @event.listens_for(engine, 'connect')
+        def _profile(dbapi_connection, _connection_record):
+            # auto_vacuum has to be set before the first table is created
+            dbapi_connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+        return engine
+
+    def attach(self, connection: Connection, keys, read_only=()):
+        """Make sure each partition in keys is attached to connection.
+
+        Partitions already attached are reused unless their file was deleted
+        or replaced since. When more than max_attached would be attached, the
+        least recently used others are detached first.
+
+        Args:
+            connection: Connection with no transaction in progress
+            keys:       Partition keys to attach
+            read_only:  Keys to attach read-only and memory-mapped
+        """
+        dbapi    = connection.connection.driver_connection
+        attached = connection.connection.info.setdefault(_ATTACHED, {})
+        wanted   = {self.schema(key): key for key in keys}
+
+        # Let go of files that were dropped or replaced since
+        for schema, (path, inode, _) in list(attached.items()):
+            if not self._is_current(path, inode):
+                dbapi.execute(f"DETACH DATABASE {schema}")
+                del attached[schema]
+
+        for schema, key in wanted.items():
+            cold = key in read_only
+            if schema in attached:
+                if attached[schema][2] == cold:
+                    attached[schema] = attached.pop(schema)   # most recently used
+                    continue
+                dbapi.execute(f"DETACH DATABASE {schema}")
+                del attached[schema]
+            while len(attached) >= self._max_attached:
+                stale = next((s for s in attached if s not in wanted), None)
+                if stale is None:
+                    raise RuntimeError(
+                        f"A query needs more than database.partitions.max_attached={self._max_attached} partitions"
+                    )
+                dbapi.execute(f"DETACH DATABASE {stale}")
+                del attached[stale]
+
+            path = self.path(key)
+            if cold:
+                dbapi.execute(f"ATTACH DATABASE ? AS {schema}", (f'file:{path}?mode=ro',))
+                dbapi.execute(f"PRAGMA {schema}.mmap_size={self._cold_mmap_size}")
+            else:
+                dbapi.execute(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+            attached[schema] = (str(path), os.stat(path).st_ino, cold)
+
+    @staticmethod
+    def _is_current(path: str, inode: int) -> bool:
+        try:
+            return os.stat(path).st_ino == inode
+        except FileNotFoundError:
+            return False
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Catalog
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def live(session: Session) -> list[Partition]:
+        """Every partition not dropped, oldest first."""
+        return [
+            Partition(*row) for row in session.execute(
+                select(MetricPartition.partition_key, MetricPartition.start_epoch,
+                       MetricPartition.end_epoch, MetricPartition.max_snapshot_id)
+                .where(MetricPartition.dropped_epoch.is_(None))
+                .order_by(MetricPartition.start_epoch)
+            )
+        ]
+
+    def select(self, session: Session, start_epoch: int | None = None, end_epoch: int | None = None,
+               after_id: int | None = None) -> list[str | None]:
+        """The partitions a read needs, in time order.
+
+        Only partitions overlapping [start_epoch, end_epoch] and holding
+        snapshot ids above after_id are kept. The main database is always
+        first (as None), for data written before partitioning was enabled.
+
+        Returns:
+            Keys to pass to read() one after another.
+        """
+        return [None] + [
+            partition.key for partition in self.live(session)
+            if (start_epoch is None or partition.end_epoch > start_epoch)
+            and (end_epoch is None or partition.start_epoch <= end_epoch)
+            and (after_id is None or partition.max_snapshot_id > after_id)
+        ]
+
+    def read(self, session: Session, key: str | None):
+        """Attach partition key to a reading session if needed, read-only
+        and memory-mapped once its period ended cold_after_days ago, and
+        point the partitioned tables at it (None: the main database).
+
+        Partitions are attached one at a time as a read reaches them, so a
+        read can span more of them than max_attached. Only for sessions
+        that have not written anything: SQLite cannot attach or detach
+        inside a write transaction.
+        """
+        if key is not None:
+            cold = self.bounds(key)[1] <= datetime.now(timezone.utc).timestamp() - self._cold_after
+            self.attach(session.connection(), [key], read_only={key} if cold else ())
+        self.use(session, key)
+
+    def allocate_ids(self, session: Session, count: int) -> int:
+        """Reserve count snapshot ids, returning the first. Ids continue from
+        the highest one ever used, in the main database or any partition,
+        including dropped ones. Call with the write lock held."""
+        self.use(session, None)
+        highest = session.execute(select(
+            func.max(
+                func.coalesce(select(func.max(MetricSnapshot.metric_snapshot_id)).scalar_subquery(), 0),
+                func.coalesce(select(func.max(MetricPartition.max_snapshot_id)).scalar_subquery(), 0),
+            )
+        )).scalar()
+        return highest + 1
+
+    def record(self, session: Session, key: str, max_snapshot_id: int):
+        """Register a write of snapshots up to max_snapshot_id to partition
+        key in the catalog, in the writing transaction."""
+        start, end = self.bounds(key)
+        stmt  = sqlite_insert(MetricPartition).values(
+            partition_key=key, start_epoch=start, end_epoch=end, max_snapshot_id=max_snapshot_id
+        )
+        table = MetricPartition.__table__.c
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=['partition_key'],
+            set_={
+                'max_snapshot_id': func.max(table.max_snapshot_id, stmt.excluded.max_snapshot_id),
+                'dropped_epoch':   None,
+            }
+        ))
+
+    def drop(self, engine: Engine, key: str):
+        """Drop a partition: mark it dropped in the catalog, then delete its
+        file. Readers stop using it as soon as the catalog commits.
+
+        Idle pooled connections of engine are closed so that none of them
+        keeps the deleted file open; connections of other processes let go
+        of it the next time they attach partitions.
+        """
+        with Session(engine) as session:
+            row = session.get(MetricPartition, key)
+            if row is None or row.dropped_epoch is not None:
+                return
+            row.dropped_epoch = int(datetime.now(timezone.utc).timestamp())
+            session.commit()
+        engine.dispose()
+        path = self.path(key)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(f'{path}{suffix}')
+            except FileNotFoundError:
+                pass
+        _logger.info("Dropped partition %s", key)
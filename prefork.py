@@ -0,0 +1,213 @@
+"""
+prefork.py
+
+Multi-process production serving for 'python server.py serve'.
+
+'python server.py both' runs both APIs in one process, so they share one
+GIL and one core. Here a supervisor opens each API's listening socket once
+and forks worker processes that all accept from it:
+
+    supervisor (this process) — binds the ports, restarts crashed children
+      ├── writer                    the only process that writes to SQLite
+      ├── ingest worker × N  ─┐     accept on ingest_api.port, validate each
+      │                       └──►  request and forward it to the writer
+      └── read worker × M           accept on read_api.port
+
+Ingest workers never touch the database: they hand every validated batch to
+the designated writer over a local socket (see api/writer_channel.py), so
+there is still exactly one writer with one identity cache and, if enabled,
+one group-commit queue and one retention thread (see api/retention.py).
+After each commit the writer wakes every read worker through its
+ChangeNotifier (see api/change_notify.py); each read worker then pushes to
+its own SSE clients and refreshes its own response cache.
+
+Worker counts come from ingest_api.workers and read_api.workers in
+config.json (read_api.workers defaults to the number of CPUs). Requires
+os.fork, so Unix only.
+
+Usage:
+    python server.py serve
+"""
+
+import os
+import signal
+import socket
+import secrets
+import logging
+import threading
+from sqlalchemy.engine import Engine
+
+from database import create_db_engine
+from migrations import upgrade
+from partitions import partition_store
+from api.change_notify import default_notify_dir
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_INGEST_WORKERS = 2
+DEFAULT_READ_WORKERS   = os.cpu_count() or 1
+LISTEN_BACKLOG         = 1024
+
+RESPAWN_DELAY    = 1    # seconds to wait before restarting a crashed child
+SHUTDOWN_TIMEOUT = 10   # seconds children get to exit before being killed
+
+WRITER = 'writer'
+INGEST = 'ingest'
+READ   = 'read'
+
+
+class Supervisor:
+    """Forks and looks after the writer, ingest and read worker processes.
+
+    Args:
+        config: Loaded Config instance
+    """
+
+    def __init__(self, config):
+        self.config          = config
+        self._ingest_workers = int(getattr(config.ingest_api, 'workers', DEFAULT_INGEST_WORKERS))
+        self._read_workers   = int(getattr(config.read_api,   'workers', DEFAULT_READ_WORKERS))
+        self._children: dict[int, tuple[str, int]] = {}   # pid → (role, index)
+        self._stopping       = False
+        self._ingest_socket: socket.socket | None = None
+        self._read_socket:   socket.socket | None = None
+        self._writer_address = str(default_notify_dir(config) / 'writer.sock')
+        self._authkey        = secrets.token_bytes(32)
+
+    def run(self) -> int:
+        """Start every child and supervise them until SIGINT or SIGTERM."""
+        if not hasattr(os, 'fork'):
+            _logger.error("server.py serve needs os.fork; use 'both' on this platform")
+            return 1
+        try:
+            self._prepare()
+        except Exception as e:
+            _logger.exception("Could not start serving: %s", str(e))
+            return 1
+
+        signal.signal(signal.SIGINT,  self._on_stop_signal)
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+
+        self._spawn(WRITER, 0)
+        for index in range(self._ingest_workers):
+            self._spawn(INGEST, index)
+        for index in range(self._read_workers):
+            self._spawn(READ, index)
+        _logger.info("Serving with 1 writer, %d ingest worker(s) on port %s and %d read worker(s) on port %s",
+                     self._ingest_workers, self.config.ingest_api.port,
+                     self._read_workers, self.config.read_api.port)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            role, index = self._children.pop(pid, (None, None))
+            if role is None or self._stopping:
+                continue
+            _logger.warning("%s %d (pid %d) exited with status %d; restarting",
+                            role, index, pid, os.waitstatus_to_exitcode(status))
+            threading.Event().wait(RESPAWN_DELAY)
+            if not self._stopping:
+                self._spawn(role, index)
+
+        _logger.info("All workers stopped")
+        return 0
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Startup
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _prepare(self):
+        """Bring the schema up to date and open both listening sockets before
+        any child exists, so workers never race each other to do either."""
+        engine: Engine = create_db_engine(self.config, immediate_writes=True)
+        try:
+            upgrade(engine)
+            store = partition_store(self.config)
+            if store is not None:
+                store.upgrade_files()
+        finally:
+            # Forked children must not inherit open database connections
+            engine.dispose()
+
+        self._ingest_socket = _listen(self.config.ingest_api.port)
+        self._read_socket   = _listen(self.config.read_api.port)
+
+        os.makedirs(os.path.dirname(self._writer_address), exist_ok=True)
+        if os.path.exists(self._writer_address):
+            os.unlink(self._writer_address)   # left behind by a previous run
+
+    def _spawn(self, role: str, index: int):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = (role, index)
+            return
+
+        # Child: never return into the supervisor's loop
+        code = 1
+        try:
+            signal.signal(signal.SIGINT,  signal.SIG_IGN)   # the supervisor handles Ctrl+C
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = self._run_child(role, index)
+        except Exception as e:
+            _logger.exception("%s %d failed: %s", role, index, str(e))
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _run_child(self, role: str, index: int) -> int:
+        # Imported here so each child builds its own engines after the fork
+        if role == WRITER:
+            from api.ingest_api import IngestAPI
+            from api.writer_channel import WriterServer
+            self._ingest_socket.close()
+            self._read_socket.close()
+            ingest = IngestAPI()
+            ingest.start_maintenance()
+            WriterServer(ingest, self._writer_address, self._authkey).serve_forever()
+            return 0
+
+        if role == INGEST:
+            from api.ingest_api import IngestAPI
+            from api.writer_channel import WriterClient
+            self._read_socket.close()
+            ingest = IngestAPI()
+            ingest.use_remote_writer(WriterClient(self._writer_address, self._authkey))
+            return ingest.run(self._ingest_socket)
+
+        from api.read_api import ReadAPI
+        self._ingest_socket.close()
+        read = ReadAPI()
+        read.set_worker(index, self._read_workers)
+        return read.run(self._read_socket)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Shutdown
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _on_stop_signal(self, signum, frame):
+        if self._stopping:
+            return
+        _logger.info("Stopping %d worker process(es)", len(self._children))
+        self._stopping = True
+        self._signal_children(signal.SIGTERM)
+        signal.signal(signal.SIGALRM, lambda *_: self._signal_children(signal.SIGKILL))
+        signal.alarm(SHUTDOWN_TIMEOUT)
+
+    def _signal_children(self, signum: int):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+
+def _listen(port: int) -> socket.socket:
+    """Open a TCP socket listening on every interface, to be shared by forked workers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+